@@ -0,0 +1,276 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import zipfile
+from datetime import datetime
+from typing import Callable, Dict, List, Set
+
+from PIL import Image
+
+from scheduler import ThermalScheduler
+from settings import Folders, Settings
+from timelapse import TimelapseGallery
+from utils import lower_thread_priority
+
+logger = logging.getLogger(__name__)
+
+# The archive actions, applied in this order:
+# - downscale - the JPEG files larger than archive_max_size are downscaled to fit, e.g. 3840 for 4K
+# - dng_only - the JPEG files are deleted when their DNG file exists
+# - pack - the JPEG files are packed into a single uncompressed zip file, see PACK_NAME
+ARCHIVE_ACTIONS = ("downscale", "dng_only", "pack")
+# The file recording the actions applied to a timelapse, in its photos folder
+ARCHIVE_MARKER = "archive.json"
+# The file the JPEG files are packed into, in the timelapse's photos folder
+PACK_NAME = "frames.zip"
+# The time between two archive passes (s)
+ARCHIVE_INTERVAL = 3600
+# Taken by the archive passes, so that only one web server process archives at a time
+ARCHIVE_LOCK = ".archive.lock"
+
+
+def folder_size(folder: str) -> int:
+    """
+    Gets the size of the files of a folder, without its subfolders.
+    Arguments:
+    folder - the path of the folder
+    """
+    with os.scandir(folder) as entries:
+        return sum(entry.stat().st_size for entry in entries if entry.is_file())
+
+
+class Archiver:
+    """
+    Compacts the finished timelapses in a low priority background thread, following the retention policy of the
+    settings: once a timelapse is older than archive_after_days, the archive actions are applied to its photos.
+    The thumbnails are kept, the gallery still shows the archived timelapses. A timelapse whose files are still waiting
+    to be uploaded is archived on a later pass, once they're uploaded.
+    """
+
+    def __init__(self, settings: Settings, folders: Folders, gallery: TimelapseGallery,
+                 ongoing_folders: Callable[[], Set[str]], scheduler: ThermalScheduler = None,
+                 pending_uploads: Callable[[str], int] = None):
+        """
+        Arguments:
+        settings - the settings, see the archive_* settings
+        folders - the folders of the timelapses
+        gallery - the timelapse gallery, updated after each timelapse is archived
+        ongoing_folders - gets the names of the timelapses being taken, which are never archived
+        scheduler - optional, defers the archiving while the Pi is hot or a photo is being taken
+        pending_uploads - optional, counts the files of a timelapse waiting to be uploaded, see Uploader
+        """
+        self.actions = [action for action in settings.archive_actions if action in ARCHIVE_ACTIONS]
+        for action in settings.archive_actions:
+            if action not in ARCHIVE_ACTIONS:
+                logger.warning("Unknown archive action: %s", action)
+        self.after_days = settings.archive_after_days
+        self.max_size = settings.archive_max_size
+        self.folders = folders
+        self.gallery = gallery
+        self.ongoing_folders = ongoing_folders
+        self.scheduler = scheduler
+        self.pending_uploads = pending_uploads
+        self.archived_items = 0
+        self.failed_items = 0
+        self.reclaimed_bytes = 0
+        self.last_run = None
+        self.running = False
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """ Starts the archive passes, if an archive action is set """
+        if not self.actions or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name="archiver", daemon=True)
+        self.thread.start()
+
+    def status(self) -> Dict:
+        """ Gets the status of the archiver as a Dict to be serialized """
+        return {
+            "actions": self.actions,
+            "running": self.running,
+            "last_run": self.last_run,
+            "archived": self.archived_items,
+            "failed": self.failed_items,
+            "reclaimed_bytes": self.reclaimed_bytes,
+        }
+
+    def run(self):
+        """ Runs an archive pass every ARCHIVE_INTERVAL - is meant to be ran in a thread """
+        lower_thread_priority()
+        while True:
+            try:
+                self.archive_pass()
+            except Exception as e:
+                logger.error("Error while archiving the timelapses: %s", e)
+            self.wake.wait(ARCHIVE_INTERVAL)
+            self.wake.clear()
+
+    def archive_pass(self):
+        """ Archives the timelapses due, unless another process is already archiving them """
+        with open(os.path.join(self.folders.target_timelapse_dir, ARCHIVE_LOCK), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            self.running = True
+            try:
+                for timelapse_date in self.due_timelapses():
+                    self.wait_turn()
+                    self.archive_timelapse(timelapse_date)
+            finally:
+                self.running = False
+                self.last_run = datetime.now().isoformat(timespec="seconds")
+
+    def due_timelapses(self) -> List[str]:
+        """ Gets the names of the finished timelapses older than archive_after_days and not archived yet """
+        with self.gallery.lock:
+            names = sorted(self.gallery.galleries)
+        try:
+            ongoing = self.ongoing_folders()
+        except Exception as e:
+            # Whether a timelapse is ongoing is unknown, archiving is postponed
+            logger.warning("Unable to get the ongoing timelapses: %s", e)
+            return []
+        oldest = time.time() - self.after_days * 86400
+        due = []
+        for timelapse_date in names:
+            if timelapse_date in ongoing:
+                continue
+            folder = os.path.join(self.folders.target_timelapse_dir, timelapse_date)
+            try:
+                if os.stat(folder).st_mtime > oldest:
+                    continue
+            except FileNotFoundError:
+                continue
+            if set(self.actions) - set(self.read_marker(folder).get("actions", [])):
+                if self.is_uploading(timelapse_date):
+                    continue
+                due.append(timelapse_date)
+        return due
+
+    def is_uploading(self, timelapse_date: str) -> bool:
+        """
+        Checks if files of a timelapse are still waiting to be uploaded, they mustn't be archived before
+        Arguments:
+        timelapse_date - the name of the timelapse
+        """
+        if self.pending_uploads is None:
+            return False
+        try:
+            pending = self.pending_uploads(timelapse_date)
+        except Exception as e:
+            # Whether its files are uploaded is unknown, archiving is postponed
+            logger.warning("Unable to get the pending uploads: %s", e)
+            return True
+        if pending > 0:
+            logger.info("Timelapse not archived yet, %d files waiting to be uploaded: %s", pending, timelapse_date)
+        return pending > 0
+
+    def wait_turn(self):
+        """ Waits until the scheduler lets the archiving go on, see ThermalScheduler """
+        if self.scheduler is not None:
+            self.scheduler.wait_turn("archive")
+
+    def read_marker(self, folder: str) -> Dict:
+        """
+        Reads the actions already applied to a timelapse.
+        Arguments:
+        folder - the photos folder of the timelapse
+        """
+        try:
+            with open(os.path.join(folder, ARCHIVE_MARKER)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def archive_timelapse(self, timelapse_date: str):
+        """
+        Applies the archive actions to a timelapse and updates the gallery.
+        Arguments:
+        timelapse_date - the name of the timelapse
+        """
+        folder = os.path.join(self.folders.target_timelapse_dir, timelapse_date)
+        marker = self.read_marker(folder)
+        size_before = folder_size(folder)
+        try:
+            for action in self.actions:
+                if action in marker.get("actions", []):
+                    continue
+                getattr(self, action)(folder)
+                marker.setdefault("actions", []).append(action)
+            self.archived_items += 1
+        except (OSError, zipfile.BadZipFile) as e:
+            # The actions applied are recorded, the other ones are retried on the next pass
+            self.failed_items += 1
+            logger.error("Error while archiving: %s - %s", folder, e)
+        reclaimed = size_before - folder_size(folder)
+        marker["reclaimed_bytes"] = marker.get("reclaimed_bytes", 0) + reclaimed
+        marker["archived_at"] = datetime.now().isoformat(timespec="seconds")
+        with open(os.path.join(folder, ARCHIVE_MARKER), "w") as f:
+            json.dump(marker, f, indent=4)
+        self.reclaimed_bytes += reclaimed
+        self.gallery.invalidate(timelapse_date)
+        logger.info("Timelapse archived: %s, %d KB reclaimed", timelapse_date, reclaimed // 1024)
+
+    def jpg_files(self, folder: str) -> List[str]:
+        """
+        Gets the JPEG files of a timelapse.
+        Arguments:
+        folder - the photos folder of the timelapse
+        """
+        with os.scandir(folder) as entries:
+            return sorted(entry.name for entry in entries if entry.name.endswith(".jpg") and entry.is_file())
+
+    def downscale(self, folder: str):
+        """
+        Downscales the JPEG files larger than archive_max_size, with their EXIF data.
+        Arguments:
+        folder - the photos folder of the timelapse
+        """
+        for name in self.jpg_files(folder):
+            self.wait_turn()
+            path = os.path.join(folder, name)
+            tmp_path = path + ".tmp"
+            with Image.open(path) as image:
+                if max(image.size) <= self.max_size:
+                    continue
+                exif = image.info.get("exif", b"")
+                image.thumbnail((self.max_size, self.max_size), Image.LANCZOS)
+                image.save(tmp_path, format="JPEG", quality=90, exif=exif)
+            if os.path.getsize(tmp_path) < os.path.getsize(path):
+                os.replace(tmp_path, path)
+            else:
+                os.remove(tmp_path)
+
+    def dng_only(self, folder: str):
+        """
+        Deletes the JPEG files which have a DNG file.
+        Arguments:
+        folder - the photos folder of the timelapse
+        """
+        for name in self.jpg_files(folder):
+            if os.path.exists(os.path.join(folder, name[:-4] + ".dng")):
+                os.remove(os.path.join(folder, name))
+
+    def pack(self, folder: str):
+        """
+        Packs the JPEG files into a single file, which the next packs append to. The files are only deleted once the
+        pack is written.
+        Arguments:
+        folder - the photos folder of the timelapse
+        """
+        names = self.jpg_files(folder)
+        if not names:
+            return
+        with zipfile.ZipFile(os.path.join(folder, PACK_NAME), "a", compression=zipfile.ZIP_STORED) as pack:
+            packed = set(pack.namelist())
+            for name in names:
+                if name not in packed:
+                    pack.write(os.path.join(folder, name), name)
+        for name in names:
+            os.remove(os.path.join(folder, name))
@@ -0,0 +1,152 @@
+import logging
+from multiprocessing.connection import Client
+import os
+import threading
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# The environment variable holding the key the web server processes authenticate with to the camera service
+AUTHKEY_VARIABLE = "LAPSILAPSE_CAMERA_AUTHKEY"
+
+
+class CameraError(Exception):
+    """ Raised when the camera can't run a command, e.g. when it's busy """
+
+
+class CameraClient:
+    """
+    Sends the commands of a web server process to the camera service process, see Cameras and CameraService.
+    Each thread has its own connection, so that a long-lived preview stream doesn't block the other requests.
+    A client sends the commands to a single camera, the clients of the other cameras share its connections.
+    """
+
+    def __init__(self, address: str, authkey: bytes = None, camera_num: int = 0, local: threading.local = None):
+        """
+        Arguments:
+        address - the socket the camera service listens on
+        authkey - the key to authenticate with, read from the environment by default
+        camera_num - the index of the camera the commands are sent to
+        local - optional, the connections of the threads, shared with another client
+        """
+        self.address = address
+        self.authkey = authkey if authkey is not None else os.environ.get(
+            AUTHKEY_VARIABLE, "").encode()
+        self.camera_num = camera_num
+        self.local = local if local is not None else threading.local()
+
+    def camera(self, camera_num: int = 0) -> "CameraClient":
+        """
+        Gets the client of a camera, see Cameras.camera
+        Arguments:
+        camera_num - the index of the camera
+        """
+        return CameraClient(self.address, self.authkey, camera_num, self.local)
+
+    def connection(self):
+        """ Gets the connection of the current thread, opened on first use """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            try:
+                connection = Client(self.address, family="AF_UNIX",
+                                    authkey=self.authkey)
+            except OSError as e:
+                raise CameraError(
+                    "The camera service isn't available: " + str(e))
+            self.local.connection = connection
+        return connection
+
+    def call(self, command: str, **arguments):
+        """
+        Runs a command in the camera service and waits for its result.
+        Arguments:
+        command - the name of the command, see CameraService.COMMANDS
+        arguments - the arguments of the command
+        Returns:
+        The result of the command.
+        """
+        connection = self.connection()
+        arguments["camera"] = self.camera_num
+        try:
+            connection.send((command, arguments))
+            success, result = connection.recv()
+        except (OSError, EOFError) as e:
+            # The service may have been restarted, the next call opens a new connection
+            connection.close()
+            self.local.connection = None
+            raise CameraError("Lost the connection to the camera service: " + str(e))
+        if not success:
+            raise CameraError(result)
+        return result
+
+    def shoot(self, iso: str, exposure_time: int, wb: str, file_format: str, bracket: List[float] = None) -> List[Dict]:
+        """ See CameraService.shoot """
+        return self.call("shoot", iso=iso, exposure_time=exposure_time, wb=wb, file_format=file_format, bracket=bracket)
+
+    def shot_status(self, names: List[str]) -> Dict[str, str]:
+        """ See CameraService.shot_status """
+        return self.call("shot_status", names=names)
+
+    def wait_shots(self, names: List[str], timeout: float = 60) -> Dict[str, str]:
+        """ See CameraService.wait_shots """
+        return self.call("wait_shots", names=names, timeout=timeout)
+
+    def start_timelapse(self, input: Dict) -> Dict:
+        """ See CameraService.start_timelapse """
+        return self.call("start_timelapse", input=input)
+
+    def stop_timelapse(self) -> bool:
+        """ See CameraService.stop_timelapse """
+        return self.call("stop_timelapse")
+
+    def is_timelapse_ongoing(self) -> bool:
+        """ See CameraService.is_timelapse_ongoing """
+        return self.call("is_timelapse_ongoing")
+
+    def timelapse_status(self, since: int = 0, thumbs_since: int = 0) -> Dict:
+        """ See CameraService.timelapse_status """
+        return self.call("timelapse_status", since=since, thumbs_since=thumbs_since)
+
+    def preview_frame(self, timeout: float = 5) -> bytes:
+        """ See CameraService.preview_frame """
+        return self.call("preview_frame", timeout=timeout)
+
+    def stop_preview(self):
+        """ See CameraService.stop_preview """
+        return self.call("stop_preview")
+
+    def calibrate_darks(self, isos: List[int], exposure_times: List[int], frames: int = None) -> Dict:
+        """ See CameraService.calibrate_darks """
+        return self.call("calibrate_darks", isos=isos, exposure_times=exposure_times, frames=frames)
+
+    def dark_frames_status(self) -> Dict:
+        """ See CameraService.dark_frames_status """
+        return self.call("dark_frames_status")
+
+    def list_cameras(self) -> List[Dict]:
+        """ See Cameras.list_cameras """
+        return self.call("list_cameras")
+
+    def timelapse_thumbnail(self, folder: str, name: str) -> bytes:
+        """ See Cameras.timelapse_thumbnail """
+        return self.call("timelapse_thumbnail", folder=folder, name=name)
+
+    def render_metrics(self) -> str:
+        """ See Cameras.render_metrics """
+        return self.call("render_metrics")
+
+    def scheduler_status(self) -> Dict:
+        """ See Cameras.scheduler_status """
+        return self.call("scheduler_status")
+
+    def pending_uploads(self, timelapse_date: str) -> int:
+        """ See Cameras.pending_uploads """
+        return self.call("pending_uploads", timelapse_date=timelapse_date)
+
+    def is_capturing(self) -> bool:
+        """ See Cameras.is_capturing """
+        return self.call("is_capturing")
+
+    def upload_status(self) -> Dict:
+        """ See Cameras.upload_status """
+        return self.call("upload_status")
@@ -0,0 +1,1256 @@
+import io
+import logging
+from multiprocessing.connection import Listener
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from threading import Condition
+from typing import Dict, List
+from PIL import Image
+from camera_client import AUTHKEY_VARIABLE, CameraError
+from dark_frames import DarkFrameLibrary, frame_temperature
+from dng_encoder import DngEncoder
+from frame_cache import FrameCache
+from image_worker import BRIGHTNESS_TIMEOUT, FrameJob, ImageWorker
+from log_setup import setup_logging
+from metrics import Metrics, render_metrics
+from preview_clip import PREVIEW_CLIP_NAME, PreviewClip
+from settings import Folders, Settings
+from scheduler import ThermalScheduler
+from settle import clamp_controls, controls_applied, wait_for_settle
+from stacking import FrameStacker
+from timelapse import Timelapse
+from timelapse_status import StatusPublisher
+from uploader import Uploader
+from utils import decimated_luma, get_day, get_day_and_time, get_awb_mode, generate_pretty_exposure_times, get_resident_memory, make_thumbnail, pretty_exposure_time, quick_preview
+
+logger = logging.getLogger(__name__)
+
+# The preview recording is stopped when no frame has been asked for during this time, in seconds
+PREVIEW_IDLE_TIMEOUT = 5
+# The maximum number of photos in a bracket or a burst
+MAX_BRACKET_FRAMES = 9
+# The maximum number of frames dropped while waiting for the exposure of a bracket or stacked photo to apply
+BRACKET_SETTLE_FRAMES = 8
+# The maximum time to wait for the last photos of a timelapse to be processed, in seconds
+TIMELAPSE_END_TIMEOUT = 30
+# The number of photos whose status is kept after they're saved, see CameraService.shot_status
+MAX_TRACKED_SHOTS = 100
+# The maximum width and height of the preview returned as soon as a photo is taken
+QUICK_PREVIEW_SIZE = 320
+
+
+def delete_file(path: str):
+    """
+    Deletes a file if it exists
+    Arguments:
+    path - the path of the file
+    """
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        logger.error("Error while deleting: " + path + " - " + str(e))
+
+
+def save_shot_files(array, jpg_path: str, thumbnail_path: str, keep_jpg: bool):
+    """
+    Saves the JPEG file and the thumbnail of a photo when there's no image worker - is meant to be ran in a thread
+    Arguments:
+    array - the copy of the frame
+    jpg_path - the path of the JPEG file
+    thumbnail_path - the path of the thumbnail
+    keep_jpg - False to only keep the thumbnail
+    """
+    Image.fromarray(array).save(jpg_path, quality=90)
+    make_thumbnail(jpg_path, thumbnail_path, 1000, 1000)
+    if not keep_jpg:
+        delete_file(jpg_path)
+
+
+class CameraBackend:
+    """
+    The camera classes of a backend, imported on first use:
+    - picamera2 - the Raspberry Pi cameras
+    - fake - simulated cameras, see FakeCamera, to run and test the app without cameras, Picamera2 or libcamera
+    The white balance names of the app are turned into the backend's controls by awb_mode.
+    """
+
+    BACKENDS = ("picamera2", "fake")
+
+    def __init__(self, name: str = "picamera2"):
+        """
+        Arguments:
+        name - the name of the backend
+        """
+        if name not in self.BACKENDS:
+            logger.warning("Unknown camera backend: " + str(name) + ", falling back to picamera2")
+            name = "picamera2"
+        self.name = name
+        if name == "fake":
+            from fake_camera import FakeCamera, FakeFileOutput, FakeJpegEncoder, FakeMappedArray, fake_awb_mode
+            self.camera_class = FakeCamera
+            self.awb_mode = fake_awb_mode
+            self.mapped_array = FakeMappedArray
+            self.jpeg_encoder = FakeJpegEncoder
+            self.file_output = FakeFileOutput
+            self.srgb = None
+        else:
+            import libcamera
+            from picamera2 import MappedArray, Picamera2
+            from picamera2.encoders import JpegEncoder
+            from picamera2.outputs import FileOutput
+            # Picamera2 logs each frame request at the INFO and DEBUG levels, only its errors go to the log files
+            Picamera2.set_logging(Picamera2.ERROR)
+            self.camera_class = Picamera2
+            self.awb_mode = get_awb_mode
+            self.mapped_array = MappedArray
+            self.jpeg_encoder = JpegEncoder
+            self.file_output = FileOutput
+            self.srgb = libcamera.ColorSpace.Srgb()
+
+
+class StreamingOutput(io.BufferedIOBase):
+    """ Used for camera streaming on the preview page """
+
+    def __init__(self):
+        self.frame = None
+        self.condition = Condition()
+
+    def write(self, buf):
+        with self.condition:
+            self.frame = buf
+            self.condition.notify_all()
+
+    def wait_for_frame(self, timeout: float):
+        """
+        Waits for the next frame
+        Arguments:
+        timeout - the maximum time to wait, in seconds
+        Returns:
+        The frame, or None if no frame came in time.
+        """
+        with self.condition:
+            if not self.condition.wait(timeout):
+                return None
+            return self.frame
+
+
+class PreviewStream:
+    """
+    Shares a single camera recording between all the viewers of the preview page.
+    The viewers may be in other processes, so the recording is stopped once no frame has been asked for a while.
+    """
+
+    def __init__(self, service: "CameraService"):
+        self.service = service
+        self.output = StreamingOutput()
+        self.is_recording = False
+        self.last_request = 0.0
+        threading.Thread(target=self.stop_when_idle, daemon=True).start()
+
+    def start(self) -> bool:
+        """
+        Starts the recording if it's not already started
+        Returns:
+        False if the camera is busy, e.g. with a timelapse.
+        """
+        self.last_request = time.monotonic()
+        if self.is_recording:
+            return True
+        if not self.service.camera_lock.acquire(blocking=False):
+            return False
+        try:
+            if not self.is_recording:
+                camera = self.service.camera
+                with self.service.metrics.span("stream_configure"):
+                    camera.configure(camera.create_video_configuration(
+                        main={"size": (1280, 960)}))
+                with self.service.metrics.span("stream_start"):
+                    backend = self.service.backend
+                    camera.start_recording(
+                        backend.jpeg_encoder(), backend.file_output(self.output))
+                self.is_recording = True
+        finally:
+            self.service.camera_lock.release()
+        return True
+
+    def stop(self):
+        """ Stops the recording - the camera lock must be held """
+        if self.is_recording:
+            self.service.camera.stop_recording()
+            self.is_recording = False
+
+    def stop_when_idle(self):
+        """ Stops the recording once the viewers are gone - is meant to be ran in a thread """
+        while True:
+            time.sleep(1)
+            if not self.is_recording or time.monotonic() - self.last_request < PREVIEW_IDLE_TIMEOUT:
+                continue
+            if self.service.camera_lock.acquire(blocking=False):
+                try:
+                    self.stop()
+                finally:
+                    self.service.camera_lock.release()
+
+
+class CameraService:
+    """
+    Owns a camera: takes the photos, runs the timelapses and streams the preview.
+    Each camera of the Pi has its own service, see Cameras, with its own timelapse and capture thread.
+    """
+
+    # The commands that can be sent by a CameraClient to a camera
+    COMMANDS = ("shoot", "shot_status", "wait_shots", "start_timelapse", "stop_timelapse", "is_timelapse_ongoing",
+                "timelapse_status", "preview_frame", "stop_preview", "calibrate_darks", "dark_frames_status")
+
+    def __init__(self, settings: Settings, folders: Folders, metrics: Metrics = None, camera_num: int = 0,
+                 backend: CameraBackend = None, dng_encoder: DngEncoder = None, image_worker: ImageWorker = None,
+                 uploader: Uploader = None, scheduler: ThermalScheduler = None, frame_cache: FrameCache = None):
+        """
+        Arguments:
+        settings - the settings
+        folders - the folders the photos and timelapses are saved in
+        metrics - optional, the metrics to time the capture hot path with
+        camera_num - the index of the camera
+        backend - optional, the camera backend, read from the settings by default
+        dng_encoder - optional, the DNG encoder shared with the other cameras
+        image_worker - optional, the image worker shared with the other cameras
+        uploader - optional, replicates the timelapse files once they're written
+        scheduler - optional, the scheduler of the background work shared with the other cameras
+        frame_cache - optional, keeps the thumbnails of the timelapses in memory, shared with the other cameras
+        """
+        self.settings = settings
+        self.folders = folders
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.camera_num = camera_num
+        # Appended to the names of the photos and timelapses of the other cameras than the first one
+        self.name_suffix = "" if camera_num == 0 else "_cam" + str(camera_num)
+        self.backend = backend if backend is not None else CameraBackend(
+            settings.camera_backend)
+        # Opened on first use, see the camera property
+        self.picamera2 = None
+        self.open_lock = threading.Lock()
+        self.pretty_exposure_times_list = generate_pretty_exposure_times()
+        self.frame_stacker = FrameStacker()
+        if dng_encoder is None:
+            dng_encoder = DngEncoder(settings.dng_mode, settings.dng_workers)
+            self.metrics.register("dng_encoder_pending", "gauge", "DNG files waiting to be encoded.",
+                                  lambda: self.dng_encoder.pending)
+        self.dng_encoder = dng_encoder
+        if image_worker is None and settings.image_workers > 0:
+            image_worker = ImageWorker(settings.image_workers)
+            self.metrics.register("image_worker_pending", "gauge", "Frames waiting to be processed by the image worker.",
+                                  lambda: len(self.image_worker.pending))
+        self.image_worker = image_worker
+        self.uploader = uploader
+        if frame_cache is None:
+            frame_cache = FrameCache(settings.frame_cache_size * 1024 * 1024)
+            frame_cache.register_metrics(self.metrics)
+        self.frame_cache = frame_cache
+        # The background work holds back while the timelapse photos are taken
+        self.scheduler = scheduler if scheduler is not None else ThermalScheduler(
+            settings.thermal_soft_temp, settings.thermal_hard_temp, settings.thermal_max_load)
+        self.is_timelapse_ongoing_flag = False
+        # Set to stop the ongoing timelapse, wakes it up from its sleep between two photos
+        self.timelapse_stop = threading.Event()
+        self.timelapse: Timelapse = None
+        self.timelapse_thread: threading.Thread = None
+        # Held while the camera is being used, e.g. during a whole timelapse
+        self.camera_lock = threading.Lock()
+        # Makes starting a timelapse atomic when several requests come at once
+        self.timelapse_lock = threading.Lock()
+        self.preview_stream = PreviewStream(self)
+        # Receives the thumbnails of the ongoing timelapse
+        self.timelapse_output = StreamingOutput()
+        # The snapshot of the ongoing timelapse read by the requests, published by the capture thread
+        self.status = StatusPublisher()
+        # The preview clip of the ongoing timelapse, and the name of its folder
+        self.preview_clip: PreviewClip = None
+        self.timelapse_folder: str = None
+        # The exposure the last timelapse photo was taken with, the next photo's is checked when it changes
+        self.capture_controls: Dict = None
+        # The status of the last photos shot, processing until their files are saved, see shot_status
+        self.shot_states: "OrderedDict[str, str]" = OrderedDict()
+        self.shot_condition = Condition()
+        # Saves the photos shot when there's no image worker, created on first use
+        self.shot_saver: ThreadPoolExecutor = None
+        # The spool files of the photos being shot, converted once the camera is released
+        self.shot_spool_paths: List[str] = []
+        # The master dark frames of the camera, and the progress of their calibration, see calibrate_darks
+        self.dark_frames = DarkFrameLibrary(os.path.join(
+            folders.dark_frames_dir, "cam" + str(camera_num)), settings.dark_temp_band)
+        self.dark_calibration = {"running": False, "done": 0, "total": 0, "error": None}
+
+    @property
+    def camera(self):
+        """ The camera, opened on first use so that the server starts without waiting for it """
+        if self.picamera2 is None:
+            with self.open_lock:
+                if self.picamera2 is None:
+                    with self.metrics.phase("open_camera"):
+                        self.picamera2 = self.backend.camera_class(
+                            self.camera_num)
+        return self.picamera2
+
+    def close(self):
+        """ Closes the camera if it has been opened """
+        if self.picamera2 is not None:
+            self.picamera2.close()
+
+    def preview_frame(self, timeout: float = 5) -> bytes:
+        """
+        Waits for the next frame to stream. All the viewers share the same recording.
+        While a timelapse is ongoing, its latest thumbnail is streamed instead of the live view.
+        Arguments:
+        timeout - the maximum time to wait, in seconds
+        Returns:
+        The frame as a JPEG, or None if no frame came in time.
+        """
+        if self.status.current.is_ongoing:
+            return self.timelapse_output.wait_for_frame(timeout)
+        if self.preview_stream.start():
+            with self.metrics.span("stream_frame"):
+                return self.preview_stream.output.wait_for_frame(timeout)
+        time.sleep(min(1, timeout))
+        return None
+
+    def stop_preview(self):
+        """ Stops the preview, e.g. when the shoot page is displayed, unless the camera is busy """
+        if self.camera_lock.acquire(blocking=False):
+            try:
+                self.preview_stream.stop()
+                if self.picamera2 is not None:
+                    self.picamera2.stop()
+            finally:
+                self.camera_lock.release()
+
+    def shoot(self, iso: str, exposure_time: int, wb: str, file_format: str, bracket: List[float] = None) -> List[Dict]:
+        """
+        Takes a photo, or a bracket of photos in a single camera session. Returns once the photos are captured, their
+        files are saved in the background, see shot_status.
+        Arguments:
+        iso - the ISO to set, or Auto
+        exposure_time - the exposure time to set in ms, or -1 for auto
+        wb - the white balance to set
+        file_format - the file format to save the photo in
+        bracket - optional, the EV offsets of the photos of a bracket, e.g. [-2, 0, 2], or [0, 0, 0] for a burst
+        Returns:
+        The photos' data with a low resolution preview, see the shoot page.
+        """
+        # The shoot page sends the exposure time as a string
+        exposure_time = int(exposure_time)
+        bracket = [float(ev) for ev in bracket][:MAX_BRACKET_FRAMES] if bracket else []
+        if not self.camera_lock.acquire(blocking=False):
+            raise CameraError("The camera is busy.")
+        try:
+            camera = self.camera
+            metrics = self.metrics
+            self.preview_stream.stop()
+            capture_config = camera.create_still_configuration(
+                raw={}, display=None, colour_space=self.backend.srgb)
+            controls = {}
+            if iso != "Auto":
+                controls["AnalogueGain"] = int(iso) / 100
+            if exposure_time != -1:
+                controls["ExposureTime"] = exposure_time
+            if wb != "auto":
+                controls["AwbMode"] = self.backend.awb_mode(wb)
+            if controls:
+                camera.set_controls(controls)
+            with metrics.span("shoot_camera_start"):
+                camera.start()
+            with metrics.span("shoot_settle"):
+                wait_for_settle(camera, controls)
+            day = get_day()
+            day_and_time = get_day_and_time() + self.name_suffix
+            if len(bracket) > 1:
+                shots = self.take_bracket(
+                    capture_config, bracket, iso, exposure_time, day_and_time, file_format)
+            else:
+                with metrics.span("shoot_capture"):
+                    r = camera.switch_mode_capture_request_and_stop(
+                        capture_config)
+                shot = self.save_shot(r, day_and_time, file_format)
+                shot["iso"] = iso
+                shot["speed"] = exposure_time
+                shot["exposureTime"] = self.pretty_exposure_times_list[exposure_time]
+                shots = [shot]
+        except RuntimeError as e:
+            logger.warning(str(e))
+            raise CameraError("Error while taking the photo.")
+        finally:
+            spool_paths = self.shot_spool_paths
+            self.shot_spool_paths = []
+            self.camera_lock.release()
+            if spool_paths:
+                # Only the spool files of these photos, converted in turn with the other background work
+                self.dng_encoder.convert_spool_files(spool_paths)
+        for shot in shots:
+            shot["day"] = day
+            shot["wb"] = wb.capitalize()
+        return shots
+
+    def take_bracket(self, capture_config: Dict, bracket: List[float], iso: str, exposure_time: int, day_and_time: str, file_format: str):
+        """
+        Takes the photos of a bracket in a single camera session, the camera must be started.
+        The photos are handed to the workers as they come, so that the bracket takes about the sum of its exposures.
+        Arguments:
+        capture_config - the capture configuration for the camera
+        bracket - the EV offsets of the photos
+        iso - the ISO set, or Auto to start from the ISO chosen by the camera
+        exposure_time - the exposure time set in ms, or -1 to start from the exposure time chosen by the camera
+        day_and_time - the date and time of the bracket, the photos are numbered after it
+        file_format - the file format to save the photos in
+        Returns:
+        The photos' data.
+        """
+        camera = self.camera
+        metrics = self.metrics
+        metadata = camera.capture_metadata()
+        base_exposure_time = metadata["ExposureTime"] if exposure_time == -1 else exposure_time
+        gain = int(iso) / 100 if iso != "Auto" else metadata["AnalogueGain"]
+        shots = []
+        camera.switch_mode(capture_config)
+        try:
+            for i, ev in enumerate(bracket):
+                target_exposure_time = max(1, int(base_exposure_time * 2 ** ev))
+                with metrics.span("shoot_bracket_frame"):
+                    r = self.capture_with_exposure(target_exposure_time, gain)
+                try:
+                    shot = self.save_shot(
+                        r, day_and_time + "_" + str(i + 1), file_format)
+                    actual = r.get_metadata()
+                finally:
+                    r.release()
+                shot["iso"] = str(round(actual.get("AnalogueGain", gain) * 100))
+                shot["speed"] = actual.get("ExposureTime", target_exposure_time)
+                shot["exposureTime"] = pretty_exposure_time(shot["speed"])
+                shot["ev"] = ev
+                shots.append(shot)
+        finally:
+            camera.stop()
+            # Gives the exposure back to the camera for the next photos
+            camera.set_controls({"AeEnable": True})
+        return shots
+
+    def capture_with_exposure(self, exposure_time: int, gain: float):
+        """
+        Sets the exposure and captures the first request it applies to. The controls take effect a few frames later,
+        the frames captured before are dropped.
+        Arguments:
+        exposure_time - the exposure time in ms
+        gain - the analogue gain
+        Returns:
+        The request, to be released by the caller.
+        """
+        camera = self.camera
+        controls = {"AeEnable": False,
+                    "ExposureTime": exposure_time, "AnalogueGain": gain}
+        camera.set_controls(controls)
+        for _ in range(BRACKET_SETTLE_FRAMES):
+            r = camera.capture_request()
+            if controls_applied(r.get_metadata(), controls, 0.1):
+                return r
+            r.release()
+        logger.warning("Exposure time " + str(exposure_time) +
+                       " not reached, the sensor may not allow it")
+        return camera.capture_request()
+
+    def save_shot(self, r, name: str, file_format: str):
+        """
+        Starts saving a photo in the background, with the image worker when there's one, see shot_status.
+        Arguments:
+        r - the captured request, it can be released once this returns
+        name - the name of the photo
+        file_format - the file format to save the photo in
+        Returns:
+        The photo's data, with a low resolution preview of the photo.
+        """
+        metrics = self.metrics
+        pending = []
+        jpg_path = name + ".jpg"
+        jpg_full_path = os.path.join(self.folders.target_photos_dir, jpg_path)
+        thumbnail_full_path = os.path.join(self.folders.thumbnails_dir, jpg_path)
+        if self.image_worker is not None:
+            with metrics.span("shoot_submit_frame"):
+                with self.backend.mapped_array(r, "main", write=False) as mapped:
+                    preview = quick_preview(mapped.array, QUICK_PREVIEW_SIZE)
+                    job = self.image_worker.submit(
+                        mapped.array, jpg_full_path if "jpg" in file_format else None, thumbnail_full_path, 1000,
+                        self.camera_num)
+            pending.append(job.done)
+        else:
+            with metrics.span("shoot_copy_frame"):
+                array = r.make_array("main")
+                preview = quick_preview(array, QUICK_PREVIEW_SIZE)
+            if self.shot_saver is None:
+                self.shot_saver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shot-saver")
+            pending.append(self.shot_saver.submit(save_shot_files, array, jpg_full_path, thumbnail_full_path,
+                                                  "jpg" in file_format))
+        dng_path = None
+        if "dng" in file_format:
+            dng_path = name + ".dng"
+            with metrics.span("shoot_save_dng"):
+                dng_saved = self.dng_encoder.save(r, os.path.join(
+                    self.folders.target_photos_dir, dng_path))
+            pending.append(dng_saved)
+            if self.dng_encoder.mode == "spool":
+                # The spool file is written, it's converted once the camera is released, see shoot
+                self.shot_spool_paths.append(dng_saved.result())
+        self.track_shot(name, pending)
+        return {
+            "fileName": name,
+            "jpgPath": jpg_path,
+            "thumbPath": jpg_path,
+            "dngPath": dng_path,
+            "preview": preview,
+            "status": "processing",
+        }
+
+    def track_shot(self, name: str, pending: List[Future]):
+        """
+        Follows the saving of a photo, see shot_status.
+        Arguments:
+        name - the name of the photo
+        pending - the futures done once the files of the photo are saved
+        """
+        remaining = [len(pending)]
+
+        def on_done(future: Future):
+            with self.shot_condition:
+                if future.exception() is not None:
+                    logger.error("Error while saving the photo " + name + ": " + str(future.exception()))
+                    self.shot_states[name] = "failed"
+                remaining[0] -= 1
+                if remaining[0] == 0 and self.shot_states.get(name) == "processing":
+                    self.shot_states[name] = "done"
+                self.shot_condition.notify_all()
+
+        with self.shot_condition:
+            self.shot_states[name] = "processing" if pending else "done"
+            while len(self.shot_states) > MAX_TRACKED_SHOTS:
+                self.shot_states.popitem(last=False)
+        for future in pending:
+            future.add_done_callback(on_done)
+
+    def shot_status(self, names: List[str]) -> Dict[str, str]:
+        """
+        Gets the status of photos shot: processing while their files are being saved, then done or failed.
+        Arguments:
+        names - the names of the photos
+        Returns:
+        The status of each photo, unknown for the photos shot too long ago.
+        """
+        with self.shot_condition:
+            return {name: self.shot_states.get(name, "unknown") for name in names}
+
+    def wait_shots(self, names: List[str], timeout: float = 60) -> Dict[str, str]:
+        """
+        Waits until the files of photos shot are saved.
+        Arguments:
+        names - the names of the photos
+        timeout - the maximum time to wait (s)
+        Returns:
+        The status of each photo, see shot_status.
+        """
+        with self.shot_condition:
+            self.shot_condition.wait_for(lambda: all(self.shot_states.get(name) != "processing" for name in names),
+                                         timeout)
+        return self.shot_status(names)
+
+    def is_timelapse_ongoing(self) -> bool:
+        """ Checks if the timelapse is still ongoing """
+        return self.status.current.is_ongoing
+
+    def stop_timelapse(self) -> bool:
+        """
+        Stops the ongoing timelapse, the current photo is finished first. The timelapse is reported as ongoing until
+        its last photos are processed, see run_timelapse_safely.
+        Returns:
+        False, no more photos are taken.
+        """
+        self.is_timelapse_ongoing_flag = False
+        self.timelapse_stop.set()
+        return self.is_timelapse_ongoing_flag
+
+    def timelapse_status(self, since: int = 0, thumbs_since: int = 0) -> Dict:
+        """
+        Gets the stats of the ongoing timelapse from the last published snapshot, see TimelapseStatus
+        Arguments:
+        since - only the photos taken after this photo number are returned
+        thumbs_since - only the thumbnails made after this photo number are returned
+        """
+        return self.status.current.to_dict(since, thumbs_since)
+
+    def start_timelapse(self, input: Dict) -> Dict:
+        """
+        Starts the timelapse in a dedicated thread
+        Arguments:
+        input - the parameters of the timelapse - see the Timelapse class
+        """
+        to_return = {}
+        to_return["started"] = False
+        with self.timelapse_lock:
+            if self.is_timelapse_ongoing_flag:
+                return to_return
+            if self.timelapse_thread is not None and self.timelapse_thread.is_alive():
+                to_return["error"] = "The previous timelapse is still finishing."
+                return to_return
+            if self.dark_calibration["running"]:
+                to_return["error"] = "The dark frames are being calibrated."
+                return to_return
+            if int(input.get("stack_frames", 1)) > 1 and "jpg" not in input.get("file_format", ""):
+                # The frames are stacked after the ISP, there's no raw stack to save as DNG
+                to_return["error"] = "Stacked photos are only saved as JPEG, choose the JPG format."
+                return to_return
+            if int(input.get("stack_frames", 1)) > 1 and "dng" in input.get("file_format", ""):
+                logger.warning("Stacked photos are only saved as JPEG, no DNG files are written")
+                to_return["warning"] = "Stacked photos are only saved as JPEG, no DNG files are written."
+            self.timelapse = None
+            self.is_timelapse_ongoing_flag = True
+            self.timelapse_stop.clear()
+            self.status.start()
+            self.timelapse_thread = threading.Thread(target=self.run_timelapse_safely,
+                                                     args=(input,), daemon=True)
+            self.timelapse_thread.start()
+            to_return["started"] = True
+        return to_return
+
+    def run_timelapse_safely(self, input: Dict):
+        """
+        Runs the timelapse and makes sure it's flagged as finished, even on errors - is meant to be ran in a thread
+        Arguments:
+        input - the parameters of the timelapse - see the Timelapse class
+        """
+        try:
+            self.run_timelapse(input)
+        except Exception as e:
+            logger.error("Timelapse stopped on error: " + str(e))
+        finally:
+            self.is_timelapse_ongoing_flag = False
+            self.status.publish(is_ongoing=False)
+
+    def run_timelapse(self, input: Dict):
+        """
+        Runs the timelapse - is meant to be ran in a thread
+        Arguments:
+        input - the parameters of the timelapse - see the Timelapse class
+        """
+        logger.info("Start timelapse")
+        camera = self.camera
+        metrics = self.metrics
+        date_and_time = get_day_and_time() + self.name_suffix
+        static_working_dir = os.path.join(
+            self.folders.static_timelapse_dir, date_and_time)
+        os.makedirs(static_working_dir, exist_ok=True)
+        tmp_dir = os.path.join(static_working_dir, "tmp")
+        logger.info("Thumbnails folder: %s", tmp_dir)
+        os.makedirs(tmp_dir, exist_ok=True)
+        target_working_dir = os.path.join(
+            self.folders.target_timelapse_dir, date_and_time)
+        os.makedirs(target_working_dir, exist_ok=True)
+
+        timelapse = Timelapse(input, thumbnail_dir=tmp_dir,
+                              records_path=os.path.join(target_working_dir, "frames.csv"))
+        self.preview_clip = PreviewClip(
+            os.path.join(static_working_dir, PREVIEW_CLIP_NAME))
+        self.timelapse_folder = date_and_time
+        self.timelapse = timelapse
+        self.status.publish(folder=date_and_time, photos_to_take=timelapse.photos_to_take, iso=timelapse.iso,
+                            exposure_time=timelapse.exposure_time)
+
+        with self.camera_lock:
+            self.preview_stream.stop()
+            preview_config = camera.create_preview_configuration()
+            capture_config = camera.create_still_configuration(
+                raw={"size": camera.sensor_resolution})
+            camera.stop()
+            camera.configure(preview_config)
+            controls = {"AnalogueGain": timelapse.iso / 100,
+                        "ExposureTime": timelapse.exposure_time, "AwbMode": self.backend.awb_mode(timelapse.wb)}
+            camera.set_controls(controls)
+            camera.start()
+            with metrics.span("settle"):
+                # The preview can't apply the long exposures, they're checked on each photo instead
+                wait_for_settle(camera, clamp_controls(controls, preview_config))
+            self.capture_controls = None
+            reference_path = os.path.join(tmp_dir, "ref.jpg")
+            metrics.start_recording(os.path.join(
+                target_working_dir, "timings.csv"))
+            while self.is_timelapse_ongoing_flag and timelapse.is_ongoing():
+                with metrics.span("photo", timelapse.photos_taken + 1), self.scheduler.capture():
+                    self.take_timelapse_photo(capture_config, reference_path,
+                                              target_working_dir, tmp_dir)
+                sleep_time = timelapse.get_sleep_time()
+                logger.info("Sleeping for: %s", sleep_time)
+                self.scheduler.expect_capture(self.camera_num, sleep_time)
+                with metrics.span("sleep", timelapse.photos_taken):
+                    self.timelapse_stop.wait(sleep_time)
+            self.scheduler.expect_capture(self.camera_num, None)
+            camera.stop()
+            metrics.stop_recording()
+            timelapse.records.close()
+        if self.uploader is not None:
+            self.uploader.enqueue(os.path.join(target_working_dir, "frames.csv"))
+        if self.dng_encoder.mode == "spool":
+            self.dng_encoder.convert_spool(target_working_dir)
+        if self.image_worker is not None:
+            # The last thumbnails are made before the timelapse is flagged as finished
+            self.image_worker.wait_until_idle(
+                TIMELAPSE_END_TIMEOUT, self.camera_num)
+        self.preview_clip.close()
+        if os.path.exists(reference_path):
+            os.remove(reference_path)
+        logger.info("Timelapse finished")
+
+    def take_timelapse_photo(self, capture_config: Dict, reference_path: str, working_dir: str, tmp_dir: str):
+        """
+        Takes a photo for the ongoin timelapse
+        Arguments:
+        capture_config (Dict) - the capture configuration for the camera
+        reference_path (str) - the path to the reference file for brightness calculation
+        working_dir (str) - the path to the working directory
+        tmp_dir (str) - the path to the tmp directory
+        """
+        camera = self.camera
+        metrics = self.metrics
+        timelapse = self.timelapse
+        photo_number = timelapse.photos_taken + 1
+        controls = {"AnalogueGain": timelapse.iso / 100, "ExposureTime": timelapse.exposure_time}
+        # Only checked when the exposure changed, the frames of an unchanged exposure have it already
+        changed_controls = controls if controls != self.capture_controls else None
+        with metrics.span("camera_stop", photo_number):
+            camera.stop()
+        with metrics.span("set_controls", photo_number):
+            camera.set_controls({"AnalogueGain": timelapse.iso / 100})
+            camera.set_controls({"ExposureTime": timelapse.exposure_time})
+        with metrics.span("camera_start", photo_number):
+            camera.start()
+        timelapse.photos_taken = photo_number
+        self.capture_controls = controls
+        logger.info("==================== Taking photo: %d/%d", timelapse.photos_taken, timelapse.photos_to_take)
+        capture_timestamp = time.time()
+        filename = timelapse.get_file_name(capture_timestamp)
+        jpg_path = os.path.join(working_dir, filename + ".jpg")
+        thumbnail_path = os.path.join(tmp_dir, filename + ".jpg")
+        # Stacked photos only exist as JPEG
+        keep_jpg = "jpg" in timelapse.file_format or timelapse.stack_frames > 1
+        stack_time = None
+        job = None
+        # A near-duplicate skipped in the adaptive interval mode has no file, nor thumbnail
+        skip = False
+        if timelapse.stack_frames > 1:
+            with metrics.span("capture_stack", photo_number):
+                stacked_frame, stack_time = self.take_stacked_photo(
+                    capture_config, changed_controls)
+            metrics.observe("stack_frame", stack_time / 1000, photo_number)
+            logger.info("Stacked %d frames, %.1f ms per frame", timelapse.stack_frames, stack_time)
+            master = self.find_dark_master(None)
+            if master is not None:
+                with metrics.span("dark_subtract", photo_number):
+                    stacked_frame = self.dark_frames.subtract(stacked_frame, master)
+            if timelapse.adaptive_interval is not None:
+                with metrics.span("scene_change", photo_number):
+                    skip = timelapse.check_scene_change(
+                        decimated_luma(stacked_frame))
+                keep_jpg = not skip
+            if self.image_worker is not None:
+                with metrics.span("submit_frame", photo_number):
+                    job = self.image_worker.submit(
+                        stacked_frame, jpg_path if keep_jpg else None, None if skip else thumbnail_path, 400,
+                        self.camera_num, timelapse.meter)
+            else:
+                stacked_image = Image.fromarray(stacked_frame)
+                with metrics.span("save_jpg", photo_number):
+                    stacked_image.save(
+                        jpg_path if keep_jpg else reference_path, quality=90)
+                with metrics.span("brightness", photo_number):
+                    photo_brightness = timelapse.meter.brightness(
+                        stacked_frame)
+        else:
+            with metrics.span("capture", photo_number):
+                r = camera.switch_mode_capture_request_and_stop(capture_config)
+                if changed_controls is not None and not controls_applied(r.get_metadata(), changed_controls, 0.1):
+                    logger.warning("The exposure wasn't applied to the photo, taking it again")
+                    r.release()
+                    camera.start()
+                    r = camera.switch_mode_capture_request_and_stop(capture_config)
+                    if not controls_applied(r.get_metadata(), changed_controls, 0.1):
+                        logger.warning("The exposure still isn't applied, requested: %s, applied: %s", changed_controls,
+                                       {control: r.get_metadata().get(control) for control in changed_controls})
+            # The frame with the master dark frame subtracted, None when there's no master for this exposure
+            corrected = None
+            master = self.find_dark_master(r.get_metadata())
+            if master is not None:
+                with metrics.span("dark_subtract", photo_number):
+                    with self.backend.mapped_array(r, "main", write=False) as mapped:
+                        corrected = self.dark_frames.subtract(mapped.array, master)
+            if timelapse.adaptive_interval is not None:
+                # Decided before anything is written, so that a skipped photo costs no storage
+                with metrics.span("scene_change", photo_number):
+                    with self.backend.mapped_array(r, "main", write=False) as mapped:
+                        skip = timelapse.check_scene_change(
+                            decimated_luma(mapped.array))
+                keep_jpg = keep_jpg and not skip
+            if "dng" in timelapse.file_format and not skip:
+                dng_path = os.path.join(working_dir, filename + ".dng")
+                with metrics.span("save_dng", photo_number):
+                    dng_saved = self.dng_encoder.save(r, dng_path)
+                if self.uploader is not None:
+                    dng_saved.add_done_callback(
+                        lambda done: done.exception() is None and self.uploader.enqueue(dng_path))
+            if self.image_worker is not None:
+                with metrics.span("submit_frame", photo_number):
+                    with self.backend.mapped_array(r, "main", write=False) as mapped:
+                        job = self.image_worker.submit(
+                            mapped.array if corrected is None else corrected, jpg_path if keep_jpg else None,
+                            None if skip else thumbnail_path, 400, self.camera_num, timelapse.meter)
+            elif corrected is not None:
+                corrected_image = Image.fromarray(corrected)
+                with metrics.span("save_jpg", photo_number):
+                    corrected_image.save(reference_path, quality=90)
+                    if not skip:
+                        corrected_image.save(jpg_path, quality=90)
+                with metrics.span("brightness", photo_number):
+                    photo_brightness = timelapse.meter.brightness(corrected)
+            else:
+                with metrics.span("save_jpg", photo_number):
+                    r.save("main", reference_path)
+                    if not skip:
+                        r.save("main", jpg_path)
+                with metrics.span("brightness", photo_number):
+                    with self.backend.mapped_array(r, "main", write=False) as mapped:
+                        photo_brightness = timelapse.meter.brightness(
+                            mapped.array)
+        if job is not None:
+            with metrics.span("wait_brightness", photo_number):
+                photo_brightness = self.wait_brightness(job)
+        timelapse.add_photo(capture_timestamp, photo_brightness, stack_time)
+        with metrics.span("update_settings", photo_number):
+            timelapse.update_settings(photo_brightness)
+            timelapse.apply_plan()
+        self.status.add_photo(timelapse.records,
+                              timelapse.iso, timelapse.exposure_time)
+
+        def on_photo_processed():
+            """ Adds the thumbnail to the timelapse and to its preview clip once it's been made """
+            timelapse.add_thumbnail(photo_number)
+            if skip:
+                # Only flagged as processed, so that the thumbnails of the next photos are published
+                self.status.add_thumbnails(timelapse.records, len(self.preview_clip))
+                return
+            with open(thumbnail_path, "rb") as f:
+                thumbnail = f.read()
+            self.frame_cache.put(thumbnail_path, thumbnail)
+            self.timelapse_output.write(thumbnail)
+            self.preview_clip.append(thumbnail)
+            if self.uploader is not None and keep_jpg:
+                self.uploader.enqueue(jpg_path)
+            self.status.add_thumbnails(
+                timelapse.records, len(self.preview_clip))
+
+        def on_frame_processed(done: Future):
+            """ Records the time the worker spent on each stage """
+            if done.exception() is not None:
+                return
+            for stage, seconds in done.result().items():
+                metrics.observe("worker_" + stage, seconds, photo_number)
+            on_photo_processed()
+
+        if job is not None:
+            job.done.add_done_callback(on_frame_processed)
+        else:
+            if not skip:
+                with metrics.span("make_thumbnail", photo_number):
+                    make_thumbnail(jpg_path if os.path.exists(jpg_path) else reference_path,
+                                   thumbnail_path, 400, 400)
+            if not keep_jpg:
+                delete_file(jpg_path)
+            on_photo_processed()
+        metrics.flush_recording()
+
+    def wait_brightness(self, job: FrameJob) -> float:
+        """
+        Waits for the brightness of a timelapse photo measured by the image worker. If it doesn't come in time the
+        workers are restarted, and the brightness is measured here, or the previous photo's is reused.
+        Arguments:
+        job - the photo's job
+        Returns:
+        The brightness of the photo.
+        """
+        timelapse = self.timelapse
+        try:
+            return job.brightness.result(timeout=BRIGHTNESS_TIMEOUT)
+        except FutureTimeoutError:
+            logger.warning("No brightness from the image worker after %ds", BRIGHTNESS_TIMEOUT)
+            timed_out = True
+        except RuntimeError as e:
+            logger.warning("No brightness from the image worker: %s", e)
+            timed_out = False
+        try:
+            # The frame is still in shared memory until the workers are restarted
+            array = job.frame.array()
+            photo_brightness = timelapse.meter.brightness(array[..., :3] if array.shape[-1] == 4 else array)
+            del array
+        except (OSError, ValueError) as e:
+            logger.warning("Unable to measure the brightness, the previous one is reused: %s", e)
+            records = timelapse.records
+            photo_brightness = records.brightnesses[-1] if len(records.brightnesses) > 0 else \
+                timelapse.reference_brightness
+        if timed_out:
+            self.image_worker.restart()
+        return photo_brightness
+
+    def take_stacked_photo(self, capture_config: Dict, changed_controls: Dict = None):
+        """
+        Takes the frames of a stacked timelapse photo in a single camera session and stacks them as they come.
+        Only the main stream is stacked, stacked photos are saved as JPEG.
+        Arguments:
+        capture_config (Dict) - the capture configuration for the camera
+        changed_controls (Dict) - optional, the exposure just requested, the frames taken before it applies are dropped
+        Returns:
+        The stacked photo as an RGB array and the mean time it took to stack a frame, in ms.
+        """
+        camera = self.camera
+        camera.switch_mode(capture_config)
+        self.frame_stacker.reset(self.timelapse.stack_mode)
+        stacked = 0
+        dropped = 0
+        while stacked < self.timelapse.stack_frames:
+            r = camera.capture_request()
+            try:
+                if changed_controls is not None and not controls_applied(r.get_metadata(), changed_controls, 0.1):
+                    dropped += 1
+                    if dropped < BRACKET_SETTLE_FRAMES:
+                        continue
+                    logger.warning("The exposure wasn't applied to the frames, requested: %s", changed_controls)
+                changed_controls = None
+                with self.backend.mapped_array(r, "main", write=False) as mapped:
+                    self.frame_stacker.add(mapped.array)
+                stacked += 1
+            finally:
+                r.release()
+        camera.stop()
+        return self.frame_stacker.result(), self.frame_stacker.mean_stack_time()
+
+    def find_dark_master(self, metadata: Dict):
+        """
+        Gets the master dark frame matching the settings of the ongoing timelapse, see DarkFrameLibrary
+        Arguments:
+        metadata - the metadata of the frame, None for a stacked photo
+        Returns:
+        The master dark frame, None if the exposure is too short to need one or there's none for these settings.
+        """
+        timelapse = self.timelapse
+        if timelapse.exposure_time < self.settings.dark_frame_min_exposure:
+            return None
+        return self.dark_frames.find(timelapse.exposure_time, timelapse.iso / 100, frame_temperature(metadata))
+
+    def calibrate_darks(self, isos: List[int], exposure_times: List[int], frames: int = None) -> Dict:
+        """
+        Takes the master dark frames of the camera in a dedicated thread, one for each ISO and exposure time. The lens
+        must be covered. The temperature band is the one the dark frames are taken at, so calibrating again once the
+        camera has cooled down, e.g. later in the night, adds the masters of the colder band.
+        Arguments:
+        isos - the ISOs to calibrate, e.g. the ones a night timelapse goes through
+        exposure_times - the exposure times to calibrate, in ms
+        frames - optional, the number of dark frames averaged into each master, see the dark_frame_count setting
+        """
+        to_return = {"started": False}
+        frames = int(frames) if frames else self.settings.dark_frame_count
+        pairs = [(int(iso), int(exposure_time)) for iso in isos for exposure_time in exposure_times]
+        if not pairs:
+            to_return["error"] = "No ISO or exposure time to calibrate."
+            return to_return
+        if self.is_timelapse_ongoing_flag or not self.camera_lock.acquire(blocking=False):
+            to_return["error"] = "The camera is busy."
+            return to_return
+        self.dark_calibration = {"running": True, "done": 0, "total": len(pairs), "error": None}
+        threading.Thread(target=self.run_dark_calibration, args=(pairs, frames), daemon=True).start()
+        to_return["started"] = True
+        return to_return
+
+    def run_dark_calibration(self, pairs: List, frames: int):
+        """
+        Takes the master dark frames - is meant to be ran in a thread, with the camera lock held
+        Arguments:
+        pairs - the ISOs and exposure times to calibrate
+        frames - the number of dark frames averaged into each master
+        """
+        camera = self.camera
+        try:
+            self.preview_stream.stop()
+            # The same configuration as the timelapse photos, so that the masters have the shape of their frames
+            capture_config = camera.create_still_configuration(
+                raw={"size": camera.sensor_resolution})
+            camera.stop()
+            camera.configure(capture_config)
+            camera.start()
+            for iso, exposure_time in pairs:
+                gain = iso / 100
+                logger.info("Calibrating the dark frames: ISO %d, exposure time %d", iso, exposure_time)
+                self.frame_stacker.reset("mean")
+                temperatures = []
+                r = self.capture_with_exposure(exposure_time, gain)
+                for frame in range(frames):
+                    if frame > 0:
+                        r = camera.capture_request()
+                    try:
+                        temperatures.append(frame_temperature(r.get_metadata()))
+                        with self.backend.mapped_array(r, "main", write=False) as mapped:
+                            self.frame_stacker.add(mapped.array)
+                    finally:
+                        r.release()
+                known = [temperature for temperature in temperatures if temperature is not None]
+                temperature = sum(known) / len(known) if known else None
+                self.dark_frames.add(self.frame_stacker.result(), exposure_time, gain, temperature, frames)
+                self.dark_calibration["done"] += 1
+        except Exception as e:
+            logger.error("Dark frame calibration stopped on error: %s", e)
+            self.dark_calibration["error"] = str(e)
+        finally:
+            camera.stop()
+            self.dark_calibration["running"] = False
+            self.camera_lock.release()
+
+    def dark_frames_status(self) -> Dict:
+        """ Gets the master dark frames of the camera and the progress of their calibration """
+        return {"calibration": dict(self.dark_calibration), "masters": self.dark_frames.status()}
+
+
+class Cameras:
+    """
+    The cameras of the Pi, addressed by their index, each one owned by its own CameraService.
+    The DNG encoder and the image worker are shared, so that the post-processing of all the cameras runs on the same
+    processes, the image worker serving the cameras in turn.
+    It either runs in the web server process, or in a dedicated process receiving the commands of the web server
+    processes through a local socket, see serve() and CameraClient, so that the web server can run several processes.
+    """
+
+    # The commands that can be sent by a CameraClient to all the cameras, see CameraService.COMMANDS for the others
+    COMMANDS = ("list_cameras", "render_metrics", "upload_status", "pending_uploads", "scheduler_status",
+                "is_capturing", "timelapse_thumbnail")
+
+    def __init__(self, settings: Settings, folders: Folders, metrics: Metrics = None,
+                 scheduler: ThermalScheduler = None):
+        """
+        Arguments:
+        settings - the settings, the number of cameras is read from them
+        folders - the folders the photos and timelapses are saved in
+        metrics - optional, the metrics shared by the cameras, e.g. the queues, each camera has its own labelled with
+        its index
+        scheduler - optional, the scheduler of the background work, shared with the web server in the local mode
+        """
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.folders = folders
+        self.scheduler = scheduler if scheduler is not None else ThermalScheduler(
+            settings.thermal_soft_temp, settings.thermal_hard_temp, settings.thermal_max_load)
+        self.frame_cache = FrameCache(settings.frame_cache_size * 1024 * 1024)
+        self.frame_cache.register_metrics(self.metrics)
+        backend = CameraBackend(settings.camera_backend)
+        # The fake cameras have no raw stream to encode
+        dng_mode = settings.dng_mode if backend.name != "fake" else "sync"
+        self.dng_encoder = DngEncoder(dng_mode, settings.dng_workers, self.scheduler)
+        self.image_worker = ImageWorker(
+            settings.image_workers) if settings.image_workers > 0 else None
+        self.metrics.register("dng_encoder_pending", "gauge", "DNG files waiting to be encoded.",
+                              lambda: self.dng_encoder.pending)
+        if self.image_worker is not None:
+            self.metrics.register("image_worker_pending", "gauge", "Frames waiting to be processed by the image worker.",
+                                  lambda: len(self.image_worker.pending))
+        self.uploader = None
+        if settings.upload_endpoint:
+            # The uploads slow down while the frames of any camera are being written
+            self.uploader = Uploader(settings, folders, lambda: self.dng_encoder.pending > 0 or (
+                self.image_worker is not None and len(self.image_worker.pending) > 0) or self.scheduler.is_throttled(),
+                self.scheduler)
+            self.metrics.register("upload_queue_pending", "gauge", "Files waiting to be uploaded.",
+                                  lambda: len(self.uploader.queue))
+            self.metrics.register("uploaded_bytes", "counter", "Bytes uploaded to the S3 endpoint.",
+                                  lambda: self.uploader.uploaded_bytes)
+        self.services: List[CameraService] = []
+        for camera_num in range(max(1, settings.cameras)):
+            camera_metrics = Metrics(self.metrics.prefix, {"camera": str(camera_num)})
+            self.services.append(CameraService(settings, folders, camera_metrics, camera_num, backend,
+                                               self.dng_encoder, self.image_worker, self.uploader, self.scheduler,
+                                               self.frame_cache))
+
+    def camera(self, camera_num: int = 0) -> CameraService:
+        """
+        Gets the service of a camera.
+        Arguments:
+        camera_num - the index of the camera
+        """
+        if not 0 <= camera_num < len(self.services):
+            raise CameraError("Unknown camera: " + str(camera_num))
+        return self.services[camera_num]
+
+    def list_cameras(self) -> List[Dict]:
+        """ Gets the cameras, whether a timelapse is ongoing on each of them and its folder """
+        return [{"camera": service.camera_num, "is_timelapse_ongoing": service.is_timelapse_ongoing(),
+                 "folder": service.status.current.folder if service.is_timelapse_ongoing() else None}
+                for service in self.services]
+
+    def timelapse_thumbnail(self, folder: str, name: str) -> bytes:
+        """
+        Gets a thumbnail of a timelapse from the frame cache, read from the disk and cached if it's not there.
+        Arguments:
+        folder - the folder of the timelapse
+        name - the file name of the thumbnail, or latest for the last thumbnail of the timelapse being taken
+        Returns:
+        The thumbnail as a JPEG, None if there's no such thumbnail.
+        """
+        if name == "latest":
+            for service in self.services:
+                if service.is_timelapse_ongoing() and service.status.current.folder == folder:
+                    return service.timelapse_output.frame
+            return None
+        path = os.path.join(self.folders.static_timelapse_dir, folder, "tmp", name)
+        thumbnail = self.frame_cache.get(path)
+        if thumbnail is None:
+            try:
+                with open(path, "rb") as f:
+                    thumbnail = f.read()
+            except OSError:
+                return None
+            self.frame_cache.put(path, thumbnail)
+        return thumbnail
+
+    def render_metrics(self) -> str:
+        """ Gets the shared metrics and the ones of all the cameras in the Prometheus text format """
+        return render_metrics([self.metrics] + [service.metrics for service in self.services])
+
+    def scheduler_status(self) -> Dict:
+        """ Gets the throttling decisions of the background work, see ThermalScheduler """
+        return self.scheduler.status()
+
+    def pending_uploads(self, timelapse_date: str) -> int:
+        """
+        Counts the files of a timelapse still waiting to be uploaded, see Uploader
+        Arguments:
+        timelapse_date - the name of the timelapse
+        """
+        if self.uploader is None:
+            return 0
+        return self.uploader.queue.count_in(os.path.join(self.folders.target_timelapse_dir, timelapse_date))
+
+    def is_capturing(self) -> bool:
+        """ Checks if a timelapse photo is being taken or is about to be, see ThermalScheduler.is_capturing """
+        return self.scheduler.is_capturing()
+
+    def upload_status(self) -> Dict:
+        """ Gets the status of the uploads, see Uploader """
+        if self.uploader is None:
+            return {"enabled": False}
+        return {"enabled": True, **self.uploader.status()}
+
+    def close(self):
+        """ Closes the cameras which have been opened """
+        for service in self.services:
+            service.close()
+        if self.uploader is not None:
+            self.uploader.close()
+
+    def serve(self, address: str, authkey: bytes):
+        """
+        Receives the commands of the web server processes, each connection is handled in its own thread
+        Arguments:
+        address - the socket to listen on
+        authkey - the key the clients must authenticate with
+        """
+        if os.path.exists(address):
+            os.remove(address)
+        with Listener(address, family="AF_UNIX", authkey=authkey) as listener:
+            logger.info("Camera service listening on " + address)
+            while True:
+                try:
+                    connection = listener.accept()
+                except (OSError, multiprocessing.AuthenticationError) as e:
+                    logger.warning("Refused a camera service connection: " + str(e))
+                    continue
+                threading.Thread(target=self.handle_connection,
+                                 args=(connection,), daemon=True).start()
+
+    def handle_connection(self, connection):
+        """
+        Runs the commands received on a connection until it's closed - is meant to be ran in a thread
+        Arguments:
+        connection - the connection to a CameraClient
+        """
+        with connection:
+            while True:
+                try:
+                    command, arguments = connection.recv()
+                except (OSError, EOFError):
+                    return
+                try:
+                    camera_num = arguments.pop("camera", 0)
+                    if command in self.COMMANDS:
+                        target = self
+                    elif command in CameraService.COMMANDS:
+                        target = self.camera(camera_num)
+                    else:
+                        raise CameraError("Unknown command: " + str(command))
+                    response = (True, getattr(target, command)(**arguments))
+                except CameraError as e:
+                    response = (False, str(e))
+                except Exception as e:
+                    logger.error("Error while running " +
+                                 str(command) + ": " + str(e))
+                    response = (False, "Error while running " + str(command) + ".")
+                try:
+                    connection.send(response)
+                except (OSError, EOFError):
+                    return
+
+
+def run_service(address: str = None, authkey: bytes = None):
+    """
+    Runs the camera service until the process is stopped - is meant to be ran in a dedicated process
+    Arguments:
+    address - optional, the socket to listen on, read from the settings by default
+    authkey - optional, the key the clients must authenticate with, read from the environment by default
+    """
+    settings = Settings()
+    settings.load_from_json()
+    folders = Folders(settings)
+    folders.create()
+    setup_logging(settings.log_level, settings.log_levels)
+    address = address if address is not None else settings.camera_socket
+    authkey = authkey if authkey is not None else os.environ.get(
+        AUTHKEY_VARIABLE, "").encode()
+    # Exits cleanly when terminated, so that the camera is released and the worker processes are stopped
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    cameras = Cameras(settings, folders)
+    cameras.metrics.register("camera_service_resident_bytes", "gauge", "Resident memory of the camera service process.",
+                             get_resident_memory)
+    try:
+        cameras.serve(address, authkey)
+    finally:
+        cameras.close()
+
+
+def start_service_process(address: str, authkey: bytes) -> multiprocessing.Process:
+    """
+    Starts the camera service in a dedicated process, e.g. from the gunicorn master process before the web workers.
+    The process isn't a daemon as it starts its own worker processes, it must be terminated by the caller.
+    Arguments:
+    address - the socket to listen on
+    authkey - the key the clients must authenticate with
+    Returns:
+    The process.
+    """
+    process = multiprocessing.get_context("spawn").Process(
+        target=run_service, args=(address, authkey), name="camera-service")
+    process.start()
+    return process
+
+
+if __name__ == "__main__":
+    run_service()
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from utils import get_cpu_temp
+
+logger = logging.getLogger(__name__)
+
+# The file listing the master dark frames of a camera, in its dark frames folder
+DARK_INDEX = "darks.json"
+# The level a pixel of a master is counted as hot from, out of 255
+HOT_PIXEL_LEVEL = 32
+
+
+def linear_subtraction_table() -> np.ndarray:
+    """
+    Builds the table of the dark frame subtraction of 8 bits sRGB values, done in linear light: the entry
+    [value * 256 + dark] is the sRGB value of linear(value) - linear(dark), clipped at 0.
+    """
+    encoded = np.arange(256) / 255
+    linear = np.where(encoded <= 0.04045, encoded / 12.92, ((encoded + 0.055) / 1.055) ** 2.4)
+    difference = np.clip(linear[:, None] - linear[None, :], 0, 1)
+    table = np.where(difference <= 0.0031308, difference * 12.92, 1.055 * difference ** (1 / 2.4) - 0.055)
+    return np.rint(table * 255).astype(np.uint8).ravel()
+
+
+# See linear_subtraction_table
+LINEAR_SUBTRACTION_TABLE = linear_subtraction_table()
+
+
+def frame_temperature(metadata: Dict = None) -> float:
+    """
+    Gets the temperature a frame was taken at: the sensor's if it reports it, the CPU's otherwise.
+    Arguments:
+    metadata - optional, the metadata of the frame
+    Returns:
+    The temperature in °C, None if it can't be read e.g. not on a Pi.
+    """
+    if metadata and metadata.get("SensorTemperature") is not None:
+        return float(metadata["SensorTemperature"])
+    try:
+        return get_cpu_temp()
+    except (OSError, ValueError):
+        return None
+
+
+class DarkFrameLibrary:
+    """
+    The master dark frames of a camera, by exposure time, gain and temperature band, e.g. 30s, gain 8, 40-45°C.
+    A master is the mean of frames taken with the lens covered, so it only holds the sensor's thermal noise and hot
+    pixels. Subtracting it from the long exposures of a night timelapse removes the hot pixels at the cost of a
+    single exposure, where the in-camera long exposure noise reduction would take a dark frame after each photo.
+    The masters are saved as .npy files and loaded on first use.
+    """
+
+    def __init__(self, folder: str, band_width: float = 5):
+        """
+        Arguments:
+        folder - the folder of the master dark frames of the camera
+        band_width - the width of the temperature bands (°C)
+        """
+        self.folder = folder
+        self.band_width = band_width
+        self.lock = threading.Lock()
+        # The masters by file name, as in the index
+        self.index: Dict[str, Dict] = self.read_index()
+        self.masters: Dict[str, np.ndarray] = {}
+        # Reused by subtract(), so that the hot path allocates nothing
+        self.buffer: np.ndarray = None
+        self.indexes: np.ndarray = None
+
+    def read_index(self) -> Dict[str, Dict]:
+        """ Reads the index of the masters, empty if there's none yet """
+        try:
+            with open(os.path.join(self.folder, DARK_INDEX)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def band(self, temperature: float) -> int:
+        """
+        Gets the temperature band of a temperature, e.g. 40 for 43°C with 5° bands
+        Arguments:
+        temperature - the temperature in °C, None if unknown
+        Returns:
+        The lower bound of the band, None if the temperature is unknown.
+        """
+        if temperature is None:
+            return None
+        return int(temperature // self.band_width * self.band_width)
+
+    def file_name(self, exposure_time: int, gain: float, band: int) -> str:
+        return "dark_" + str(exposure_time) + "_" + "{:.2f}".format(gain) + "_" + \
+            ("any" if band is None else str(band)) + ".npy"
+
+    def add(self, master: np.ndarray, exposure_time: int, gain: float, temperature: float, frames: int):
+        """
+        Saves a master dark frame, replacing the one of the same exposure time, gain and temperature band.
+        Arguments:
+        master - the master dark frame, with the shape of the timelapse frames
+        exposure_time - the exposure time of the dark frames
+        gain - the analogue gain of the dark frames
+        temperature - the temperature the dark frames were taken at, None if unknown
+        frames - the number of dark frames averaged
+        """
+        band = self.band(temperature)
+        name = self.file_name(exposure_time, gain, band)
+        os.makedirs(self.folder, exist_ok=True)
+        np.save(os.path.join(self.folder, name), master)
+        with self.lock:
+            self.masters[name] = master
+            self.index[name] = {"exposure_time": exposure_time, "gain": round(gain, 2), "band": band,
+                                "temperature": temperature, "frames": frames,
+                                "hot_pixels": int(np.count_nonzero(master.max(axis=-1) > HOT_PIXEL_LEVEL))}
+            with open(os.path.join(self.folder, DARK_INDEX), "w") as f:
+                json.dump(self.index, f, indent=4)
+        logger.info("Master dark frame saved: %s", name)
+
+    def find(self, exposure_time: int, gain: float, temperature: float) -> np.ndarray:
+        """
+        Gets the master dark frame of an exposure time and gain, from the closest temperature band.
+        Arguments:
+        exposure_time - the exposure time of the frame
+        gain - the analogue gain of the frame
+        temperature - the temperature the frame was taken at, None if unknown
+        Returns:
+        The master dark frame, None if there's none for this exposure time and gain.
+        """
+        band = self.band(temperature)
+        with self.lock:
+            candidates: List[Tuple[float, str]] = []
+            for name, entry in self.index.items():
+                if entry["exposure_time"] != exposure_time or abs(entry["gain"] - gain) > 0.01:
+                    continue
+                if band is None or entry["band"] is None:
+                    distance = 0 if band == entry["band"] else self.band_width
+                else:
+                    distance = abs(entry["band"] - band)
+                candidates.append((distance, name))
+            if not candidates:
+                return None
+            name = min(candidates)[1]
+            master = self.masters.get(name)
+        if master is None:
+            try:
+                master = np.load(os.path.join(self.folder, name))
+            except (OSError, ValueError) as e:
+                logger.error("Error while loading the master dark frame: %s - %s", name, e)
+                return None
+            with self.lock:
+                self.masters[name] = master
+        return master
+
+    def subtract(self, frame: np.ndarray, master: np.ndarray) -> np.ndarray:
+        """
+        Subtracts a master dark frame from a frame. The frame isn't modified, e.g. a mapped camera buffer.
+        The thermal noise adds up in linear light, but both are the ISP's gamma encoded output: the 8 bits values are
+        decoded with the sRGB curve, subtracted and encoded again, see linear_subtraction_table. This is an
+        approximation, the ISP's tone curve, colour matrix and denoising aren't undone, so the correction is clamped:
+        a pixel is never brightened nor made darker than black. Other frames are subtracted as they are, clipped at 0.
+        Arguments:
+        frame - the frame
+        master - the master dark frame, ignored if it doesn't have the shape of the frame
+        Returns:
+        The corrected frame, in a buffer reused by the next call.
+        """
+        if master.shape != frame.shape:
+            logger.warning("The master dark frame doesn't match the frame: %s / %s", master.shape, frame.shape)
+            return frame
+        if self.buffer is None or self.buffer.shape != frame.shape or self.buffer.dtype != frame.dtype:
+            self.buffer = np.empty_like(frame)
+        if frame.dtype == np.uint8 and master.dtype == np.uint8:
+            if self.indexes is None or self.indexes.shape != frame.shape:
+                self.indexes = np.empty(frame.shape, dtype=np.uint16)
+            np.multiply(frame, 256, out=self.indexes, dtype=np.uint16)
+            np.add(self.indexes, master, out=self.indexes)
+            np.take(LINEAR_SUBTRACTION_TABLE, self.indexes, out=self.buffer)
+            return self.buffer
+        # frame - min(frame, master) never wraps around
+        np.minimum(frame, master, out=self.buffer)
+        np.subtract(frame, self.buffer, out=self.buffer)
+        return self.buffer
+
+    def status(self) -> List[Dict]:
+        """ Gets the masters as a list to be serialized """
+        with self.lock:
+            return sorted(self.index.values(), key=lambda entry: (entry["exposure_time"], entry["gain"],
+                                                                 entry["band"] if entry["band"] is not None else -1))
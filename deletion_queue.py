@@ -0,0 +1,122 @@
+import fcntl
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from typing import List
+
+from scheduler import ThermalScheduler
+from utils import create_folder_if_not_exists, get_day_and_time, lower_thread_priority
+
+logger = logging.getLogger(__name__)
+
+# Taken for each deletion, in the trash folder, so that the web server processes don't delete the same items at once
+DELETION_LOCK = ".deletion.lock"
+
+
+class DeletionQueue:
+    """
+    Deletes photos and timelapses in a low priority background thread.
+    Each web server process has its own queue, and all of them resume the trash left by a previous run: the deletions
+    are made one at a time across the processes, and an item already deleted by another process is skipped.
+    """
+
+    def __init__(self, trash_dir: str, scheduler: ThermalScheduler = None):
+        """
+        Arguments:
+        trash_dir - the folder where timelapses are moved before being deleted, must be on the same drive as the timelapses
+        scheduler - optional, defers the deletions while the Pi is hot or a photo is being taken
+        """
+        self.trash_dir = trash_dir
+        self.scheduler = scheduler
+        self.queue = queue.Queue()
+        self.deleted_items = 0
+        self.failed_items = 0
+        create_folder_if_not_exists(trash_dir)
+        self.lock_path = os.path.join(trash_dir, DELETION_LOCK)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.resume()
+
+    def resume(self):
+        """ Queues the timelapses left in the trash by a previous run, e.g. after a reboot """
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for entry in os.scandir(self.trash_dir):
+                if entry.name != DELETION_LOCK:
+                    self.queue.put(entry.path)
+
+    def delete_files(self, paths: List[str]):
+        """
+        Moves files to the trash right away, in a folder of their own, and queues it for deletion, so that the
+        deletion is resumed after a restart.
+        Arguments:
+        paths - the paths of the files, None values and missing files are ignored
+        """
+        trash_path = tempfile.mkdtemp(prefix="files_" + get_day_and_time() + "_", dir=self.trash_dir)
+        for index, path in enumerate(paths):
+            if path is None or not os.path.lexists(path):
+                continue
+            try:
+                # Numbered, as e.g. a photo and its thumbnail have the same name
+                os.replace(path, os.path.join(trash_path, str(index) + "_" + os.path.basename(path)))
+            except OSError as e:
+                # e.g. on another drive than the trash, deleted from where it is
+                logger.warning("Unable to move to the trash, deleted in place: %s - %s", path, e)
+                self.queue.put(path)
+        self.queue.put(trash_path)
+
+    def delete_folder(self, path: str) -> bool:
+        """
+        Moves a folder to the trash right away and queues it for deletion.
+        Arguments:
+        path - the path of the folder
+        Returns:
+        True if the folder has been moved to the trash or doesn't exist.
+        """
+        if not os.path.exists(path):
+            return True
+        trash_path = os.path.join(
+            self.trash_dir, os.path.basename(os.path.normpath(path)) + "_" + get_day_and_time())
+        try:
+            os.replace(path, trash_path)
+        except OSError as e:
+            logger.error("Error while moving to the trash: " + path + " - " + str(e))
+            return False
+        self.queue.put(trash_path)
+        return True
+
+    def status(self):
+        """ Gets the status of the queue as a Dict to be serialized """
+        return {
+            "pending": self.queue.qsize(),
+            "deleted": self.deleted_items,
+            "failed": self.failed_items,
+        }
+
+    def run(self):
+        """ Deletes the queued items one by one - is meant to be ran in a thread """
+        lower_thread_priority()
+        while True:
+            path = self.queue.get()
+            if self.scheduler is not None:
+                self.scheduler.wait_turn("deletion")
+            try:
+                with open(self.lock_path, "a") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    if not os.path.lexists(path):
+                        # Deleted by another process in the meantime
+                        continue
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                self.deleted_items += 1
+                logger.info("Deleted: " + path)
+            except OSError as e:
+                self.failed_items += 1
+                logger.error("Error while deleting: " + path + " - " + str(e))
+            finally:
+                self.queue.task_done()
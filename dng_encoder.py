@@ -0,0 +1,260 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from typing import Dict, List, Set
+
+import numpy as np
+
+from scheduler import ThermalScheduler
+from shared_frames import SharedFrame
+
+logger = logging.getLogger(__name__)
+
+SPOOL_EXTENSION = ".rawspool.npy"
+# The raw buffers waiting in shared memory per worker of the pool mode, the next ones are spooled, see DngEncoder.save
+MAX_SHARED_FRAMES_PER_WORKER = 2
+
+
+def encode_dng(raw, config: Dict, metadata: Dict, dng_path: str):
+    """
+    Encodes a raw buffer into a DNG file, the same way Picamera2's CompletedRequest.save_dng does.
+    Arguments:
+    raw - the raw buffer as an array, or a SharedFrame holding it
+    config - the raw stream configuration
+    metadata - the request's metadata
+    dng_path - the path of the DNG file to write
+    """
+    from pidng.camdefs import Picamera2Camera
+    from pidng.core import PICAM2DNG
+    frame = raw if isinstance(raw, SharedFrame) else None
+    try:
+        array = frame.array() if frame is not None else raw
+        dng = PICAM2DNG(Picamera2Camera(config, metadata))
+        dng.options(compress=0)
+        dng.convert(array, dng_path)
+    finally:
+        if frame is not None:
+            frame.close()
+    return dng_path
+
+
+def convert_spool_file(spool_path: str, remove_spool: bool = True):
+    """
+    Converts a raw spool file and its JSON sidecar into a DNG file.
+    Arguments:
+    spool_path - the path of the spool file
+    remove_spool - True to delete the spool files once converted
+    """
+    sidecar_path = spool_path[:-len(SPOOL_EXTENSION)] + ".json"
+    with open(sidecar_path, "r") as f:
+        sidecar = json.load(f)
+    raw = np.load(spool_path, mmap_mode="r")
+    encode_dng(raw, sidecar["config"], sidecar["metadata"], sidecar["dng_path"])
+    del raw
+    if remove_spool:
+        os.remove(spool_path)
+        os.remove(sidecar_path)
+    return sidecar["dng_path"]
+
+
+class DngEncoder:
+    """
+    Saves the DNG files of the captured requests, depending on the mode:
+    - sync - encodes the DNG on the capture thread, as Picamera2 does
+    - pool - hands the raw buffer to a process pool through shared memory, the encoding runs on the other cores.
+      A raw buffer takes about 20MB, so when the pool falls behind, e.g. during a burst, the next ones are spooled
+      and converted in the pool instead of filling /dev/shm
+    - spool - dumps the raw buffer to a spool file, converted into a DNG once the timelapse is over
+    """
+
+    MODES = ("sync", "pool", "spool")
+
+    def __init__(self, mode: str = "pool", workers: int = 2, scheduler: ThermalScheduler = None,
+                 max_shared_frames: int = None):
+        """
+        Arguments:
+        mode - the encoding mode, see the class description
+        workers - the number of processes in the pool
+        scheduler - optional, paces the spool conversions, which can wait unlike the raw buffers in shared memory
+        max_shared_frames - optional, the raw buffers in shared memory the pool mode spools from, 2 per worker
+        by default
+        """
+        if mode not in self.MODES:
+            logger.warning("Unknown DNG mode: " + str(mode) + ", falling back to sync")
+            mode = "sync"
+        self.mode = mode
+        self.workers = workers
+        self.pool: ProcessPoolExecutor = None
+        # Changed by the capture threads and the pool callbacks
+        self.lock = threading.Lock()
+        self.pending = 0
+        # The raw buffers in shared memory, waiting for the pool or being encoded
+        self.shared_frames = 0
+        self.max_shared_frames = max_shared_frames if max_shared_frames is not None else \
+            workers * MAX_SHARED_FRAMES_PER_WORKER
+        self.spooled_frames = 0
+        # The spool files queued or being converted, so that each one is only converted once
+        self.spooling: Set[str] = set()
+        # The futures of the DNG files spooled in pool mode, set once converted
+        self.spool_futures: Dict[str, Future] = {}
+        self.scheduler = scheduler
+
+    def get_pool(self) -> ProcessPoolExecutor:
+        """ Gets the process pool, created on first use """
+        if self.pool is None:
+            # spawn rather than fork: the capture process runs libcamera threads
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self.pool
+
+    def save(self, request, dng_path: str) -> Future:
+        """
+        Saves the raw stream of a request as a DNG file. Only the copy of the raw buffer happens on the calling thread
+        in the pool and spool modes.
+        Arguments:
+        request - the Picamera2 CompletedRequest
+        dng_path - the path of the DNG file
+        Returns:
+        A Future done once the DNG file is written - or the spool file in spool mode.
+        """
+        if self.mode == "sync":
+            future = Future()
+            request.save_dng(dng_path)
+            future.set_result(dng_path)
+            return future
+        from picamera2 import MappedArray
+        config = request.config["raw"]
+        metadata = request.get_metadata()
+        with MappedArray(request, "raw", write=False) as mapped:
+            if self.mode == "spool":
+                return self.spool(mapped.array, config, metadata, dng_path)
+            with self.lock:
+                shared = self.shared_frames < self.max_shared_frames
+                if shared:
+                    self.shared_frames += 1
+                    self.pending += 1
+            frame = None
+            if shared:
+                try:
+                    frame = SharedFrame.from_array(mapped.array)
+                except OSError as e:
+                    logger.warning("Unable to copy the raw buffer to shared memory: %s", e)
+                    with self.lock:
+                        self.shared_frames -= 1
+                        self.pending -= 1
+            if frame is None:
+                return self.spool_and_convert(mapped.array, config, metadata, dng_path)
+        future = self.get_pool().submit(encode_dng, frame, config, metadata, dng_path)
+        future.add_done_callback(lambda f: self.on_encoded(f, frame, dng_path))
+        return future
+
+    def spool_and_convert(self, raw: np.ndarray, config: Dict, metadata: Dict, dng_path: str) -> Future:
+        """
+        Spools a raw buffer the pool mode can't hold in shared memory, and queues its conversion right away.
+        Arguments:
+        raw - the raw buffer
+        config - the raw stream configuration
+        metadata - the request's metadata
+        dng_path - the path of the DNG file
+        Returns:
+        A Future done once the DNG file is written.
+        """
+        spool_path = self.spool(raw, config, metadata, dng_path).result()
+        future = Future()
+        with self.lock:
+            self.spool_futures[spool_path] = future
+            self.spooled_frames += 1
+        logger.info("The DNG encoding is behind, spooled: %s", spool_path)
+        self.convert_spool_files([spool_path])
+        return future
+
+    def on_encoded(self, future: Future, frame: SharedFrame, dng_path: str):
+        """ Frees the shared raw buffer once the DNG is written """
+        with self.lock:
+            self.pending -= 1
+            self.shared_frames -= 1
+        frame.unlink()
+        if future.exception() is not None:
+            logger.error("Error while encoding: " + dng_path + " - " + str(future.exception()))
+
+    def spool(self, raw: np.ndarray, config: Dict, metadata: Dict, dng_path: str) -> Future:
+        """
+        Dumps a raw buffer into a spool file next to the DNG file to be.
+        Arguments:
+        raw - the raw buffer
+        config - the raw stream configuration
+        metadata - the request's metadata
+        dng_path - the path of the DNG file to be
+        """
+        base_path = os.path.splitext(dng_path)[0]
+        np.save(base_path + SPOOL_EXTENSION, raw)
+        with open(base_path + ".json", "w") as f:
+            json.dump({"config": config, "metadata": metadata,
+                       "dng_path": dng_path}, f, default=str)
+        future = Future()
+        future.set_result(base_path + SPOOL_EXTENSION)
+        return future
+
+    def convert_spool(self, folder: str):
+        """
+        Converts all the spool files of a folder into DNG files, in the process pool.
+        Arguments:
+        folder - the folder holding the spool files
+        """
+        self.convert_spool_files([entry.path for entry in os.scandir(folder)
+                                  if entry.name.endswith(SPOOL_EXTENSION)])
+
+    def convert_spool_files(self, spool_paths: List[str]):
+        """
+        Converts spool files into DNG files, in the process pool. The files already queued are skipped.
+        Arguments:
+        spool_paths - the paths of the spool files
+        """
+        with self.lock:
+            paths = [path for path in spool_paths if path not in self.spooling]
+            self.spooling.update(paths)
+            self.pending += len(paths)
+        if not paths:
+            return
+        if self.scheduler is None:
+            for path in paths:
+                future = self.get_pool().submit(convert_spool_file, path)
+                future.add_done_callback(lambda f, path=path: self.on_spool_converted(f, path))
+        else:
+            threading.Thread(target=self.convert_spool_paced, args=(paths,), daemon=True).start()
+
+    def convert_spool_paced(self, paths: List[str]):
+        """
+        Converts spool files one worker at a time, each one waiting for its turn - is meant to be ran in a thread
+        Arguments:
+        paths - the paths of the spool files
+        """
+        in_flight = set()
+        for path in paths:
+            if len(in_flight) >= self.workers:
+                _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            self.scheduler.wait_turn("dng_spool")
+            future = self.get_pool().submit(convert_spool_file, path)
+            future.add_done_callback(lambda f, path=path: self.on_spool_converted(f, path))
+            in_flight.add(future)
+
+    def on_spool_converted(self, future: Future, spool_path: str):
+        """ Logs the spool conversion errors, and sets the future of a DNG file spooled in pool mode """
+        with self.lock:
+            self.pending -= 1
+            self.spooling.discard(spool_path)
+            dng_saved = self.spool_futures.pop(spool_path, None)
+        if future.exception() is not None:
+            logger.error("Error while converting a spool file: " + str(future.exception()))
+            if dng_saved is not None:
+                dng_saved.set_exception(future.exception())
+        elif dng_saved is not None:
+            dng_saved.set_result(future.result())
+
+    def status(self):
+        """ Gets the status of the encoder as a Dict to be serialized """
+        return {"mode": self.mode, "pending": self.pending, "shared_frames": self.shared_frames,
+                "spooled_frames": self.spooled_frames}
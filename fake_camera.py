@@ -0,0 +1,196 @@
+import io
+import logging
+import threading
+import time
+from typing import Dict
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# The size of the frames of the fake cameras
+FAKE_MAIN_SIZE = (640, 480)
+FAKE_SENSOR_RESOLUTION = (1280, 960)
+# The time between two frames, when the exposure is shorter
+FAKE_FRAME_DURATION = 1 / 30
+# The longest frame duration of the preview configuration, in µs, as Picamera2's - longer exposures are clamped
+FAKE_PREVIEW_FRAME_DURATION = 83333
+# The brightness of the scene, the frames are saturated above an exposure time x gain of about 4x this value
+FAKE_SCENE_EXPOSURE = 20000
+
+
+class FakeRequest:
+    """ A captured request of a FakeCamera, see Picamera2's CompletedRequest """
+
+    def __init__(self, array: np.ndarray, metadata: Dict, config: Dict):
+        self.array = array
+        self.metadata = metadata
+        self.config = config
+
+    def get_metadata(self) -> Dict:
+        return dict(self.metadata)
+
+    def make_array(self, stream: str) -> np.ndarray:
+        return self.array.copy()
+
+    def save(self, stream: str, path: str):
+        Image.fromarray(self.array).save(path, quality=90)
+
+    def save_dng(self, path: str):
+        """ Saves the frame as a TIFF file, the fake cameras have no raw stream """
+        Image.fromarray(self.array).save(path, format="TIFF")
+
+    def release(self):
+        pass
+
+
+class FakeMappedArray:
+    """ Maps a FakeRequest's frame, see Picamera2's MappedArray """
+
+    def __init__(self, request: FakeRequest, stream: str, reshape: bool = True, write: bool = True):
+        self.request = request
+
+    def __enter__(self):
+        self.array = self.request.array
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def fake_awb_mode(wb: str) -> str:
+    """
+    Gets the white balance control of the fake cameras, which take the name of the white balance as is
+    Arguments:
+    wb - the white balance, e.g. day or auto
+    """
+    return wb
+
+
+class FakeJpegEncoder:
+    """ Stands for Picamera2's JpegEncoder, the fake cameras encode the preview themselves """
+
+
+class FakeFileOutput:
+    """ Stands for Picamera2's FileOutput """
+
+    def __init__(self, file):
+        self.file = file
+
+
+class FakeCamera:
+    """
+    Simulates a camera with the subset of the Picamera2 API the camera service uses, so that the app can run and be
+    tested without a camera, e.g. several cameras at once. The frames are a gradient with a bar moving over time, their
+    brightness follows the exposure time and the gain, and the requested controls are applied on the next frame.
+    """
+
+    def __init__(self, camera_num: int = 0):
+        """
+        Arguments:
+        camera_num - the index of the camera, the scenes of the cameras differ
+        """
+        self.camera_num = camera_num
+        self.sensor_resolution = FAKE_SENSOR_RESOLUTION
+        self.config = {}
+        self.started = False
+        self.lock = threading.Lock()
+        self.controls = {"ExposureTime": 10000,
+                         "AnalogueGain": 1.0, "AeEnable": True}
+        self.pending_controls = {}
+        self.recording = None
+        x = np.linspace(0, 1, FAKE_MAIN_SIZE[0], dtype="float32")
+        y = np.linspace(0, 1, FAKE_MAIN_SIZE[1], dtype="float32")
+        tint = np.array([1.0, 0.9 - 0.2 * (camera_num % 2), 0.8], dtype="float32")
+        self.scene = (np.add.outer(y, x)[..., None] / 2) * tint
+        logger.info("Fake camera " + str(camera_num) + " opened")
+
+    def create_preview_configuration(self, **kwargs) -> Dict:
+        return {"use_case": "preview", "controls": {"FrameDurationLimits": (100, FAKE_PREVIEW_FRAME_DURATION)},
+                **kwargs}
+
+    def create_still_configuration(self, **kwargs) -> Dict:
+        return {"use_case": "still", **kwargs}
+
+    def create_video_configuration(self, **kwargs) -> Dict:
+        return {"use_case": "video", **kwargs}
+
+    def configure(self, config: Dict):
+        self.config = config
+
+    def switch_mode(self, config: Dict):
+        self.config = config
+
+    def set_controls(self, controls: Dict):
+        with self.lock:
+            self.pending_controls.update(controls)
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def close(self):
+        self.stop_recording()
+        self.started = False
+
+    def capture_request(self) -> FakeRequest:
+        """ Waits for the next frame, the controls requested before are applied to it """
+        with self.lock:
+            self.controls.update(self.pending_controls)
+            self.pending_controls = {}
+            controls = dict(self.controls)
+        exposure_time = int(controls["ExposureTime"])
+        limits = self.config.get("controls", {}).get("FrameDurationLimits")
+        if limits:
+            exposure_time = min(exposure_time, limits[1])
+        gain = float(controls["AnalogueGain"])
+        time.sleep(max(FAKE_FRAME_DURATION, exposure_time / 1000000))
+        metadata = {"ExposureTime": exposure_time, "AnalogueGain": gain, "AeLocked": True,
+                    "ColourGains": (2.0, 1.5), "Lux": 400.0, "SensorTimestamp": time.monotonic_ns()}
+        if not controls.get("AeEnable", True):
+            metadata.pop("AeLocked")
+        return FakeRequest(self.make_frame(exposure_time * gain), metadata, {"raw": {}, "main": {}})
+
+    def capture_metadata(self) -> Dict:
+        return self.capture_request().get_metadata()
+
+    def switch_mode_capture_request_and_stop(self, config: Dict) -> FakeRequest:
+        self.switch_mode(config)
+        request = self.capture_request()
+        self.stop()
+        return request
+
+    def make_frame(self, exposure: float) -> np.ndarray:
+        """
+        Renders a frame of the scene.
+        Arguments:
+        exposure - the exposure time x the gain
+        """
+        frame = self.scene * (exposure / FAKE_SCENE_EXPOSURE)
+        # A bar crossing the frame every minute, so that the scene changes
+        bar = int((time.time() % 60) / 60 * FAKE_MAIN_SIZE[0])
+        frame[:, bar:bar + 16] += 0.5
+        return (np.clip(frame, 0, 1) * 255).astype(np.uint8)
+
+    def start_recording(self, encoder: FakeJpegEncoder, output: FakeFileOutput):
+        """ Writes the frames as JPEG files to the output until the recording is stopped """
+        stop = threading.Event()
+        self.recording = stop
+
+        def record():
+            while not stop.is_set():
+                buffer = io.BytesIO()
+                Image.fromarray(self.capture_request().array).save(
+                    buffer, format="JPEG", quality=70)
+                output.file.write(buffer.getvalue())
+
+        self.started = True
+        threading.Thread(target=record, daemon=True).start()
+
+    def stop_recording(self):
+        if self.recording is not None:
+            self.recording.set()
+            self.recording = None
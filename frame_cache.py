@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+
+from metrics import Metrics
+
+
+class FrameCache:
+    """
+    Keeps the latest JPEG files in memory, e.g. the thumbnails of the ongoing timelapses, so that the pages showing
+    them don't read them from the SD card again for every viewer. The least recently used files are evicted once the
+    cache holds more than its maximum size.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        """
+        Arguments:
+        max_bytes - the maximum size of the files kept
+        """
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def put(self, key: str, data: bytes):
+        """
+        Adds a file, or replaces it, as the most recently used one.
+        Arguments:
+        key - the key of the file, e.g. its path
+        data - the content of the file, not kept if it's larger than the cache
+        """
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def get(self, key: str) -> bytes:
+        """
+        Gets a file and marks it as the most recently used one.
+        Arguments:
+        key - the key of the file
+        Returns:
+        The content of the file, None if it isn't in the cache.
+        """
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def register_metrics(self, metrics: Metrics):
+        """
+        Exposes the hits, misses and size of the cache.
+        Arguments:
+        metrics - the metrics to expose them with
+        """
+        metrics.register("frame_cache_hits", "counter", "Files served from the frame cache.", lambda: self.hits)
+        metrics.register("frame_cache_misses", "counter", "Files read from the disk, missing from the frame cache.",
+                         lambda: self.misses)
+        metrics.register("frame_cache_evictions", "counter", "Files evicted from the frame cache.",
+                         lambda: self.evictions)
+        metrics.register("frame_cache_bytes", "gauge", "Size of the files in the frame cache.", lambda: self.size)
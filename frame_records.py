@@ -0,0 +1,207 @@
+from array import array
+import csv
+from datetime import datetime
+import math
+import os
+from typing import Dict, List
+
+from utils import generate_pretty_exposure_times, pretty_number
+
+pretty_exposure_times_list = generate_pretty_exposure_times()
+
+
+class FrameRecordStore:
+    """
+    Stores the records of a timelapse's photos in numeric columns, so that a long timelapse only takes a few bytes per photo.
+    The values are only formatted when the records are sent to the web page, and each record is appended to a CSV file.
+    """
+
+    __slots__ = ("photos_to_take", "thumbnail_dir", "numbers", "timestamps", "isos", "exposure_times",
+                 "brightnesses", "stack_times", "scene_changes", "intervals", "skipped", "thumbnails_ready",
+                 "csv_file", "csv_writer")
+
+    COLUMNS = ["number", "timestamp", "iso", "exposure_time", "brightness", "stack_time",
+               "scene_change", "interval", "skipped"]
+
+    def __init__(self, photos_to_take: int, thumbnail_dir: str = "", csv_path: str = None):
+        """
+        Arguments:
+        photos_to_take - the number of photos of the timelapse, used to build the file names
+        thumbnail_dir - the folder of the thumbnails
+        csv_path - optional, the path of the CSV file the records are appended to
+        """
+        self.photos_to_take = photos_to_take
+        self.thumbnail_dir = thumbnail_dir
+        self.numbers = array("I")
+        self.timestamps = array("d")
+        self.isos = array("I")
+        self.exposure_times = array("I")
+        self.brightnesses = array("f")
+        self.stack_times = array("f")
+        self.scene_changes = array("f")
+        self.intervals = array("f")
+        self.skipped = array("B")
+        self.thumbnails_ready = array("B")
+        self.csv_file = None
+        self.csv_writer = None
+        if csv_path is not None:
+            self.csv_file = open(csv_path, "a", newline="")
+            self.csv_writer = csv.writer(self.csv_file)
+            if self.csv_file.tell() == 0:
+                self.csv_writer.writerow(self.COLUMNS)
+                self.csv_file.flush()
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def append(self, number: int, timestamp: float, iso: int, exposure_time: int, brightness: float, stack_time: float = None,
+               scene_change: float = None, interval: float = None, skipped: bool = False):
+        """
+        Adds the record of a photo.
+        Arguments:
+        number - the number of the photo in the timelapse
+        timestamp - the time the photo was taken, as a POSIX timestamp
+        iso - the ISO value
+        exposure_time - the exposure time (ms)
+        brightness - the photo's brightness
+        stack_time - optional, the mean time it took to stack a frame, in ms
+        scene_change - optional, the scene change score in the adaptive interval mode, see AdaptiveInterval
+        interval - optional, the interval chosen before the next photo in the adaptive interval mode, in seconds
+        skipped - True if the photo hasn't been saved, as a near-duplicate of the previous one
+        """
+        stack_time = math.nan if stack_time is None else stack_time
+        scene_change = math.nan if scene_change is None else scene_change
+        interval = math.nan if interval is None else interval
+        self.numbers.append(number)
+        self.timestamps.append(timestamp)
+        self.isos.append(iso)
+        self.exposure_times.append(exposure_time)
+        self.brightnesses.append(brightness)
+        self.stack_times.append(stack_time)
+        self.scene_changes.append(scene_change)
+        self.intervals.append(interval)
+        self.skipped.append(1 if skipped else 0)
+        self.thumbnails_ready.append(0)
+        if self.csv_writer is not None:
+            self.csv_writer.writerow([number, "{:.3f}".format(timestamp), iso, exposure_time,
+                                      "{:.3f}".format(brightness), format_optional(
+                                          stack_time, "{:.1f}"),
+                                      format_optional(scene_change, "{:.4f}"), format_optional(interval, "{:.1f}"),
+                                      1 if skipped else 0])
+            self.csv_file.flush()
+
+    def set_thumbnail_ready(self, number: int):
+        """
+        Flags the thumbnail of a photo as ready to be displayed.
+        Arguments:
+        number - the number of the photo in the timelapse
+        """
+        index = self.index_of(number)
+        if index is not None:
+            self.thumbnails_ready[index] = 1
+
+    def index_of(self, number: int):
+        """ Gets the index of a photo's record from its number, None if not found """
+        # Photos are numbered from 1 without gaps
+        index = number - 1
+        if 0 <= index < len(self.numbers) and self.numbers[index] == number:
+            return index
+        return None
+
+    def file_name(self, number: int, timestamp: float, iso: int, exposure_time: int) -> str:
+        """
+        Gets the file name of a photo, without extension.
+        Arguments:
+        number - the number of the photo in the timelapse
+        timestamp - the time the photo was taken, as a POSIX timestamp
+        iso - the ISO value
+        exposure_time - the exposure time (ms)
+        """
+        return "tl_" + pretty_number(number, self.photos_to_take) + "_" + format_timestamp(timestamp) + "_ISO_" + \
+            str(iso) + "_" + \
+            pretty_exposure_times_list[exposure_time].replace('/', '-')
+
+    def photo(self, index: int) -> Dict:
+        """
+        Gets a photo's record as a Dict to be serialized.
+        Arguments:
+        index - the index of the record
+        """
+        number = self.numbers[index]
+        timestamp = self.timestamps[index]
+        iso = self.isos[index]
+        exposure_time = self.exposure_times[index]
+        photo = {
+            "file_name": self.file_name(number, timestamp, iso, exposure_time),
+            "time": format_timestamp(timestamp),
+            "iso": iso,
+            "speed": pretty_exposure_times_list[exposure_time],
+            "number": number,
+            "brightness": "{:10.3f}".format(self.brightnesses[index]),
+        }
+        if not math.isnan(self.stack_times[index]):
+            photo["stack_time"] = "{:.1f}".format(self.stack_times[index])
+        if not math.isnan(self.scene_changes[index]):
+            photo["scene_change"] = "{:.4f}".format(self.scene_changes[index])
+        if not math.isnan(self.intervals[index]):
+            photo["interval"] = "{:.1f}".format(self.intervals[index])
+        if self.skipped[index]:
+            photo["skipped"] = True
+        return photo
+
+    def thumbnail(self, index: int) -> Dict:
+        """
+        Gets a photo's thumbnail as a Dict to be serialized.
+        Arguments:
+        index - the index of the record
+        """
+        photo = self.photo(index)
+        return {
+            "path": os.path.join(self.thumbnail_dir, photo["file_name"] + ".jpg"),
+            "number": photo["number"],
+            "time": photo["time"],
+            "iso": photo["iso"],
+            "speed": photo["speed"],
+            "brightness": photo["brightness"],
+        }
+
+    def photos(self, since: int = 0) -> List[Dict]:
+        """
+        Gets the records of the photos taken after a given one.
+        Arguments:
+        since - the number of the last photo already known, 0 for all the photos
+        """
+        return [self.photo(index) for index in range(max(0, since), len(self.numbers))]
+
+    def thumbnails(self, since: int = 0) -> List[Dict]:
+        """
+        Gets the thumbnails made after a given one. The thumbnails can be made out of order, so only the ones
+        following each other without gap are returned, the skipped photos having none.
+        Arguments:
+        since - the number of the last thumbnail already known, 0 for all the thumbnails
+        """
+        thumbnails = []
+        for index in range(max(0, since), len(self.numbers)):
+            if not self.thumbnails_ready[index]:
+                break
+            # The skipped photos have no thumbnail
+            if not self.skipped[index]:
+                thumbnails.append(self.thumbnail(index))
+        return thumbnails
+
+    def close(self):
+        """ Closes the CSV file """
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = None
+            self.csv_writer = None
+
+
+def format_optional(value: float, format: str) -> str:
+    """ Formats an optional value of the CSV file, NaN meaning no value """
+    return "" if math.isnan(value) else format.format(value)
+
+
+def format_timestamp(timestamp: float) -> str:
+    """ Formats a POSIX timestamp in a YYYY-MM-DD_HH-MM-SS format, as get_day_and_time() does """
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d_%H-%M-%S")
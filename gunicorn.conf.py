@@ -0,0 +1,37 @@
+# Gunicorn settings, see https://docs.gunicorn.org/en/stable/settings.html
+# The requests are served by threads, so that an open preview stream or a slow page doesn't make the other pages wait.
+# With the camera_service setting set to process, the camera is owned by a dedicated camera service process started
+# here, and the web server can run several processes. Otherwise a single process owns the camera.
+import os
+import secrets
+
+from camera_client import AUTHKEY_VARIABLE
+from settings import Settings
+
+settings = Settings()
+settings.load_from_json()
+camera_service_process = None
+
+bind = "0.0.0.0:8000"
+workers = settings.web_workers if settings.camera_service == "process" else 1
+worker_class = "gthread"
+threads = 16
+
+
+def on_starting(server):
+    """ Starts the camera service before the web workers, which inherit the key to authenticate with """
+    global camera_service_process
+    if settings.camera_service != "process":
+        return
+    from camera_service import start_service_process
+    os.environ[AUTHKEY_VARIABLE] = secrets.token_hex(16)
+    camera_service_process = start_service_process(
+        settings.camera_socket, os.environ[AUTHKEY_VARIABLE].encode())
+    server.log.info("Camera service started, pid %s", camera_service_process.pid)
+
+
+def on_exit(server):
+    """ Stops the camera service """
+    if camera_service_process is not None:
+        camera_service_process.terminate()
+        camera_service_process.join(10)
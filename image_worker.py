@@ -0,0 +1,253 @@
+from collections import deque
+from concurrent.futures import Future
+import itertools
+import logging
+import multiprocessing
+import threading
+import time
+from typing import Dict
+
+import numpy as np
+from PIL import Image
+
+from metering import Meter
+from shared_frames import SharedFrame
+from utils import array_brightness, resize_to_fit
+
+logger = logging.getLogger(__name__)
+
+# The maximum time to wait for the brightness of a frame, in seconds, the workers are restarted past it
+BRIGHTNESS_TIMEOUT = 10
+
+
+def worker_loop(jobs, results):
+    """
+    Processes the frames received through the jobs queue - is meant to be ran in a dedicated process.
+    For each frame, the brightness is sent back as soon as it's known, then the JPEG and the thumbnail are saved
+    and the time each stage took is sent back.
+    Arguments:
+    jobs - the queue of the frames to process
+    results - the queue the results are sent back through
+    """
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, frame, jpg_path, thumbnail_path, thumbnail_size, meter = job
+        try:
+            timings = {}
+            start = time.perf_counter()
+            array = frame.array()
+            if array.shape[-1] == 4:
+                array = array[..., :3]
+            photo_brightness = meter.brightness(
+                array) if meter is not None else array_brightness(array)
+            timings["brightness"] = time.perf_counter() - start
+            results.put((job_id, "brightness", photo_brightness))
+            if jpg_path is not None or thumbnail_path is not None:
+                image = Image.fromarray(array)
+                if jpg_path is not None:
+                    start = time.perf_counter()
+                    image.save(jpg_path, quality=90)
+                    timings["save_jpg"] = time.perf_counter() - start
+                if thumbnail_path is not None:
+                    start = time.perf_counter()
+                    resize_to_fit(image, thumbnail_size,
+                                  thumbnail_size).save(thumbnail_path)
+                    timings["make_thumbnail"] = time.perf_counter() - start
+                del image
+            del array
+            results.put((job_id, "done", timings))
+        except Exception as e:
+            results.put((job_id, "error", str(e)))
+        finally:
+            frame.close()
+
+
+class FrameJob:
+    """ A frame being processed by the image worker """
+
+    def __init__(self, job_id: int, frame: SharedFrame, owner: int = 0):
+        self.job_id = job_id
+        self.frame = frame
+        # The camera the frame comes from
+        self.owner = owner
+        # Set as soon as the brightness is known
+        self.brightness = Future()
+        # Set once the JPEG and the thumbnail are saved, with the time each stage took in seconds
+        self.done = Future()
+
+
+class ImageWorker:
+    """
+    A pool of processes computing the brightness, saving the JPEG and making the thumbnail of the captured frames,
+    so that this work doesn't compete for the GIL with the web server. The frames are handed through shared memory.
+    The pool can be shared by several cameras: each camera has its own queue, and the queues are served in turn with no
+    more frames handed to the processes than there are processes, so that a camera can't delay the others' frames.
+    """
+
+    def __init__(self, workers: int = 2):
+        """
+        Arguments:
+        workers - the number of processes
+        """
+        self.workers = workers
+        self.context = multiprocessing.get_context("spawn")
+        self.jobs = None
+        self.results = None
+        self.processes = []
+        self.dispatcher: threading.Thread = None
+        self.restarts = 0
+        self.pending: Dict[int, FrameJob] = {}
+        # The frames waiting for a process, per camera, and the order the cameras are served in
+        self.queued: Dict[int, deque] = {}
+        self.turns = deque()
+        self.in_flight = 0
+        self.job_ids = itertools.count()
+        self.lock = threading.Lock()
+        # Notified each time a job is done
+        self.idle = threading.Condition()
+
+    def start(self):
+        """ Starts the processes, done on first use """
+        with self.lock:
+            if self.processes:
+                return
+            self.jobs = self.context.Queue()
+            self.results = self.context.Queue()
+            for _ in range(self.workers):
+                process = self.context.Process(
+                    target=worker_loop, args=(self.jobs, self.results), daemon=True)
+                process.start()
+                self.processes.append(process)
+            self.dispatcher = threading.Thread(target=self.dispatch_results, args=(self.results,), daemon=True)
+            self.dispatcher.start()
+            self.feed()
+
+    def restart(self):
+        """
+        Replaces the processes, e.g. when one of them is stuck. The frames handed to them are lost: their futures
+        fail. The frames still queued are handed to the new processes.
+        """
+        with self.lock:
+            processes, results, dispatcher = self.processes, self.results, self.dispatcher
+        logger.warning("Restarting the image workers")
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(5)
+        if dispatcher is not None:
+            # Stops the dispatcher once it has handled the results already sent
+            results.put(None)
+            dispatcher.join(5)
+        with self.lock:
+            queued = {job[0] for queue in self.queued.values() for job in queue}
+            lost = [job for job_id, job in list(self.pending.items()) if job_id not in queued]
+            self.processes = []
+            self.in_flight = 0
+        error = RuntimeError("The image workers were restarted")
+        with self.idle:
+            for job in lost:
+                self.pending.pop(job.job_id, None)
+                try:
+                    job.frame.unlink()
+                except FileNotFoundError:
+                    pass
+                if not job.brightness.done():
+                    job.brightness.set_exception(error)
+                if not job.done.done():
+                    job.done.set_exception(error)
+            self.idle.notify_all()
+        self.restarts += 1
+        self.start()
+
+    def submit(self, array: np.ndarray, jpg_path: str = None, thumbnail_path: str = None, thumbnail_size: int = 400,
+               owner: int = 0, meter: Meter = None) -> FrameJob:
+        """
+        Hands a frame to the workers. The frame is copied once into shared memory so that the camera buffer can be released.
+        Arguments:
+        array - the frame as an RGB array, e.g. a mapped camera buffer
+        jpg_path - optional, the path of the JPEG file to save
+        thumbnail_path - optional, the path of the thumbnail to make
+        thumbnail_size - the maximum width and height of the thumbnail
+        owner - the index of the camera the frame comes from
+        meter - optional, the metering mode of the brightness, the whole frame is metered by default
+        Returns:
+        The FrameJob, holding the futures of the results.
+        """
+        self.start()
+        job = FrameJob(next(self.job_ids),
+                       SharedFrame.from_array(array), owner)
+        with self.lock:
+            self.pending[job.job_id] = job
+            if owner not in self.queued:
+                self.queued[owner] = deque()
+                self.turns.append(owner)
+            self.queued[owner].append((job.job_id, job.frame, jpg_path,
+                                       thumbnail_path, thumbnail_size, meter))
+            self.feed()
+        return job
+
+    def feed(self):
+        """ Hands the queued frames to the processes, one camera after the other - the lock must be held """
+        while self.in_flight < self.workers:
+            for _ in range(len(self.turns)):
+                owner = self.turns[0]
+                self.turns.rotate(-1)
+                if self.queued[owner]:
+                    self.jobs.put(self.queued[owner].popleft())
+                    self.in_flight += 1
+                    break
+            else:
+                return
+
+    def dispatch_results(self, results):
+        """
+        Sets the results received from the workers on the jobs' futures - is meant to be ran in a thread
+        Arguments:
+        results - the queue the workers send the results through, None stops the thread
+        """
+        while True:
+            result = results.get()
+            if result is None:
+                return
+            job_id, kind, value = result
+            job = self.pending.get(job_id)
+            if job is None:
+                continue
+            if kind == "brightness":
+                job.brightness.set_result(value)
+                continue
+            job.frame.unlink()
+            with self.lock:
+                self.in_flight -= 1
+                self.feed()
+            if kind == "done":
+                job.done.set_result(value)
+            else:
+                logger.error("Error while processing a frame: " + value)
+                if not job.brightness.done():
+                    job.brightness.set_exception(RuntimeError(value))
+                job.done.set_exception(RuntimeError(value))
+            # Removed once its callbacks have ran, so that waiting until idle includes them
+            with self.idle:
+                del self.pending[job_id]
+                self.idle.notify_all()
+
+    def wait_until_idle(self, timeout: float, owner: int = None) -> bool:
+        """
+        Waits until all the submitted frames are processed.
+        Arguments:
+        timeout - the maximum time to wait, in seconds
+        owner - optional, only waits for the frames of this camera
+        Returns:
+        False if frames are still being processed after the timeout.
+        """
+        with self.idle:
+            return self.idle.wait_for(lambda: not any(owner is None or job.owner == owner
+                                                      for job in list(self.pending.values())), timeout)
+
+    def status(self):
+        """ Gets the status of the workers as a Dict to be serialized """
+        return {"workers": len(self.processes), "pending": len(self.pending), "restarts": self.restarts,
+                "queued": {owner: len(queue) for owner, queue in self.queued.items()}}
@@ -0,0 +1,427 @@
+"""
+Load and soak test for a running Lapsilapse server.
+
+Several clients request the pages in a loop while other clients keep the preview stream open, then the latency
+percentiles of each page and the gaps between the stream's frames are reported. Start a timelapse beforehand to check
+that the pages keep a bounded latency while it's capturing, or let the test start one with --timelapse.
+
+With --timelapse, the test also follows the timelapse as the Timelapse page does, and counts the photos taken later
+than their delay allows and the stream frames coming later than --frame-deadline. The resident memory of the server
+processes is sampled from /metrics all along, so that a long run, e.g. --duration 36000 for a night, shows its growth.
+The server can run on a Linux box without cameras, Picamera2 or libcamera, with "camera_backend": "fake" in its
+settings.json, see FakeCamera. Ran from the folder of the app, --check makes sure it does before a long run.
+
+Usage:
+python loadtest.py --url http://raspberrypi.local:8000 --duration 60 --clients 4 --streams 2
+python loadtest.py --check
+python loadtest.py --url http://localhost:8000 --duration 36000 --timelapse --photo-delay 10 --max-growth 64
+"""
+import argparse
+from datetime import datetime
+import http.client
+import json
+import os
+import re
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+
+PAGES = ["/gallery", "/timelapse-gallery",
+         "/update_timelapse", "/is_timelapse_ongoing"]
+# The timelapse started by --timelapse, the number of photos and their delay are set from the arguments
+TIMELAPSE_INPUT = {"startIso": 100, "minIso": 100, "maxIso": 800, "startExposureTime": 8000,
+                   "minExposureTime": 300, "maxExposureTime": 1000000, "priority": "iso", "wb": "auto",
+                   "file_format": "jpg"}
+# The metrics sampled to follow the memory of the server processes
+MEMORY_METRIC = re.compile(r"^(\w+_resident_bytes) (\d+(?:\.\d+)?)$", re.MULTILINE)
+# The links of the timelapses on the timelapse gallery page
+VIEW_LINK = re.compile(r"/timelapse-gallery/view/([\w.-]+)")
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """
+    Gets a percentile of a list of values, with the nearest-rank method
+    Arguments:
+    values - the values
+    percent - the percentile to get, from 0 to 100
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(percent / 100 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def check_fake_backend() -> bool:
+    """
+    Checks that the app imports and serves its pages and its preview stream with the fake backend, as if Picamera2 and
+    libcamera weren't installed. Is ran from the folder of the app, whose settings.json must use the fake backend.
+    Returns:
+    True if the app imports and serves every page.
+    """
+    # Any import of these modules fails, as on a box where they aren't installed
+    for module in ("picamera2", "libcamera"):
+        sys.modules[module] = None
+    try:
+        import server
+    except ImportError as e:
+        print("The app doesn't import without Picamera2 and libcamera: " + str(e))
+        return False
+    if server.settings.camera_backend != "fake":
+        print("The settings.json of the app doesn't use the fake backend")
+        return False
+    client = server.app.test_client()
+    success = True
+    for path in ["/", "/timelapse", "/cameras", "/metrics"] + PAGES:
+        status = client.get(path).status_code
+        print(f"{path:<28}{status:>8}")
+        success = success and status < 400
+    response = client.get("/video_feed")
+    frame = next(iter(response.response), b"")
+    print(f"{'/video_feed':<28}{response.status_code:>8}  first frame: {len(frame)} bytes")
+    return success and b"image/jpeg" in frame
+
+
+class LoadTest:
+    """ Runs page clients and stream clients against a server and collects their latencies """
+
+    def __init__(self, url: str, duration: float, clients: int, streams: int, frame_deadline: float = 5.0,
+                 sample_interval: float = 60.0):
+        """
+        Arguments:
+        url - the base URL of the server
+        duration - the duration of the test, in seconds
+        clients - the number of clients per page
+        streams - the number of clients keeping the preview stream open
+        frame_deadline - the gap between two stream frames counted as a missed frame, in seconds
+        sample_interval - the time between two samples of the memory of the server processes, in seconds
+        """
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.duration = duration
+        self.clients = clients
+        self.streams = streams
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.deadline = 0.0
+        self.pages = list(PAGES)
+        self.frame_deadline = frame_deadline
+        self.sample_interval = sample_interval
+        # The stream frames later than frame_deadline, and the timelapse photos later than their delay
+        self.missed_frames = 0
+        self.late_photos = 0
+        self.photos_followed = 0
+        # The delay between the photos of the timelapse started by the test, None if it didn't start one
+        self.photo_delay: float = None
+        # The samples of the memory of the server processes: elapsed time, metric name and bytes
+        self.memory_samples: List[Tuple[float, str, float]] = []
+
+    def get(self, path: str, timeout: float = 30) -> Tuple[int, bytes]:
+        """ Requests a path on a new connection and returns the status and the body """
+        connection = http.client.HTTPConnection(
+            self.host, self.port, timeout=timeout)
+        try:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def add_timelapse_view(self, timelapse: str = None):
+        """
+        Adds the page of a finished timelapse to the pages requested, the first one of the gallery by default
+        Arguments:
+        timelapse - optional, the folder of the timelapse
+        """
+        if timelapse is None:
+            try:
+                status, body = self.get("/timelapse-gallery")
+            except (OSError, http.client.HTTPException):
+                return
+            match = VIEW_LINK.search(body.decode(errors="replace"))
+            if status >= 400 or match is None:
+                print("No timelapse in the gallery, its view page isn't requested")
+                return
+            timelapse = match.group(1)
+        self.pages.append("/timelapse-gallery/view/" + timelapse)
+
+    def start_timelapse(self, photo_delay: float) -> bool:
+        """
+        Starts a timelapse lasting as long as the test
+        Arguments:
+        photo_delay - the delay between two photos, in seconds
+        Returns:
+        True if the timelapse started.
+        """
+        input = dict(TIMELAPSE_INPUT, photos_delay=int(photo_delay),
+                     photos_number=max(1, int(self.duration // photo_delay)))
+        connection = http.client.HTTPConnection(
+            self.host, self.port, timeout=30)
+        try:
+            connection.request("POST", "/start_timelapse", json.dumps(input),
+                               {"Content-Type": "application/json"})
+            result = json.loads(connection.getresponse().read())
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            print("Unable to start the timelapse: " + str(e))
+            return False
+        finally:
+            connection.close()
+        if not result.get("started"):
+            print("The timelapse didn't start: " + str(result.get("error", "a timelapse is ongoing")))
+            return False
+        self.photo_delay = photo_delay
+        return True
+
+    def stop_timelapse(self):
+        """ Stops the timelapse started by the test """
+        try:
+            self.get("/stop_timelapse")
+        except (OSError, http.client.HTTPException) as e:
+            print("Unable to stop the timelapse: " + str(e))
+
+    def timelapse_client(self):
+        """
+        Follows the timelapse as the Timelapse page does, only asking for the new photos, and counts the photos taken
+        later than their delay allows - is meant to be ran in a thread
+        """
+        since = 0
+        thumbs_since = 0
+        last_time = None
+        # The time it takes to take and process a photo comes on top of the delay
+        allowed = self.photo_delay + max(2.0, self.photo_delay * 0.5)
+        while time.monotonic() < self.deadline:
+            path = "/update_timelapse?since=" + str(since) + "&thumbs_since=" + str(thumbs_since)
+            start = time.perf_counter()
+            try:
+                status, body = self.get(path)
+                data = json.loads(body)
+            except (OSError, http.client.HTTPException, ValueError):
+                self.record("/update_timelapse (follow)")
+                time.sleep(1)
+                continue
+            if status >= 400:
+                self.record("/update_timelapse (follow)")
+            else:
+                self.record("/update_timelapse (follow)", time.perf_counter() - start)
+            for photo in data.get("photos", []):
+                since = max(since, photo["number"])
+                taken = datetime.strptime(photo["time"], "%Y-%m-%d_%H-%M-%S")
+                with self.lock:
+                    self.photos_followed += 1
+                    if last_time is not None and (taken - last_time).total_seconds() > allowed:
+                        self.late_photos += 1
+                last_time = taken
+            for thumb in data.get("thumbs", []):
+                thumbs_since = max(thumbs_since, thumb["number"])
+            time.sleep(1)
+
+    def memory_sampler(self):
+        """ Samples the memory of the server processes from /metrics - is meant to be ran in a thread """
+        start = time.monotonic()
+        while True:
+            try:
+                status, body = self.get("/metrics")
+                if status < 400:
+                    with self.lock:
+                        for name, value in MEMORY_METRIC.findall(body.decode(errors="replace")):
+                            self.memory_samples.append((time.monotonic() - start, name, float(value)))
+            except (OSError, http.client.HTTPException):
+                self.record("/metrics")
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(self.sample_interval, remaining))
+
+    def record(self, name: str, latency: float = None):
+        """ Records a latency, or an error if the latency is None """
+        with self.lock:
+            if latency is None:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            else:
+                self.latencies.setdefault(name, []).append(latency)
+
+    def page_client(self, path: str):
+        """ Requests a page in a loop, on a keep-alive connection - is meant to be ran in a thread """
+        connection = http.client.HTTPConnection(
+            self.host, self.port, timeout=30)
+        while time.monotonic() < self.deadline:
+            start = time.perf_counter()
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 400:
+                    self.record(path)
+                else:
+                    self.record(path, time.perf_counter() - start)
+            except (OSError, http.client.HTTPException):
+                self.record(path)
+                connection.close()
+                connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=30)
+            time.sleep(0.1)
+        connection.close()
+
+    def stream_client(self):
+        """ Keeps the preview stream open and measures the gaps between its frames - is meant to be ran in a thread """
+        connection = http.client.HTTPConnection(
+            self.host, self.port, timeout=30)
+        start = time.perf_counter()
+        try:
+            connection.request("GET", "/video_feed")
+            response = connection.getresponse()
+            last_frame = None
+            buffer = b""
+            while time.monotonic() < self.deadline:
+                chunk = response.read1(65536)
+                if not chunk:
+                    break
+                buffer += chunk
+                while b"--frame" in buffer:
+                    buffer = buffer[buffer.index(b"--frame") + 7:]
+                    now = time.perf_counter()
+                    if last_frame is None:
+                        self.record("/video_feed first frame", now - start)
+                    else:
+                        self.record("/video_feed frame gap", now - last_frame)
+                        if now - last_frame > self.frame_deadline:
+                            with self.lock:
+                                self.missed_frames += 1
+                    last_frame = now
+        except (OSError, http.client.HTTPException):
+            self.record("/video_feed first frame")
+        finally:
+            connection.close()
+
+    def run(self):
+        """ Runs the test until its duration is over """
+        self.deadline = time.monotonic() + self.duration
+        threads = [threading.Thread(target=self.memory_sampler, daemon=True)]
+        if self.photo_delay is not None:
+            threads.append(threading.Thread(
+                target=self.timelapse_client, daemon=True))
+        for path in self.pages:
+            for _ in range(self.clients):
+                threads.append(threading.Thread(
+                    target=self.page_client, args=(path,), daemon=True))
+        for _ in range(self.streams):
+            threads.append(threading.Thread(
+                target=self.stream_client, daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(self.duration + 30)
+
+    def report(self, max_p99: float) -> bool:
+        """
+        Prints the latency percentiles of each page.
+        Arguments:
+        max_p99 - the maximum 99th percentile allowed, in seconds
+        Returns:
+        True if all the pages are within the bound and without errors.
+        """
+        success = True
+        names = sorted(set(self.latencies) | set(self.errors))
+        width = max([28] + [len(name) + 2 for name in names])
+        print(f"{'request':<{width}}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for name in names:
+            values = self.latencies.get(name, [])
+            errors = self.errors.get(name, 0)
+            p99 = percentile(values, 99)
+            print(f"{name:<{width}}{len(values):>8}{errors:>8}{percentile(values, 50) * 1000:>10.1f}"
+                  f"{percentile(values, 95) * 1000:>10.1f}{p99 * 1000:>10.1f}{max(values, default=0) * 1000:>10.1f}")
+            if errors > 0 or p99 > max_p99:
+                success = False
+        print(f"stream frames later than {self.frame_deadline:.1f} s: {self.missed_frames}")
+        if self.photo_delay is not None:
+            print(f"timelapse photos followed: {self.photos_followed}, later than their delay: {self.late_photos}")
+            if self.late_photos > 0:
+                success = False
+        return success
+
+    def report_memory(self, max_growth: float = None) -> bool:
+        """
+        Prints the memory of each server process over the test.
+        Arguments:
+        max_growth - optional, the maximum growth allowed, in MB
+        Returns:
+        True if no process grew more than allowed.
+        """
+        success = True
+        names = sorted({name for _, name, _ in self.memory_samples})
+        if not names:
+            print("No memory metric sampled")
+            return success
+        print(f"{'process memory':<36}{'samples':>8}{'first MB':>10}{'last MB':>10}{'max MB':>10}{'growth MB':>11}"
+              f"{'MB/h':>8}")
+        for name in names:
+            samples = [(elapsed, value) for elapsed, sample_name, value in self.memory_samples if sample_name == name]
+            first_elapsed, first = samples[0]
+            last_elapsed, last = samples[-1]
+            growth = (last - first) / 1024 / 1024
+            hours = (last_elapsed - first_elapsed) / 3600
+            rate = growth / hours if hours > 0 else 0.0
+            print(f"{name:<36}{len(samples):>8}{first / 1024 / 1024:>10.1f}{last / 1024 / 1024:>10.1f}"
+                  f"{max(value for _, value in samples) / 1024 / 1024:>10.1f}{growth:>11.1f}{rate:>8.1f}")
+            if max_growth is not None and growth > max_growth:
+                success = False
+        return success
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load test for a running Lapsilapse server.")
+    parser.add_argument("--url", default="http://localhost:8000",
+                        help="the base URL of the server")
+    parser.add_argument("--duration", type=float, default=60,
+                        help="the duration of the test, in seconds")
+    parser.add_argument("--clients", type=int, default=4,
+                        help="the number of clients per page")
+    parser.add_argument("--streams", type=int, default=2,
+                        help="the number of clients keeping the preview stream open")
+    parser.add_argument("--max-p99", type=float, default=2.0,
+                        help="the maximum 99th percentile latency allowed, in seconds")
+    parser.add_argument("--check", action="store_true",
+                        help="check that the app in the current folder runs with the fake backend, then exit")
+    parser.add_argument("--timelapse", action="store_true",
+                        help="start a timelapse lasting as long as the test and follow it")
+    parser.add_argument("--photo-delay", type=float, default=5,
+                        help="the delay between two photos of the timelapse, in seconds")
+    parser.add_argument("--view", default=None,
+                        help="the timelapse whose page is requested, the first one of the gallery by default")
+    parser.add_argument("--frame-deadline", type=float, default=None,
+                        help="the gap between two stream frames counted as a missed frame, in seconds, "
+                             "twice the photo delay with --timelapse and 5 otherwise")
+    parser.add_argument("--sample-interval", type=float, default=60,
+                        help="the time between two samples of the memory of the server processes, in seconds")
+    parser.add_argument("--max-growth", type=float, default=None,
+                        help="the maximum memory growth allowed for each server process, in MB")
+    args = parser.parse_args()
+    if args.check:
+        success = check_fake_backend()
+        sys.stdout.flush()
+        # The app's threads and worker processes aren't stopped
+        os._exit(0 if success else 1)
+    frame_deadline = args.frame_deadline
+    if frame_deadline is None:
+        # While a timelapse is ongoing, the stream shows its thumbnails, one per photo
+        frame_deadline = 2 * args.photo_delay if args.timelapse else 5.0
+    load_test = LoadTest(args.url, args.duration, args.clients, args.streams, frame_deadline,
+                         min(args.sample_interval, args.duration / 2))
+    load_test.add_timelapse_view(args.view)
+    if args.timelapse and not load_test.start_timelapse(args.photo_delay):
+        sys.exit(1)
+    load_test.run()
+    if args.timelapse:
+        load_test.stop_timelapse()
+    success = load_test.report(args.max_p99)
+    success = load_test.report_memory(args.max_growth) and success
+    sys.exit(0 if success else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import atexit
+import copy
+import logging
+import logging.handlers
+import os
+import queue
+from typing import Dict
+
+from utils import get_day
+
+# The format of the log lines, the name is the module the line comes from
+LOG_FORMAT = "%(asctime)s :: %(levelname)s :: %(name)s :: %(message)s"
+
+
+class DailyFileHandler(logging.FileHandler):
+    """
+    Writes the logs into one file per day, e.g. logs/2024-06-21.log, switching to the next file at midnight.
+    The files are only appended to and never renamed, so that several processes can share them.
+    """
+
+    def __init__(self, folder: str):
+        """
+        Arguments:
+        folder - the folder of the log files
+        """
+        self.folder = folder
+        self.day = get_day()
+        super().__init__(self.day_path(), delay=True)
+
+    def day_path(self) -> str:
+        return os.path.join(self.folder, self.day + ".log")
+
+    def emit(self, record: logging.LogRecord):
+        day = get_day()
+        if day != self.day:
+            self.day = day
+            self.close()
+            self.baseFilename = os.path.abspath(self.day_path())
+        super().emit(record)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands the log records to the listener thread without formatting them: the message is only built from its
+    arguments by the listener, off the calling thread, e.g. the capture thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # A copy, so that the other handlers of the record see it unchanged
+        return copy.copy(record)
+
+
+def setup_logging(level: str = "INFO", levels: Dict[str, str] = None, folder: str = "./logs") -> logging.handlers.QueueListener:
+    """
+    Sends the logs of the process to the daily log files through a queue, so that logging never waits for the SD card.
+    The records are written by a listener thread, stopped and flushed when the process exits.
+    Arguments:
+    level - the level of the logs, e.g. INFO
+    levels - optional, the levels of some modules, e.g. {"timelapse": "WARNING", "uploader": "DEBUG"}
+    folder - the folder of the log files
+    Returns:
+    The listener writing the records.
+    """
+    os.makedirs(folder, exist_ok=True)
+    file_handler = DailyFileHandler(folder)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+    for name, module_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
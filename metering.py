@@ -0,0 +1,128 @@
+from functools import lru_cache
+import logging
+import math
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# The metering modes:
+# - average - the whole frame, as before the metering modes
+# - center - center-weighted, the weight decreases away from the center
+# - spot - a disk at the center of the frame
+# - roi - a custom region of interest, as a polygon
+# - lower - the lower part of the frame only, e.g. to exclude the sky
+METERING_MODES = ("average", "center", "spot", "roi", "lower")
+# The spread of the center-weighted mask, as a fraction of the frame's width and height
+CENTER_SIGMA = 0.25
+# The radius of the spot, as a fraction of the frame's smallest side
+SPOT_RADIUS = 0.1
+# Where the lower region starts, as a fraction of the frame's height from the top
+LOWER_REGION_START = 1 / 3
+
+
+def polygon_mask(polygon: Sequence[Tuple[float, float]], height: int, width: int) -> np.ndarray:
+    """
+    Computes which pixels are inside a polygon, with the even-odd rule.
+    Arguments:
+    polygon - the points of the polygon, as (x, y) fractions of the frame's width and height
+    height, width - the size of the mask
+    Returns:
+    The mask, True inside the polygon.
+    """
+    y, x = np.mgrid[0:height, 0:width].astype("float32")
+    x = (x + 0.5) / width
+    y = (y + 0.5) / height
+    inside = np.zeros((height, width), dtype=bool)
+    for i in range(len(polygon)):
+        x1, y1 = polygon[i]
+        x2, y2 = polygon[i - 1]
+        if y1 == y2:
+            continue
+        crosses = (y1 > y) != (y2 > y)
+        intersection_x = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < intersection_x)
+    return inside
+
+
+@lru_cache(maxsize=16)
+def metering_mask(mode: str, height: int, width: int, roi: Tuple[Tuple[float, float], ...] = None) -> np.ndarray:
+    """
+    Computes the weights of the pixels for a metering mode, once per mode and size.
+    Arguments:
+    mode - the metering mode, see METERING_MODES
+    height, width - the size of the frames at the metering resolution
+    roi - the polygon of the roi mode, see polygon_mask
+    Returns:
+    The weights, flattened and summing to 1.
+    """
+    y, x = np.mgrid[0:height, 0:width].astype("float32")
+    # Distances from the center, as fractions of the width and the height
+    dx = (x + 0.5) / width - 0.5
+    dy = (y + 0.5) / height - 0.5
+    if mode == "center":
+        weights = np.exp(-(dx ** 2 + dy ** 2) / (2 * CENTER_SIGMA ** 2))
+    elif mode == "spot":
+        radius = SPOT_RADIUS * min(height, width)
+        weights = ((dx * width) ** 2 + (dy * height) ** 2 <= radius ** 2).astype("float32")
+    elif mode == "roi" and roi:
+        weights = polygon_mask(roi, height, width).astype("float32")
+    elif mode == "lower":
+        weights = (y >= LOWER_REGION_START * height).astype("float32")
+    else:
+        weights = np.ones((height, width), dtype="float32")
+    total = weights.sum()
+    if total == 0:
+        # e.g. a region of interest smaller than a pixel at the metering resolution
+        logger.warning("Empty metering mask for the " + mode + " mode, the whole frame is metered")
+        weights = np.ones((height, width), dtype="float32")
+        total = weights.sum()
+    weights = (weights / total).ravel()
+    weights.flags.writeable = False
+    return weights
+
+
+class Meter:
+    """
+    Measures the brightness of the frames with a metering mode. Each mode is a weight mask computed once at the metering
+    resolution, then applied with a single dot product per frame.
+    Meters are small, so that they can be sent to the image worker's processes with each frame.
+    """
+
+    def __init__(self, mode: str = "average", roi: List[Tuple[float, float]] = None, step: int = 4):
+        """
+        Arguments:
+        mode - the metering mode, see METERING_MODES
+        roi - the polygon of the roi mode, as (x, y) fractions of the frame's width and height
+        step - only one pixel every step pixels, on both axes, is metered
+        """
+        if mode not in METERING_MODES:
+            logger.warning("Unknown metering mode: " + str(mode) + ", falling back to average")
+            mode = "average"
+        self.roi = tuple((float(x), float(y)) for x, y in roi) if roi else None
+        if mode == "roi" and (self.roi is None or len(self.roi) < 3):
+            logger.warning("The region of interest needs at least 3 points, falling back to average")
+            mode = "average"
+        self.mode = mode
+        self.step = step
+
+    def brightness(self, array: np.ndarray) -> float:
+        """
+        Gets the brightness of a frame, with the same scale as utils.brightness
+        Arguments:
+        array - the frame as an RGB array
+        """
+        small = array[::self.step, ::self.step, :3]
+        height, width = small.shape[:2]
+        weights = metering_mask(self.mode, height, width, self.roi)
+        r, g, b = weights @ small.reshape(-1, 3)
+        return math.sqrt(0.241*(r**2) + 0.691*(g**2) + 0.068*(b**2))
+
+    def image_brightness(self, image) -> float:
+        """
+        Gets the brightness of an image
+        Arguments:
+        image - the PIL image
+        """
+        return self.brightness(np.asarray(image.convert("RGB")))
@@ -0,0 +1,191 @@
+from contextlib import contextmanager
+import csv
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histograms' buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """ Cumulative histogram of durations, as exposed to Prometheus """
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """
+        Adds a value to the histogram.
+        Arguments:
+        value - the duration, in seconds
+        """
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+def render_metrics(metrics_list: List["Metrics"]) -> str:
+    """
+    Gets the metrics of several Metrics in the Prometheus text format, e.g. of each camera. The values of a metric
+    are rendered in a single family, told apart by their labels.
+    Arguments:
+    metrics_list - the Metrics, with the same prefix
+    """
+    families: Dict[str, Tuple[str, str, List[str]]] = {}
+    for metrics in metrics_list:
+        for name, metric_type, help, samples in metrics.families():
+            if name not in families:
+                families[name] = (metric_type, help, [])
+            families[name][2].extend(samples)
+    lines = []
+    for name, (metric_type, help, samples) in families.items():
+        lines.append("# HELP " + name + " " + help)
+        lines.append("# TYPE " + name + " " + metric_type)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+class Metrics:
+    """
+    Times the stages of the capture hot path. The durations are aggregated into one histogram per stage, and can also
+    be recorded as a CSV file, e.g. alongside the frames of a timelapse.
+    """
+
+    def __init__(self, prefix: str = "lapsilapse", labels: Dict[str, str] = None,
+                 stage_family: str = "stage_duration_seconds"):
+        """
+        Arguments:
+        prefix - the prefix of the names of the metrics
+        labels - optional, the labels added to all the values, e.g. {"camera": "1"}
+        stage_family - the name of the histograms of the stages, without the prefix
+        """
+        self.prefix = prefix
+        self.labels = labels or {}
+        self.stage_family = stage_family
+        self.histograms: Dict[str, Histogram] = {}
+        self.callbacks: List[Tuple[str, str, str, Callable]] = []
+        self.lock = threading.Lock()
+        self.recording_file = None
+        self.recording_writer = None
+
+    @contextmanager
+    def span(self, stage: str, photo: int = None):
+        """
+        Times the code ran within the context.
+        Arguments:
+        stage - the name of the stage
+        photo - optional, the number of the timelapse photo, to record the duration in the CSV file
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, photo)
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Times a startup phase, the duration is logged and added to the startup_<name> stage.
+        Arguments:
+        name - the name of the phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            logger.info("Startup phase %s took %.1f ms", name, seconds * 1000)
+            self.observe("startup_" + name, seconds)
+
+    def observe(self, stage: str, seconds: float, photo: int = None):
+        """
+        Adds a duration measured elsewhere, e.g. in a worker process.
+        Arguments:
+        stage - the name of the stage
+        seconds - the duration
+        photo - optional, the number of the timelapse photo, to record the duration in the CSV file
+        """
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+            if photo is not None and self.recording_writer is not None:
+                self.recording_writer.writerow(
+                    [photo, stage, "{:.6f}".format(seconds)])
+
+    def register(self, name: str, metric_type: str, help: str, callback: Callable):
+        """
+        Exposes a value read when the metrics are rendered, e.g. the size of a queue.
+        Arguments:
+        name - the name of the metric, without the prefix
+        metric_type - gauge or counter
+        help - the description of the metric
+        callback - the function returning the value
+        """
+        self.callbacks.append((name, metric_type, help, callback))
+
+    def start_recording(self, csv_path: str):
+        """
+        Starts recording the durations of the timelapse photos into a CSV file.
+        Arguments:
+        csv_path - the path of the CSV file
+        """
+        with self.lock:
+            self.recording_file = open(csv_path, "a", newline="")
+            self.recording_writer = csv.writer(self.recording_file)
+            if self.recording_file.tell() == 0:
+                self.recording_writer.writerow(["photo", "stage", "seconds"])
+
+    def flush_recording(self):
+        """ Writes the recorded durations to the disk, e.g. after each photo """
+        with self.lock:
+            if self.recording_file is not None:
+                self.recording_file.flush()
+
+    def stop_recording(self):
+        """ Stops recording the durations and closes the CSV file """
+        with self.lock:
+            if self.recording_file is not None:
+                self.recording_file.close()
+            self.recording_file = None
+            self.recording_writer = None
+
+    def label_text(self, **labels) -> str:
+        """ Gets the labels of a value, after the ones of the Metrics, e.g. camera="1",stage="capture" """
+        return ",".join(f'{key}="{value}"' for key, value in {**self.labels, **labels}.items())
+
+    def families(self) -> List[Tuple[str, str, str, List[str]]]:
+        """ Gets the metrics as a list of families: their name, type, description and lines of values """
+        families = []
+        name = self.prefix + "_" + self.stage_family
+        with self.lock:
+            # Skipped when empty, e.g. in a web server process when the camera is owned by the camera service
+            if self.histograms:
+                samples = []
+                for stage, histogram in sorted(self.histograms.items()):
+                    for bound, bucket_count in zip(BUCKETS, histogram.bucket_counts):
+                        samples.append(f'{name}_bucket{{{self.label_text(stage=stage, le=bound)}}} {bucket_count}')
+                    samples.append(f'{name}_bucket{{{self.label_text(stage=stage, le="+Inf")}}} {histogram.count}')
+                    samples.append(f'{name}_sum{{{self.label_text(stage=stage)}}} {histogram.sum}')
+                    samples.append(f'{name}_count{{{self.label_text(stage=stage)}}} {histogram.count}')
+                families.append((name, "histogram", "Time spent in each stage of the capture hot path and of the startup.", samples))
+        for metric_name, metric_type, help, callback in self.callbacks:
+            full_name = self.prefix + "_" + metric_name
+            labels = self.label_text()
+            families.append((full_name, metric_type, help,
+                             [full_name + ("{" + labels + "}" if labels else "") + " " + str(callback())]))
+        return families
+
+    def render(self) -> str:
+        """ Gets the metrics in the Prometheus text format """
+        return render_metrics([self])
@@ -1,7 +1,11 @@
 from collections import defaultdict
+from contextlib import contextmanager
+import fcntl
 import json
 import os
-from typing import Dict, List
+import tempfile
+import threading
+from typing import Dict, List, Set
 
 
 class Photo:
@@ -65,38 +69,126 @@ class PhotoRepository:
     def __init__(self, repository: str) -> None:
         self.repository: str = repository
         self.photos: Dict[str, Photo] = {}  # Maps photo names to Photo objects
+        self.lock = threading.RLock()  # The photos are added and removed from several threads
+        # The inode and modification time of the JSON file when it was last read or written, to pick up the changes
+        # made by the other web server processes - each write replaces the file, so the inode always changes
+        self.json_version = None
+        # The lock file held by update() across the web server processes, and how many times it's held by this one
+        self.lock_file = None
+        self.lock_depth = 0
+
+    def json_path(self) -> str:
+        """Gets the path of the JSON file the photos are saved in."""
+        return os.path.join(self.repository, "photos.json")
+
+    @contextmanager
+    def update(self):
+        """
+        Holds the photos across the threads and the web server processes while they're read, modified and saved, so
+        that the changes made by the other processes at the same time aren't lost. The photos are refreshed first.
+        """
+        with self.lock:
+            if self.lock_depth == 0:
+                os.makedirs(self.repository, exist_ok=True)
+                self.lock_file = open(self.json_path() + ".lock", "a")
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                self.refresh()
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0:
+                    # Closing the file releases the lock
+                    self.lock_file.close()
+                    self.lock_file = None
+
+    def refresh(self) -> None:
+        """Reloads the photos if the JSON file has been written by another process since it was last read."""
+        with self.lock:
+            try:
+                stat = os.stat(self.json_path())
+            except FileNotFoundError:
+                return
+            version = (stat.st_ino, stat.st_mtime_ns)
+            if version == self.json_version:
+                return
+            with open(self.json_path(), "r") as f:
+                data = json.load(f)
+            self.photos = {name: Photo.from_dict(photo_dict)
+                           for name, photo_dict in data.items()}
+            self.json_version = version
 
     def add_photo(self, photo: Photo) -> None:
         """Adds a photo to the directory. Overwrites any existing photo with the same name."""
-        self.photos[photo.name] = photo
-        self.save_to_json()
+        with self.update():
+            self.photos[photo.name] = photo
+            self.save_to_json()
+
+    def add_photos(self, photos: List[Photo]) -> None:
+        """Adds photos to the directory at once, e.g. the photos of a bracket, with a single write of the JSON file."""
+        with self.update():
+            for photo in photos:
+                self.photos[photo.name] = photo
+            self.save_to_json()
 
     def get_photo(self, name: str) -> Photo:
         """Retrieves a photo by its name."""
-        return self.photos.get(name)
+        with self.lock:
+            self.refresh()
+            return self.photos.get(name)
 
     def remove_photo(self, name: str) -> bool:
         """Removes a photo by its name. Returns True if photo was removed, False if not found."""
-        if name in self.photos:
-            del self.photos[name]
-            self.save_to_json()
-            return True
-        return False
+        with self.update():
+            if name in self.photos:
+                del self.photos[name]
+                self.save_to_json()
+                return True
+            return False
+
+    def remove_photos(self, names: List[str]) -> List[str]:
+        """Removes several photos by their names, saving the JSON file only once. Returns the names of the removed photos."""
+        with self.update():
+            removed = [name for name in names if name in self.photos]
+            for name in removed:
+                del self.photos[name]
+            if removed:
+                self.save_to_json()
+            return removed
 
     def save_to_json(self) -> None:
-        """Saves all photos to a JSON file within the directory."""
-        data = {name: photo.to_dict() for name, photo in self.photos.items()}
-        with open(os.path.join(self.repository, "photos.json"), "w") as f:
-            json.dump(data, f, indent=4)
+        """Saves all photos to a JSON file within the directory - is meant to be called within update()."""
+        with self.lock:
+            data = {name: photo.to_dict()
+                    for name, photo in self.photos.items()}
+            # Written to a temporary file of its own first, so that the other processes never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self.repository, prefix="photos.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f, indent=4)
+                os.replace(tmp_path, self.json_path())
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            stat = os.stat(self.json_path())
+            self.json_version = (stat.st_ino, stat.st_mtime_ns)
 
     def load_from_json(self) -> None:
         """Loads all photos from a JSON file within the directory."""
         json_path = os.path.join(self.repository, "photos.json")
-        if os.path.exists(json_path):
-            need_to_clean_json_file = self.load_from_json_and_check(
-                json_path)
-            if need_to_clean_json_file:
-                self.save_to_json()
+        with self.update():
+            if os.path.exists(json_path):
+                # Only the photos whose files exist are kept
+                self.photos = {}
+                need_to_clean_json_file = self.load_from_json_and_check(
+                    json_path)
+                if need_to_clean_json_file:
+                    self.save_to_json()
+                else:
+                    stat = os.stat(json_path)
+                    self.json_version = (stat.st_ino, stat.st_mtime_ns)
 
     def organize_photos_by_date(self) -> Dict[str, List[Dict]]:
         """
@@ -105,7 +197,10 @@ class PhotoRepository:
         Photos organized by date
         """
         photos_by_date = defaultdict(list)
-        for photo in self.photos.values():
+        with self.lock:
+            self.refresh()
+            photos = list(self.photos.values())
+        for photo in photos:
             photos_by_date[photo.capture_date].append(photo.to_dict())
 
         # Sort photos within each date and dates themselves (most recent first)
@@ -116,6 +211,7 @@ class PhotoRepository:
     def load_from_json_and_check(self, directory_path: str) -> bool:
         """
         Loads all photos from a JSON file within the directory.
+        The files are checked against one listing per folder rather than one stat per file.
         Arguments: 
         directory_path - the path of the directory
         Returns: 
@@ -124,11 +220,27 @@ class PhotoRepository:
         with open(directory_path, "r") as f:
             need_to_clean_json_file = False
             data = json.load(f)
+        listings: Dict[str, Set[str]] = {}
+
+        def file_exists(path: str) -> bool:
+            """ Checks if a file of the repository exists, listing its folder on first use """
+            full_path = os.path.join(self.repository, path)
+            folder, name = os.path.split(full_path)
+            if folder not in listings:
+                try:
+                    with os.scandir(folder) as entries:
+                        listings[folder] = {
+                            entry.name for entry in entries}
+                except OSError:
+                    listings[folder] = set()
+            return name in listings[folder]
+
+        with self.lock:
             for name, photo_dict in data.items():
                 photo = Photo.from_dict(photo_dict)
                 jpgExists = False
                 if photo.jpg_path != None:
-                    if os.path.exists(os.path.join(self.repository, photo.jpg_path)):
+                    if file_exists(photo.jpg_path):
                         jpgExists = True
                     else:
                         jpgExists = False
@@ -138,7 +250,7 @@ class PhotoRepository:
                     jpgExists = False
                 dngExists = False
                 if photo.dng_path != None:
-                    if os.path.exists(os.path.join(self.repository, photo.dng_path)):
+                    if file_exists(photo.dng_path):
                         dngExists = True
                     else:
                         dngExists = False
@@ -148,4 +260,4 @@ class PhotoRepository:
                     dngExists = False
                 if jpgExists or dngExists:
                     self.photos[name] = photo
-            return need_to_clean_json_file
+        return need_to_clean_json_file
@@ -0,0 +1,150 @@
+import io
+import logging
+import os
+import struct
+import threading
+from array import array
+from typing import Iterator
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# The frame rate of the preview clip
+PREVIEW_CLIP_FPS = 10
+# The name of the preview clip in the static folder of a timelapse
+PREVIEW_CLIP_NAME = "preview.avi"
+
+# The offsets of the header fields updated after each frame, see PreviewClip.write_header
+RIFF_SIZE_OFFSET = 4
+TOTAL_FRAMES_OFFSET = 48
+STREAM_LENGTH_OFFSET = 140
+MOVI_SIZE_OFFSET = 216
+MOVI_DATA_OFFSET = 224
+AVIF_HASINDEX = 0x10
+
+
+class PreviewClip:
+    """
+    A low resolution MJPEG AVI clip of a timelapse, made from its thumbnails while it's being taken.
+    Each thumbnail is appended as is and only a few fixed-size header fields are updated, so the earlier frames are
+    never re-encoded and each frame costs the same. The clip is playable at any time, the index is only written at the
+    end for the players which need it.
+    """
+
+    def __init__(self, path: str, fps: int = PREVIEW_CLIP_FPS):
+        """
+        Arguments:
+        path - the path of the clip, overwritten if it exists
+        fps - the frame rate of the clip
+        """
+        self.path = path
+        self.fps = fps
+        self.lock = threading.Lock()
+        self.file = None
+        # The offset of each frame from the movi list, and its size, for the index
+        self.offsets = array("I")
+        self.sizes = array("I")
+        self.movi_size = 4
+        self.closed = False
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def append(self, jpeg: bytes):
+        """
+        Appends a frame at the end of the clip.
+        Arguments:
+        jpeg - the frame, as a JPEG file
+        """
+        with self.lock:
+            if self.closed:
+                return
+            if self.file is None:
+                width, height = Image.open(io.BytesIO(jpeg)).size
+                self.file = open(self.path, "w+b")
+                self.write_header(width, height)
+            padding = b"\0" if len(jpeg) % 2 else b""
+            self.file.seek(0, os.SEEK_END)
+            self.offsets.append(self.movi_size)
+            self.sizes.append(len(jpeg))
+            self.file.write(b"00dc" + struct.pack("<I", len(jpeg)) + jpeg + padding)
+            self.movi_size += 8 + len(jpeg) + len(padding)
+            self.update_sizes()
+            self.file.flush()
+
+    def close(self):
+        """ Writes the index of the clip, no frame can be appended after """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.file is None:
+                return
+            self.file.seek(0, os.SEEK_END)
+            index = bytearray(b"idx1" + struct.pack("<I", 16 * len(self.offsets)))
+            for offset, size in zip(self.offsets, self.sizes):
+                index += b"00dc" + struct.pack("<III", 0x10, offset, size)
+            self.file.write(index)
+            self.file.seek(44)
+            self.file.write(struct.pack("<I", AVIF_HASINDEX))
+            self.update_sizes(len(index))
+            self.file.close()
+            logger.info("Preview clip written: " + self.path +
+                        ", " + str(len(self.offsets)) + " frames")
+
+    def write_header(self, width: int, height: int):
+        """
+        Writes the headers of an MJPEG AVI stream with no frame.
+        Arguments:
+        width, height - the size of the frames
+        """
+        buffer_size = width * height * 3
+        avih = struct.pack("<14I", 1000000 // self.fps, 0, 0, 0, 0, 0, 1, buffer_size, width, height, 0, 0, 0, 0)
+        strh = b"vidsMJPG" + struct.pack("<IHHIIIIIIiI4h", 0, 0, 0, 0, 1, self.fps, 0, 0, buffer_size, -1, 0,
+                                         0, 0, width, height)
+        strf = struct.pack("<IiiHH4sIiiII", 40, width, height, 1, 24, b"MJPG", buffer_size, 0, 0, 0, 0)
+        strl = b"strl" + b"strh" + struct.pack("<I", len(strh)) + strh + \
+            b"strf" + struct.pack("<I", len(strf)) + strf
+        hdrl = b"hdrl" + b"avih" + struct.pack("<I", len(avih)) + avih + \
+            b"LIST" + struct.pack("<I", len(strl)) + strl
+        header = b"RIFF" + struct.pack("<I", 0) + b"AVI " + b"LIST" + struct.pack("<I", len(hdrl)) + hdrl + \
+            b"LIST" + struct.pack("<I", self.movi_size) + b"movi"
+        assert len(header) == MOVI_DATA_OFFSET
+        self.file.write(header)
+
+    def update_sizes(self, index_size: int = 0):
+        """
+        Updates the number of frames and the sizes of the chunks in the headers.
+        Arguments:
+        index_size - the size of the index at the end of the clip
+        """
+        frames = struct.pack("<I", len(self.offsets))
+        for offset, value in ((RIFF_SIZE_OFFSET, struct.pack("<I", MOVI_DATA_OFFSET - 8 + self.movi_size - 4 + index_size)),
+                              (TOTAL_FRAMES_OFFSET, frames), (STREAM_LENGTH_OFFSET, frames),
+                              (MOVI_SIZE_OFFSET, struct.pack("<I", self.movi_size))):
+            self.file.seek(offset)
+            self.file.write(value)
+
+
+def read_frames(path: str) -> Iterator[bytes]:
+    """
+    Reads the frames of a preview clip, including one still being written: the frames appended while reading are read
+    as well, and a frame being appended ends the reading.
+    Arguments:
+    path - the path of the clip
+    Returns:
+    The frames, as JPEG files.
+    """
+    with open(path, "rb") as f:
+        f.seek(MOVI_DATA_OFFSET)
+        while True:
+            header = f.read(8)
+            if len(header) < 8 or header[:4] != b"00dc":
+                return
+            size = struct.unpack("<I", header[4:])[0]
+            jpeg = f.read(size)
+            if len(jpeg) < size:
+                return
+            if size % 2:
+                f.read(1)
+            yield jpeg
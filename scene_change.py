@@ -0,0 +1,73 @@
+import math
+
+import numpy as np
+
+
+def scene_change_score(previous: np.ndarray, current: np.ndarray) -> float:
+    """
+    Measures how much a scene changed between two frames, as the mean absolute difference of their luma planes.
+    Each plane is normalized by its mean first, so that an exposure change alone doesn't count as a scene change.
+    Arguments:
+    previous - the luma plane of the previous frame, see utils.decimated_luma
+    current - the luma plane of the current frame
+    Returns:
+    The score, 0 for identical frames, around 0.1 for a lot of motion.
+    """
+    previous_mean = max(float(previous.mean()), 1e-3)
+    current_mean = max(float(current.mean()), 1e-3)
+    return float(np.mean(np.abs(current / current_mean - previous / previous_mean)))
+
+
+class AdaptiveInterval:
+    """
+    Adapts the interval between the photos of a timelapse to the scene: the interval is shortened when the scene
+    changes fast and lengthened when it's static, within bounds. Near-duplicate photos can also be skipped.
+    """
+
+    # Below this score the scene is static, the interval is lengthened
+    LOW_SCORE = 0.02
+    # Above this score the scene changes fast, the interval is shortened
+    HIGH_SCORE = 0.08
+    # Below this score the photo is a near-duplicate of the last photo kept
+    DUPLICATE_SCORE = 0.005
+    # The interval is shortened fast to catch the motion, and lengthened slowly
+    SHORTEN_FACTOR = 0.5
+    LENGTHEN_FACTOR = 1.25
+
+    def __init__(self, min_interval: float, max_interval: float, interval: float, skip_duplicates: bool = False):
+        """
+        Arguments:
+        min_interval - the shortest interval allowed, in seconds
+        max_interval - the longest interval allowed, in seconds
+        interval - the interval to start with, in seconds
+        skip_duplicates - True to skip the photos which are near-duplicates of the last photo kept
+        """
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.interval = min(self.max_interval, max(min_interval, interval))
+        self.skip_duplicates = skip_duplicates
+        self.reference = None
+
+    def update(self, luma: np.ndarray):
+        """
+        Compares a photo to the last photo kept, and adapts the interval before the next photo.
+        Arguments:
+        luma - the luma plane of the photo, see utils.decimated_luma
+        Returns:
+        The scene change score, NaN for the first photo, and True if the photo should be skipped.
+        """
+        if self.reference is None or self.reference.shape != luma.shape:
+            self.reference = luma
+            return math.nan, False
+        score = scene_change_score(self.reference, luma)
+        if score > self.HIGH_SCORE:
+            self.interval = max(self.min_interval,
+                                self.interval * self.SHORTEN_FACTOR)
+        elif score < self.LOW_SCORE:
+            self.interval = min(self.max_interval,
+                                self.interval * self.LENGTHEN_FACTOR)
+        skip = self.skip_duplicates and score < self.DUPLICATE_SCORE
+        if not skip:
+            # Skipped photos aren't used as a reference, so that a slow drift ends up being kept
+            self.reference = luma
+        return score, skip
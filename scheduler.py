@@ -0,0 +1,205 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict
+
+from utils import get_cpu_temp
+
+logger = logging.getLogger(__name__)
+
+# The time a reading of the temperature and the load is reused (s)
+SAMPLE_INTERVAL = 2
+# The time the deferred jobs, and the jobs waiting for a photo, wait between two checks (s)
+DEFER_CHECK_INTERVAL = 2
+CAPTURE_CHECK_INTERVAL = 0.2
+# The pause before each job while the background work is slowed down (s)
+SLOW_PAUSE = 2
+# A deferred job runs anyway after waiting this long, so that the background work never stops for good - but still
+# not while a photo is being taken (s)
+MAX_DEFER = 600
+# The jobs already wait for the next timelapse photo this long before it's taken (s)
+CAPTURE_LEAD = 1
+
+
+class ThermalScheduler:
+    """
+    Decides when the background work may run, e.g. the deletions, the uploads or the spool conversions, so that the
+    timelapse frames are taken on time even in a hot enclosure. The jobs ask for their turn with wait_turn() and:
+    - run right away while the Pi is cool and idle - the normal level
+    - are paced while the temperature is above the soft threshold or the load is high - the slow level
+    - are deferred while the temperature is above the hard threshold, until it drops below the soft one - the defer level
+    The jobs also wait while a timelapse photo is being taken, and just before, see capture() and expect_capture(). When
+    the photos are taken in another process, e.g. the camera service, the scheduler asks it, see set_capture_source().
+    """
+
+    LEVELS = ("normal", "slow", "defer")
+
+    def __init__(self, soft_temp: float = 70, hard_temp: float = 80, max_load: float = 1.0):
+        """
+        Arguments:
+        soft_temp - the temperature the background work is slowed down from (°C)
+        hard_temp - the temperature the background work is deferred from (°C)
+        max_load - the load average per core the background work is slowed down from
+        """
+        self.soft_temp = soft_temp
+        self.hard_temp = hard_temp
+        self.max_load = max_load
+        self.lock = threading.Lock()
+        self.captures = 0
+        # The times the next photos of the timelapses are due, by camera
+        self.next_captures: Dict[int, float] = {}
+        self.sampled_at = None
+        self.cpu_temp = None
+        self.load = 0.0
+        self.level = "normal"
+        self.last_change = None
+        # The number of jobs deferred, slowed down or waiting for a capture, by job
+        self.decisions: Dict[str, Dict[str, int]] = {}
+        # Tells whether the process taking the photos is capturing, None when they're taken in this process
+        self.capture_source: Callable[[], bool] = None
+        self.remote_capturing = False
+        self.remote_checked_at = None
+
+    def set_capture_source(self, capture_source: Callable[[], bool]):
+        """
+        Makes the jobs wait for the photos taken in another process.
+        Arguments:
+        capture_source - tells whether a photo is being taken or is about to be, e.g. the camera service's is_capturing
+        """
+        self.capture_source = capture_source
+
+    @contextmanager
+    def capture(self):
+        """ Holds the background jobs back while a timelapse photo is being taken """
+        with self.lock:
+            self.captures += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.captures -= 1
+
+    def expect_capture(self, camera_num: int, delay: float):
+        """
+        Holds the background jobs back from CAPTURE_LEAD before the next timelapse photo.
+        Arguments:
+        camera_num - the index of the camera
+        delay - the time until the next photo (s), None once the timelapse is over
+        """
+        with self.lock:
+            if delay is None:
+                self.next_captures.pop(camera_num, None)
+            else:
+                self.next_captures[camera_num] = time.monotonic() + delay
+
+    def is_capturing(self) -> bool:
+        """ True while a timelapse photo is being taken or is about to be """
+        now = time.monotonic()
+        with self.lock:
+            if self.captures > 0 or any(0 <= due - now <= CAPTURE_LEAD for due in self.next_captures.values()):
+                return True
+            if self.capture_source is None:
+                return False
+            if self.remote_checked_at is not None and now - self.remote_checked_at < CAPTURE_CHECK_INTERVAL:
+                return self.remote_capturing
+            self.remote_checked_at = now
+        try:
+            capturing = bool(self.capture_source())
+        except Exception as e:
+            # e.g. the camera service is restarting, it isn't taking photos
+            logger.debug("Unable to get the capture state: %s", e)
+            capturing = False
+        with self.lock:
+            self.remote_capturing = capturing
+        return capturing
+
+    def sample(self) -> str:
+        """ Reads the temperature and the load, at most every SAMPLE_INTERVAL, and gets the level """
+        now = time.monotonic()
+        with self.lock:
+            if self.sampled_at is not None and now - self.sampled_at < SAMPLE_INTERVAL:
+                return self.level
+            self.sampled_at = now
+        try:
+            cpu_temp = get_cpu_temp()
+        except (OSError, ValueError):
+            # e.g. not on a Pi, only the load is used
+            cpu_temp = None
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        with self.lock:
+            if cpu_temp is not None and (cpu_temp >= self.hard_temp or
+                                         (self.level == "defer" and cpu_temp >= self.soft_temp)):
+                level = "defer"
+            elif (cpu_temp is not None and cpu_temp >= self.soft_temp) or load >= self.max_load:
+                level = "slow"
+            else:
+                level = "normal"
+            if level != self.level:
+                logger.info("Background work level: " + self.level + " -> " + level + " (CPU temp: " +
+                            str(cpu_temp) + "°, load: " + "{:.2f}".format(load) + ")")
+                self.last_change = datetime.now().isoformat(timespec="seconds")
+            self.cpu_temp = cpu_temp
+            self.load = load
+            self.level = level
+        return level
+
+    def is_throttled(self) -> bool:
+        """ True while the background work should hold back, e.g. to only run one upload at a time """
+        return self.sample() != "normal" or self.is_capturing()
+
+    def wait_turn(self, job: str):
+        """
+        Blocks a background job until it may run.
+        Arguments:
+        job - the name of the job, e.g. deletion, the decisions are counted by job
+        """
+        start = time.monotonic()
+        reason = None
+        while True:
+            level = self.sample()
+            if level == "defer" and reason != "forced":
+                if time.monotonic() - start >= MAX_DEFER:
+                    # Only the temperature is overridden, the frames are still taken first
+                    logger.warning("Background job %s deferred for %ds, running it anyway", job, MAX_DEFER)
+                    reason = "forced"
+                    continue
+                reason = "deferred"
+                time.sleep(DEFER_CHECK_INTERVAL)
+            elif self.is_capturing():
+                reason = reason or "waited_for_capture"
+                time.sleep(CAPTURE_CHECK_INTERVAL)
+            else:
+                break
+        if reason is not None:
+            self.record(job, reason)
+        if self.level == "slow":
+            self.record(job, "slowed")
+            time.sleep(SLOW_PAUSE)
+
+    def record(self, job: str, decision: str):
+        """
+        Counts a throttling decision.
+        Arguments:
+        job - the name of the job
+        decision - deferred, forced i.e. ran while deferred after MAX_DEFER, slowed or waited_for_capture
+        """
+        with self.lock:
+            decisions = self.decisions.setdefault(job, {})
+            decisions[decision] = decisions.get(decision, 0) + 1
+
+    def status(self) -> Dict:
+        """ Gets the level and the throttling decisions as a Dict to be serialized """
+        self.sample()
+        with self.lock:
+            return {
+                "level": self.level,
+                "cpu_temp": self.cpu_temp,
+                "load": round(self.load, 2),
+                "capturing": self.captures > 0 or self.remote_capturing,
+                "timelapses": len(self.next_captures),
+                "last_change": self.last_change,
+                "decisions": {job: dict(decisions) for job, decisions in self.decisions.items()},
+            }
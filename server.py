@@ -1,61 +1,134 @@
 from datetime import datetime
-import io
-import libcamera
 import logging
 import os
 import re
-import shutil
 import threading
 import time
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 from flask import Flask, Response, jsonify, render_template, request
-from picamera2 import Picamera2, Controls
-from picamera2.encoders import JpegEncoder
-from picamera2.outputs import FileOutput
-from threading import Condition
-from settings import Settings
-from timelapse import Timelapse, TimelapseGallery
-from utils import check_directory_permissions, brightness, get_cpu_temp, get_cpu_usage, get_day, get_day_and_time, pretty_number, get_awb_mode, generate_pretty_exposure_times, create_folder_if_not_exists, make_thumbnail
+from settings import Folders, Settings
+from timelapse import TimelapseGallery
+from utils import check_directory_permissions, get_cpu_temp, get_cpu_usage, get_resident_memory
+from log_setup import setup_logging
 from photo_repository import PhotoRepository, Photo
+from deletion_queue import DeletionQueue
+from archiver import Archiver
+from scheduler import ThermalScheduler
+from metrics import Metrics
+from camera_client import CameraClient, CameraError
+from preview_clip import PREVIEW_CLIP_FPS, PREVIEW_CLIP_NAME, read_frames
 
-settings = Settings()
-settings.load_from_json()
-static_dir = "./static/"
-settings.photo_directory = static_dir if settings.photo_directory is None else settings.photo_directory
-target_dir = settings.photo_directory
-static_photos_dir = os.path.join(static_dir, "photos/")
-target_photos_dir = os.path.join(target_dir, "photos/")
-thumbnails_dir = os.path.join(static_photos_dir, "thumbnails/")
-static_timelapse_dir = os.path.join(static_dir, "timelapses/")
-target_timelapse_dir = os.path.join(target_dir, "timelapses/")
-create_folder_if_not_exists(static_photos_dir)
-create_folder_if_not_exists(target_photos_dir)
-create_folder_if_not_exists(thumbnails_dir)
-create_folder_if_not_exists(static_timelapse_dir)
-create_folder_if_not_exists(target_timelapse_dir)
-create_folder_if_not_exists("./logs")
-
-Picamera2.set_logging(Picamera2.ERROR)
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s :: %(levelname)s :: %(message)s', filename='logs/' + get_day() + '.log')
 logger = logging.getLogger(__name__)
+metrics = Metrics()
+with metrics.phase("load_settings"):
+    settings = Settings()
+    settings.load_from_json()
+setup_logging(settings.log_level, settings.log_levels)
+if settings.camera_service == "process":
+    # The camera service renders the stages of its own process, the web server's are a family of their own so that
+    # the scrape never has the same family twice
+    metrics.stage_family = "web_stage_duration_seconds"
+static_dir = "./static/"
+folders = Folders(settings, static_dir)
+settings.photo_directory = folders.target_dir
+target_dir = folders.target_dir
+static_photos_dir = folders.static_photos_dir
+target_photos_dir = folders.target_photos_dir
+thumbnails_dir = folders.thumbnails_dir
+static_timelapse_dir = folders.static_timelapse_dir
+target_timelapse_dir = folders.target_timelapse_dir
+with metrics.phase("create_folders"):
+    folders.create()
+
 app = Flask(__name__)
 app.config["TEMPLATES_AUTO_RELOAD"]
-camera = Picamera2()
-pretty_exposure_times_list = generate_pretty_exposure_times()
+# The photos and the timelapses are indexed in the background, see load_indexes()
 photo_repository = PhotoRepository(static_photos_dir)
-photo_repository.load_from_json()
-timelapse_galleries = TimelapseGallery(static_timelapse_dir)
-is_timelapse_ongoing = False
-timelapse: Timelapse = None
+timelapse_galleries = TimelapseGallery(static_timelapse_dir, scan=False)
+# Set once the indexes are loaded, until then the galleries are warming
+indexes_ready = threading.Event()
+# Paces the background work of the web server process, and of the cameras in the local mode
+scheduler = ThermalScheduler(settings.thermal_soft_temp,
+                             settings.thermal_hard_temp, settings.thermal_max_load)
+metrics.register("web_resident_bytes", "gauge", "Resident memory of the web server process.",
+                 get_resident_memory)
+metrics.register("background_work_level", "gauge", "0 - normal, 1 - slowed down, 2 - deferred, see ThermalScheduler.",
+                 lambda: ThermalScheduler.LEVELS.index(scheduler.sample()))
+with metrics.phase("deletion_queue"):
+    deletion_queue = DeletionQueue(os.path.join(static_dir, ".trash/"), scheduler)
+metrics.register("deletion_queue_pending", "gauge", "Files and folders waiting to be deleted.",
+                 lambda: deletion_queue.queue.qsize())
+with metrics.phase("camera_service"):
+    if settings.camera_service == "process":
+        # The cameras are owned by the camera service process, started by gunicorn - see gunicorn.conf.py
+        cameras = CameraClient(settings.camera_socket)
+        # The deletions and the archiving of this process wait for the photos taken by the camera service
+        scheduler.set_capture_source(cameras.is_capturing)
+    else:
+        # The cameras themselves are opened on first use
+        from camera_service import Cameras
+        cameras = Cameras(settings, folders, metrics, scheduler)
+archiver = Archiver(settings, folders, timelapse_galleries, lambda: {
+                    camera["folder"] for camera in cameras.list_cameras() if camera.get("folder")}, scheduler,
+                    cameras.pending_uploads)
+metrics.register("archive_reclaimed_bytes", "counter", "Bytes reclaimed by archiving the finished timelapses.",
+                 lambda: archiver.reclaimed_bytes)
+
+
+# Adds the photos shot to the gallery once their files are saved, so that /doshoot returns right after the capture
+photo_finisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="photo-finisher")
+# The maximum time to wait for the files of the photos shot to be saved, in seconds
+SHOT_FINISH_TIMEOUT = 120
+
+
+def selected_camera_num() -> int:
+    """
+    Gets the index of the camera a request is for: the camera query parameter, else the camera chosen in the menu,
+    else the first camera
+    """
+    camera_num = request.args.get("camera", type=int)
+    if camera_num is None:
+        camera_num = request.cookies.get("camera", 0, type=int)
+    return camera_num if 0 <= camera_num < settings.cameras else 0
+
+
+def selected_camera():
+    """ Gets the camera a request is for, see selected_camera_num() """
+    return cameras.camera(selected_camera_num())
+
+
+@app.context_processor
+def inject_cameras():
+    """ Gives the cameras to the menu of all the pages """
+    return {"camera_count": settings.cameras, "selected_camera": selected_camera_num()}
+
+
+def load_indexes():
+    """ Loads the photos and the timelapses - is meant to be ran in a thread """
+    try:
+        with metrics.phase("load_photos"):
+            photo_repository.load_from_json()
+        with metrics.phase("scan_timelapses"):
+            timelapse_galleries.refresh()
+    except Exception as e:
+        logger.error("Error while loading the indexes: " + str(e))
+    finally:
+        indexes_ready.set()
+    # The archive passes use the timelapse index
+    archiver.start()
+
+
+threading.Thread(target=load_indexes, name="load-indexes", daemon=True).start()
 
 
 @app.route("/shoot")
 def shoot():
     """ Handles the display of the shoot page """
-    global camera
-    global logger
-    camera.stop()
+    try:
+        selected_camera().stop_preview()
+    except CameraError as e:
+        logger.warning(str(e))
     return render_template('shoot.html', active=" shoot")
 
 
@@ -96,6 +169,8 @@ def saveSettings():
 @app.route("/gallery")
 def gallery():
     """ Handles the display of the photo gallery page """
+    if not indexes_ready.is_set():
+        return render_template('gallery.html', active=" photoGallery", gallery={}, warming=True)
     gallery = photo_repository.organize_photos_by_date()
     return render_template('gallery.html', active=" photoGallery", gallery=gallery)
 
@@ -103,8 +178,11 @@ def gallery():
 @app.route("/timelapse-gallery")
 def timelapse_gallery():
     """ Handles the display of the timelpase gallery page """
+    if not indexes_ready.is_set():
+        return render_template('timelapse-gallery.html', active=" timelapseGallery", gallery=[], warming=True)
+    timelapse_galleries.refresh()
     sorted_galleries = sorted(timelapse_galleries.galleries.items(
-    ), key=lambda item: datetime.strptime(item[0], '%Y-%m-%d_%H-%M-%S'))
+    ), key=lambda item: datetime.strptime(item[0][:19], '%Y-%m-%d_%H-%M-%S'))
     display_galleries = [gallery for _, gallery in sorted_galleries]
     return render_template('timelapse-gallery.html', active=" timelapseGallery", gallery=display_galleries)
 
@@ -112,10 +190,17 @@ def timelapse_gallery():
 @app.route("/timelapse-gallery/view/<timelapse>")
 def view(timelapse):
     """ Handles the display of the timelapse gallery page """
-    display_timelapse = timelapse_galleries.galleries[timelapse]
-    logger.info("display_timelapse.thumbnails_files")
-    logger.info(display_timelapse.thumbnails_files)
-    return render_template('view-timelapse.html', active=" timelapseGallery", timelapse=display_timelapse)
+    if indexes_ready.is_set():
+        timelapse_galleries.refresh()
+        display_timelapse = timelapse_galleries.galleries[timelapse]
+    else:
+        # The timelapse can be displayed without waiting for the other ones to be indexed
+        display_timelapse = timelapse_galleries.galleries.get(timelapse) or timelapse_galleries.load_folder(
+            os.path.join(static_timelapse_dir, timelapse))
+    has_preview_clip = os.path.exists(os.path.join(
+        static_timelapse_dir, timelapse, PREVIEW_CLIP_NAME))
+    return render_template('view-timelapse.html', active=" timelapseGallery", timelapse=display_timelapse,
+                           has_preview_clip=has_preview_clip)
 
 
 @app.route("/")
@@ -134,76 +219,137 @@ def show_timelapse():
 @app.route("/is_timelapse_ongoing")
 def is_timelapse_running():
     """ Checks if the timelapse is still ongoing """
-    global is_timelapse_ongoing
     to_return = {}
-    to_return["is_timelapse_ongoing"] = is_timelapse_ongoing
+    try:
+        to_return["is_timelapse_ongoing"] = selected_camera().is_timelapse_ongoing()
+    except CameraError as e:
+        to_return["is_timelapse_ongoing"] = False
+        to_return["error"] = str(e)
     return jsonify(to_return)
 
 
 @app.route("/stop_timelapse")
 def stop_timelapse():
     """ Stops the ongoing timelapse """
-    global is_timelapse_ongoing
-    is_timelapse_ongoing = False
     to_return = {}
-    to_return["is_timelapse_ongoing"] = is_timelapse_ongoing
+    try:
+        to_return["is_timelapse_ongoing"] = selected_camera().stop_timelapse()
+    except CameraError as e:
+        to_return["error"] = str(e)
     return jsonify(to_return)
 
 
 @app.route("/update_timelapse")
 def update_timelapse():
-    """ Updates the timelapse page. Returns the full stats so that the timelpase can be displayed on any device calling this API. """
-    global timelapse
-    global is_timelapse_ongoing
-    to_return = {}
-    if is_timelapse_ongoing and (timelapse is not None):
-        # to_return["reference_photo"] = "/ref.jpg"
-        to_return["photos"] = timelapse.photos_list
-        to_return["photos_to_take"] = timelapse.photos_to_take
-        to_return["photos_taken"] = len(timelapse.photos_list)
-        to_return["thumbs"] = timelapse.thumbs_list
-        to_return["cpu_temp"] = get_cpu_temp()
+    """ 
+    Updates the timelapse page. Returns the full stats so that the timelpase can be displayed on any device calling this API. 
+    Arguments (query string): 
+    since - optional, only the photos taken after this photo number are returned
+    thumbs_since - optional, only the thumbnails made after this photo number are returned
+    """
+    since = request.args.get("since", 0, type=int)
+    thumbs_since = request.args.get("thumbs_since", 0, type=int)
+    try:
+        to_return = selected_camera().timelapse_status(since, thumbs_since)
+    except CameraError as e:
+        return jsonify({"is_timelapse_ongoing": False, "error": str(e)})
+    if to_return["is_timelapse_ongoing"]:
+        try:
+            to_return["cpu_temp"] = get_cpu_temp()
+        except (OSError, ValueError):
+            # e.g. not on a Pi
+            to_return["cpu_temp"] = None
         to_return["cpu_usage"] = get_cpu_usage()
-    to_return["is_timelapse_ongoing"] = is_timelapse_ongoing
+        to_return["background_work"] = background_work_status()
     return jsonify(to_return)
 
 
-class StreamingOutput(io.BufferedIOBase):
-    """ Used for camera streaming on the preview page """
-
-    def __init__(self):
-        self.frame = None
-        self.condition = Condition()
-
-    def write(self, buf):
-        with self.condition:
-            self.frame = buf
-            self.condition.notify_all()
+def background_work_status() -> dict:
+    """ Gets the throttling of the background work, from the camera service which takes the photos in the process mode """
+    if settings.camera_service == "process":
+        try:
+            return cameras.scheduler_status()
+        except CameraError as e:
+            logger.warning(str(e))
+    return scheduler.status()
 
 
-def genFrames():
-    """ Generates the frames to be streamed """
-    global camera
-    output = StreamingOutput()
-    camera.configure(camera.create_video_configuration(
-        main={"size": (1280, 960)}))
-    output = StreamingOutput()
-    camera.start_recording(JpegEncoder(), FileOutput(output))
+def genFrames(camera):
+    """ 
+    Generates the frames of a camera to be streamed. All the viewers share the same recording. 
+    While a timelapse is ongoing, its latest thumbnail is streamed instead of the live view.
+    """
     while True:
-        with output.condition:
-            output.condition.wait()
-            frame = output.frame
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+        try:
+            frame = camera.preview_frame(5)
+        except CameraError as e:
+            logger.warning(str(e))
+            frame = None
+            time.sleep(1)
+        if frame is not None:
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
 
 
 @app.route('/video_feed')
 def video_feed():
     """ Provides the source of the stream on the preview page """
-    return Response(genFrames(),
+    return Response(genFrames(selected_camera()),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 
+def genClipFrames(clip_path: str):
+    """ 
+    Generates the frames of a timelapse preview clip to be streamed, in a loop.
+    The frames appended while the timelapse is ongoing are played on the next loop.
+    """
+    while True:
+        played = 0
+        if os.path.exists(clip_path):
+            for frame in read_frames(clip_path):
+                played += 1
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+                time.sleep(1 / PREVIEW_CLIP_FPS)
+        if played == 0:
+            # No thumbnail has been made yet
+            time.sleep(1)
+
+
+@app.route('/timelapse-preview/<timelapse>')
+def timelapse_preview(timelapse):
+    """ Plays the preview clip of a timelapse, even while it's being taken """
+    if os.path.basename(timelapse) != timelapse:
+        return Response(status=404)
+    clip_path = os.path.join(static_timelapse_dir, timelapse, PREVIEW_CLIP_NAME)
+    return Response(genClipFrames(clip_path),
+                    mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+@app.route('/timelapse-thumbnail/<timelapse>/<name>')
+def timelapse_thumbnail(timelapse, name):
+    """ 
+    Serves a thumbnail of a timelapse from the memory of the camera service, e.g. while it's being taken
+    Arguments: 
+    timelapse - the folder of the timelapse
+    name - the file name of the thumbnail, or latest for the last thumbnail of the timelapse being taken
+    """
+    if os.path.basename(timelapse) != timelapse or os.path.basename(name) != name:
+        return Response(status=404)
+    try:
+        thumbnail = cameras.timelapse_thumbnail(timelapse, name)
+    except CameraError as e:
+        logger.warning(str(e))
+        thumbnail = None
+    if thumbnail is None:
+        return Response(status=404)
+    response = Response(thumbnail, mimetype="image/jpeg")
+    if name != "latest":
+        # A thumbnail never changes once it's made
+        response.headers["Cache-Control"] = "max-age=86400"
+    return response
+
+
 @app.route('/doshoot', methods=['POST'])
 def do_shoot():
     """ 
@@ -213,8 +359,10 @@ def do_shoot():
     speed - the exposure time to set in ms
     wb - the white balance to set
     file_format - the file format to save the photo in
+    bracket - optional, the EV offsets of a bracket e.g. [-2, 0, 2], or [0, 0, 0] for a burst, taken in a single camera session
+    Returns as soon as the photos are captured, with a low resolution preview of each one. Their files are saved in the
+    background, see /shot_status.
     """
-    global pretty_exposure_times_list
     toReturn = {}
     try:
         input = request.get_json(force=True)
@@ -222,48 +370,71 @@ def do_shoot():
         exposure_time = input["exposureTime"]
         wb = input["wb"]
         file_format = input["fileFormat"]
-
-        capture_config = camera.create_still_configuration(
-            raw={}, display=None, colour_space=libcamera.ColorSpace.Srgb())
-        if iso != "Auto":
-            camera.set_controls({"AnalogueGain": int(iso) / 100})
-        if exposure_time != -1:
-            camera.set_controls({"ExposureTime": int(exposure_time)})
-        if wb != "auto":
-            camera.set_controls({"AwbMode": get_awb_mode(wb)})
-        camera.start()
-        time.sleep(2)
-        r = camera.switch_mode_capture_request_and_stop(capture_config)
-        day = get_day()
-        day_and_time = get_day_and_time()
-        jpg_path = day_and_time + ".jpg"
-        jpg_full_path = os.path.join(target_photos_dir, jpg_path)
-        r.save("main", jpg_full_path)
-        thumbnail_full_path = os.path.join(thumbnails_dir, jpg_path)
-        make_thumbnail(jpg_full_path, thumbnail_full_path, 1000, 1000)
-        if "jpg" not in file_format:
-            do_delete_photo(jpg_full_path)
-        dng_path = None
-        if "dng" in file_format:
-            dng_path = day_and_time + ".dng"
-            r.save_dng(target_photos_dir + dng_path)
-            toReturn["dngPath"] = dng_path
-        toReturn["fileName"] = day_and_time
-        toReturn["iso"] = iso
-        toReturn["exposureTime"] = pretty_exposure_times_list[int(
-            exposure_time)]
-        toReturn["wb"] = wb.capitalize()
-        toReturn["jpgPath"] = jpg_path
-        toReturn["thumbPath"] = jpg_path
-        photo = Photo(name=day_and_time, iso=iso, speed=exposure_time, exposure_time=pretty_exposure_times_list[int(exposure_time)],
-                      white_balance=wb.capitalize(), capture_date=day, jpg_path=jpg_path, dng_path=dng_path)
-        photo_repository.add_photo(photo)
-    except RuntimeError as e:
+        bracket = input.get("bracket")
+        camera = selected_camera()
+        shots = camera.shoot(iso, exposure_time, wb, file_format, bracket)
+        photos = []
+        for shot in shots:
+            photo = {}
+            if shot["dngPath"] is not None:
+                photo["dngPath"] = shot["dngPath"]
+            photo["fileName"] = shot["fileName"]
+            photo["iso"] = shot["iso"]
+            photo["exposureTime"] = shot["exposureTime"]
+            photo["wb"] = shot["wb"]
+            photo["jpgPath"] = shot["jpgPath"]
+            photo["thumbPath"] = shot["thumbPath"]
+            photo["preview"] = shot["preview"]
+            photo["status"] = shot["status"]
+            photos.append(photo)
+        photo_finisher.submit(add_shot_photos, camera, shots)
+        # The first photo is also returned at the top level, as for a single photo
+        toReturn.update(photos[0])
+        toReturn["photos"] = photos
+    except CameraError as e:
         logger.warning(str(e))
         toReturn["error"] = True
+        toReturn["cause"] = str(e)
     return jsonify(toReturn)
 
 
+def add_shot_photos(camera, shots: List[dict]):
+    """
+    Adds photos shot to the gallery once their files are saved - is meant to be ran in a thread
+    Arguments:
+    camera - the camera the photos have been shot with
+    shots - the photos' data, see CameraService.shoot
+    """
+    try:
+        states = camera.wait_shots([shot["fileName"] for shot in shots], SHOT_FINISH_TIMEOUT)
+    except CameraError as e:
+        logger.warning(str(e))
+        states = {}
+    photos = []
+    for shot in shots:
+        if states.get(shot["fileName"]) == "failed":
+            logger.warning("Photo not added to the gallery, its files couldn't be saved: " + shot["fileName"])
+            continue
+        photos.append(Photo(name=shot["fileName"], iso=shot["iso"], speed=shot["speed"], exposure_time=shot["exposureTime"],
+                            white_balance=shot["wb"], capture_date=shot["day"], jpg_path=shot["jpgPath"], dng_path=shot["dngPath"]))
+    if photos:
+        photo_repository.add_photos(photos)
+
+
+@app.route("/shot_status")
+def shot_status():
+    """ 
+    Gets the status of photos shot: processing while their files are being saved, then done or failed
+    Arguments (query string): 
+    names - the names of the photos, comma separated
+    """
+    names = [name for name in request.args.get("names", "").split(",") if name]
+    try:
+        return jsonify({"shots": selected_camera().shot_status(names)})
+    except CameraError as e:
+        return jsonify({"error": str(e)})
+
+
 @app.route("/deletephoto", methods=['POST'])
 def delete_photo():
     """ 
@@ -275,46 +446,55 @@ def delete_photo():
     input = request.get_json(force=True)
     try:
         name = input["name"]
-        photo = photo_repository.get_photo(name)
     except:
         toReturn["error"] = True
         return jsonify(toReturn)
+    deleted = do_delete_photos([name])
+    toReturn["error"] = len(deleted) == 0
+    return jsonify(toReturn)
+
+
+@app.route("/deletephotos", methods=['POST'])
+def delete_photos():
+    """ 
+    Deletes all versions of several photos - the files are deleted in the background
+    Arguments (request body): 
+    names - the names of the photos
+    """
+    toReturn = {}
+    input = request.get_json(force=True)
     try:
-        jpg_path = static_photos_dir + photo.jpg_path
-    except:
-        jpg_path = None
-    is_jpg_deletion_error = not do_delete_photo(jpg_path)
-    try:
-        dng_path = static_photos_dir + photo.dng_path
+        names = list(input["names"])
     except:
-        dng_path = None
-    is_dng_deletion_error = not do_delete_photo(dng_path)
-    toReturn["error"] = is_jpg_deletion_error or is_dng_deletion_error
-    if not toReturn["error"]:
-        photo_repository.remove_photo(name)
-        thumbnail_path = os.path.join(thumbnails_dir, name + ".jpg")
-        do_delete_photo(thumbnail_path)
+        toReturn["error"] = True
+        return jsonify(toReturn)
+    deleted = do_delete_photos(names)
+    toReturn["deleted"] = deleted
+    toReturn["error"] = len(deleted) != len(names)
     return jsonify(toReturn)
 
 
-def do_delete_photo(photo_path) -> bool:
+def do_delete_photos(names: List[str]) -> List[str]:
     """ 
-    Deletes a photo
+    Moves the files of photos to the trash and removes the photos from the repository right away
     Arguments: 
-    photo_path - the path of the photo
+    names - the names of the photos
     Returns:
-    True if the deletion was a success or if the path was None.
+    The names of the photos that have been removed.
     """
-    if photo_path != None and os.path.exists(photo_path):
-        try:
-            os.remove(photo_path)
-            logger.info("Deleted photo: " + photo_path)
-            return True
-        except:
-            logger.error("Error while deleting: " + photo_path)
-            return False
-    else:
-        return True
+    paths = []
+    for name in names:
+        photo = photo_repository.get_photo(name)
+        if photo is None:
+            continue
+        if photo.jpg_path is not None:
+            paths.append(os.path.join(static_photos_dir, photo.jpg_path))
+        if photo.dng_path is not None:
+            paths.append(os.path.join(static_photos_dir, photo.dng_path))
+        paths.append(os.path.join(thumbnails_dir, name + ".jpg"))
+    # Moved first, so that a photo is never removed while its files are left behind
+    deletion_queue.delete_files(paths)
+    return photo_repository.remove_photos(names)
 
 
 @app.route("/deletetimelapse", methods=['POST'])
@@ -325,133 +505,163 @@ def delete_timelapse():
     timelapse - the name of the timelapse
     """
     toReturn = {}
-    toReturn["error"] = False
     input = request.get_json(force=True)
     timelapse: str = input["timelapse"]
-    static_timelapse_path = os.path.join(static_timelapse_dir, timelapse)
-    if timelapse != None and os.path.exists(static_timelapse_path):
-        try:
-            shutil.rmtree(static_timelapse_path)
-            logger.info("Timelapse deleted: " + timelapse)
-
-        except:
-            toReturn["error"] = True
-            return jsonify(toReturn)
-        if not toReturn["error"]:
-            timelapse_galleries.remove(timelapse)
+    deleted = do_delete_timelapses([timelapse])
+    toReturn["error"] = len(deleted) == 0
     return jsonify(toReturn)
 
 
-def run_timelapse(input):
+@app.route("/deletetimelapses", methods=['POST'])
+def delete_timelapses():
     """ 
-    Runs the timelapse - is meant to be ran in a thread
-    Arguments: 
-    input - the parameters of the timelapse - see the Timelapse class
+    Deletes several timelapses - the files are deleted in the background
+    Arguments (request body): 
+    timelapses - the names of the timelapses
     """
-    global is_timelapse_ongoing
-    global timelapse
-    logger.info("Start timelapse")
-    date_and_time = get_day_and_time()
-    static_working_dir = os.path.join(static_timelapse_dir, date_and_time)
-    # relative_tmp_dir = date_and_time + "/tmp/"
-    os.makedirs(static_working_dir, exist_ok=True)
-    tmp_dir = os.path.join(static_working_dir, "tmp")
-    logger.info(tmp_dir)
-    os.makedirs(tmp_dir, exist_ok=True)
-    target_working_dir = os.path.join(target_timelapse_dir, date_and_time)
-    os.makedirs(target_working_dir, exist_ok=True)
-
-    timelapse = Timelapse(input)
-    is_timelapse_ongoing = True
-    timelapse_galleries.add_timelapse(date_and_time)
-
-    preview_config = camera.create_preview_configuration()
-    capture_config = camera.create_still_configuration(
-        raw={"size": camera.sensor_resolution})
-    camera.stop()
-    camera.configure(preview_config)
-    camera.set_controls({"AnalogueGain": timelapse.iso / 100})
-    camera.set_controls({"ExposureTime": timelapse.exposure_time})
-    camera.set_controls({"AwbMode": timelapse.wb})
-    camera.start()
-    time.sleep(2)
-    reference_path = os.path.join(tmp_dir, "ref.jpg")
-    while is_timelapse_ongoing and timelapse.is_ongoing():
-        take_timelapse_photo(capture_config, reference_path,
-                             target_working_dir, tmp_dir, date_and_time)
-        logger.info("Sleeping for: " + str(timelapse.get_sleep_time()))
-        time.sleep(timelapse.get_sleep_time())
-    camera.stop()
-    time.sleep(2)
-    os.remove(reference_path)
-    is_timelapse_ongoing = False
-    logger.info("Timelapse finished")
-
-
-def take_timelapse_photo(capture_config: Dict, reference_path: str, working_dir: str, tmp_dir: str, date_and_time: str):
+    toReturn = {}
+    input = request.get_json(force=True)
+    try:
+        timelapses = list(input["timelapses"])
+    except:
+        toReturn["error"] = True
+        return jsonify(toReturn)
+    deleted = do_delete_timelapses(timelapses)
+    toReturn["deleted"] = deleted
+    toReturn["error"] = len(deleted) != len(timelapses)
+    return jsonify(toReturn)
+
+
+def do_delete_timelapses(timelapse_dates: List[str]) -> List[str]:
     """ 
-    Takes a photo for the ongoin timelapse
+    Removes timelapses from the gallery right away and moves their folders to the deletion queue
     Arguments: 
-    capture_config (Dict) - the capture configuration for the camera
-    reference_path (str) - the path to the reference file for brightness calculation
-    working_dir (str) - the path to the working directory
-    tmp_dir (str) - the path to the tmp directory
-    date_and_time (str) - the start date and time of the timelapse
+    timelapse_dates - the names of the timelapses
+    Returns:
+    The names of the timelapses that have been removed.
     """
-    camera.stop()
-    camera.set_controls({"AnalogueGain": timelapse.iso / 100})
-    camera.set_controls({"ExposureTime": timelapse.exposure_time})
-    camera.start()
-    timelapse.photos_taken = timelapse.photos_taken + 1
-    logger.info("==================== Taking photo: " + str(timelapse.photos_taken) +
-                "/" + str(timelapse.photos_to_take))
-    filename = "tl_" + \
-        pretty_number(timelapse.photos_taken, timelapse.photos_to_take) + \
-        "_" + get_day_and_time() + "_ISO_" + str(timelapse.iso) + "_" + \
-        pretty_exposure_times_list[timelapse.exposure_time].replace(
-            '/', '-')
-    r = camera.switch_mode_capture_request_and_stop(capture_config)
-    r.save("main", reference_path)
-    if "dng" in timelapse.file_format:
-        dng_path = os.path.join(working_dir, filename + ".dng")
-        r.save_dng("main", dng_path)
-        timelapse_galleries.add_dng(date_and_time, dng_path)
-    jpg_path = os.path.join(working_dir, filename + ".jpg")
-    r.save("main", jpg_path)
-    photo_brightness = brightness(reference_path)
-    day_and_time = get_day_and_time()
-    timelapse.add_photo(filename, day_and_time, photo_brightness)
-    timelapse.update_settings(photo_brightness)
-    thumbnail_path = os.path.join(tmp_dir, filename + ".jpg")
-    make_thumbnail(jpg_path, thumbnail_path, 400, 400)
-    timelapse.add_thumbnail(
-        path=thumbnail_path, day_and_time=day_and_time, number=timelapse.photos_taken, iso=timelapse.iso, speed=pretty_exposure_times_list[timelapse.exposure_time], brightness=photo_brightness)
-    timelapse_galleries.add_thumbnail(date_and_time, filename + ".jpg")
-    if "jpg" not in timelapse.file_format:
-        do_delete_photo(jpg_path)
+    indexes_ready.wait()
+    deleted = []
+    for timelapse_date in timelapse_dates:
+        if timelapse_date not in timelapse_galleries.galleries:
+            continue
+        static_timelapse_path = os.path.join(
+            static_timelapse_dir, timelapse_date)
+        if deletion_queue.delete_folder(static_timelapse_path):
+            timelapse_galleries.remove(timelapse_date)
+            logger.info("Timelapse deleted: " + timelapse_date)
+            deleted.append(timelapse_date)
+    return deleted
+
+
+@app.route("/metrics")
+def show_metrics():
+    """ Exposes the hot path timings and the background queues in the Prometheus text format """
+    if settings.camera_service == "process":
+        text = metrics.render()
+        try:
+            text += cameras.render_metrics()
+        except CameraError as e:
+            logger.warning(str(e))
     else:
-        timelapse_galleries.add_jpg(date_and_time, jpg_path)
+        # The cameras share the web server's metrics
+        text = cameras.render_metrics()
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/cameras")
+def list_cameras():
+    """ Lists the cameras and whether a timelapse is ongoing on each of them """
+    to_return = {}
+    try:
+        to_return["cameras"] = cameras.list_cameras()
+    except CameraError as e:
+        to_return["error"] = str(e)
+    return jsonify(to_return)
+
+
+@app.route("/startup_status")
+def startup_status():
+    """ Checks if the photos and the timelapses are still being indexed after a restart """
+    to_return = {}
+    to_return["warming"] = not indexes_ready.is_set()
+    return jsonify(to_return)
+
+
+@app.route("/deletion_status")
+def deletion_status():
+    """ Gets the status of the background deletions """
+    return jsonify(deletion_queue.status())
+
+
+@app.route("/archive_status")
+def archive_status():
+    """ Gets the status of the archiving of the finished timelapses, e.g. the space reclaimed """
+    return jsonify(archiver.status())
+
+
+@app.route("/scheduler_status")
+def scheduler_status():
+    """ Gets the throttling decisions of the background work, of the camera service as well in the process mode """
+    to_return = scheduler.status()
+    if settings.camera_service == "process":
+        try:
+            to_return["camera_service"] = cameras.scheduler_status()
+        except CameraError as e:
+            to_return["camera_service"] = {"error": str(e)}
+    return jsonify(to_return)
+
+
+@app.route("/upload_status")
+def upload_status():
+    """ Gets the status of the replication of the timelapse files to the S3 endpoint """
+    try:
+        return jsonify(cameras.upload_status())
+    except CameraError as e:
+        return jsonify({"error": str(e)})
+
+
+@app.route('/calibrate_darks', methods=['POST'])
+def calibrate_darks():
+    """ 
+    Takes the master dark frames of the selected camera in the background, with the lens covered
+    Arguments (request body): 
+    isos - the ISOs to calibrate
+    exposureTimes - the exposure times to calibrate, in ms
+    frames - optional, the number of dark frames averaged into each master
+    """
+    try:
+        input = request.get_json(force=True)
+        return jsonify(selected_camera().calibrate_darks(input["isos"], input["exposureTimes"], input.get("frames")))
+    except CameraError as e:
+        logger.warning(str(e))
+        return jsonify({"started": False, "error": str(e)})
+
+
+@app.route("/dark_frames")
+def dark_frames_status():
+    """ Gets the master dark frames of the selected camera and the progress of their calibration """
+    try:
+        return jsonify(selected_camera().dark_frames_status())
+    except CameraError as e:
+        return jsonify({"error": str(e)})
 
 
 @app.route('/start_timelapse', methods=['POST'])
 def start_timelapse():
     """ 
-    Starts the timelapse in a dedicated thread
+    Starts the timelapse in the camera service
     Arguments (request body): 
     input - the parameters of the timelapse - see the Timelapse class
     """
     to_return = {}
     to_return["started"] = False
-    if not is_timelapse_ongoing:
-        try:
-            input = request.get_json(force=True)
-            x = threading.Thread(target=run_timelapse,
-                                 args=(input,), daemon=True)
-            x.start()
-            to_return["started"] = True
-        except RuntimeError as e:
-            logger.warning(str(e))
-            to_return["error"] = str(e)
+    try:
+        input = request.get_json(force=True)
+        to_return = selected_camera().start_timelapse(input)
+    except CameraError as e:
+        logger.warning(str(e))
+        to_return["error"] = str(e)
     return jsonify(to_return)
 
 
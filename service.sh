@@ -2,4 +2,4 @@
 kill -9 $(lsof -t -i:8000)
 cd /home/pi/lapsilapse
 . .venv/bin.activate
-gunicorn server:app --workers 1 --bind 0.0.0.0:8000
\ No newline at end of file
+gunicorn server:app --config gunicorn.conf.py
\ No newline at end of file
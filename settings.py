@@ -1,14 +1,86 @@
 import json
 import os
 
+from utils import create_folder_if_not_exists
+
 
 class Settings:
     def __init__(self) -> None:
         self.photo_directory: str = None
+        # sync, pool or spool - see DngEncoder
+        self.dng_mode: str = "pool"
+        self.dng_workers: int = 2
+        # 0 to process the frames in the web server process
+        self.image_workers: int = 2
+        # local - the web server process owns the camera, process - a dedicated camera service process owns it
+        self.camera_service: str = "local"
+        # The socket the camera service listens on, in the process mode
+        self.camera_socket: str = "/tmp/lapsilapse-camera.sock"
+        # The number of web server processes, only used in the process mode
+        self.web_workers: int = 2
+        # The number of cameras, e.g. 2 on a Pi 5 with two camera connectors
+        self.cameras: int = 1
+        # picamera2, or fake to run without cameras - see CameraBackend
+        self.camera_backend: str = "picamera2"
+        # The retention policy of the finished timelapses, see Archiver - none by default
+        self.archive_actions: list = []
+        self.archive_after_days: int = 7
+        self.archive_max_size: int = 3840
+        # The S3-compatible endpoint the timelapse files are replicated to, see Uploader - None to not upload them
+        self.upload_endpoint: str = None
+        self.upload_bucket: str = "lapsilapse"
+        self.upload_region: str = "us-east-1"
+        self.upload_access_key: str = ""
+        self.upload_secret_key: str = ""
+        self.upload_prefix: str = ""
+        self.upload_workers: int = 2
+        # The thresholds the background work is slowed down and deferred from, see ThermalScheduler
+        self.thermal_soft_temp: float = 70
+        self.thermal_hard_temp: float = 80
+        self.thermal_max_load: float = 1.0
+        # The level of the logs, and of some modules e.g. {"timelapse": "WARNING"}, see setup_logging
+        self.log_level: str = "INFO"
+        self.log_levels: dict = {}
+        # The master dark frames are subtracted from the timelapse photos from this exposure time, see DarkFrameLibrary
+        self.dark_frame_min_exposure: int = 1000000
+        # The number of dark frames averaged into a master, and the width of its temperature band (°C)
+        self.dark_frame_count: int = 8
+        self.dark_temp_band: float = 5
+        # The maximum size of the thumbnails kept in memory, see FrameCache (MB)
+        self.frame_cache_size: int = 32
 
     def save_to_json(self) -> None:
         """Saves the settings to a JSON file within the directory."""
-        data = {"photo_directory": self.photo_directory}
+        data = {
+            "photo_directory": self.photo_directory,
+            "dng_mode": self.dng_mode,
+            "dng_workers": self.dng_workers,
+            "image_workers": self.image_workers,
+            "camera_service": self.camera_service,
+            "camera_socket": self.camera_socket,
+            "web_workers": self.web_workers,
+            "cameras": self.cameras,
+            "camera_backend": self.camera_backend,
+            "archive_actions": self.archive_actions,
+            "archive_after_days": self.archive_after_days,
+            "archive_max_size": self.archive_max_size,
+            "upload_endpoint": self.upload_endpoint,
+            "upload_bucket": self.upload_bucket,
+            "upload_region": self.upload_region,
+            "upload_access_key": self.upload_access_key,
+            "upload_secret_key": self.upload_secret_key,
+            "upload_prefix": self.upload_prefix,
+            "upload_workers": self.upload_workers,
+            "thermal_soft_temp": self.thermal_soft_temp,
+            "thermal_hard_temp": self.thermal_hard_temp,
+            "thermal_max_load": self.thermal_max_load,
+            "log_level": self.log_level,
+            "log_levels": self.log_levels,
+            "dark_frame_min_exposure": self.dark_frame_min_exposure,
+            "dark_frame_count": self.dark_frame_count,
+            "dark_temp_band": self.dark_temp_band,
+            "frame_cache_size": self.frame_cache_size,
+        }
         with open(os.path.join(".", "settings.json"), "w") as f:
             json.dump(data, f, indent=4)
 
@@ -19,3 +91,79 @@ class Settings:
             with open(json_path, "r") as f:
                 data = json.load(f)
                 self.photo_directory = data["photo_directory"]
+                self.dng_mode = data.get("dng_mode", self.dng_mode)
+                self.dng_workers = data.get("dng_workers", self.dng_workers)
+                self.image_workers = data.get(
+                    "image_workers", self.image_workers)
+                self.camera_service = data.get(
+                    "camera_service", self.camera_service)
+                self.camera_socket = data.get(
+                    "camera_socket", self.camera_socket)
+                self.web_workers = data.get("web_workers", self.web_workers)
+                self.cameras = data.get("cameras", self.cameras)
+                self.camera_backend = data.get(
+                    "camera_backend", self.camera_backend)
+                self.archive_actions = data.get(
+                    "archive_actions", self.archive_actions)
+                self.archive_after_days = data.get(
+                    "archive_after_days", self.archive_after_days)
+                self.archive_max_size = data.get(
+                    "archive_max_size", self.archive_max_size)
+                self.upload_endpoint = data.get(
+                    "upload_endpoint", self.upload_endpoint)
+                self.upload_bucket = data.get(
+                    "upload_bucket", self.upload_bucket)
+                self.upload_region = data.get(
+                    "upload_region", self.upload_region)
+                self.upload_access_key = data.get(
+                    "upload_access_key", self.upload_access_key)
+                self.upload_secret_key = data.get(
+                    "upload_secret_key", self.upload_secret_key)
+                self.upload_prefix = data.get(
+                    "upload_prefix", self.upload_prefix)
+                self.upload_workers = data.get(
+                    "upload_workers", self.upload_workers)
+                self.thermal_soft_temp = data.get(
+                    "thermal_soft_temp", self.thermal_soft_temp)
+                self.thermal_hard_temp = data.get(
+                    "thermal_hard_temp", self.thermal_hard_temp)
+                self.thermal_max_load = data.get(
+                    "thermal_max_load", self.thermal_max_load)
+                self.log_level = data.get("log_level", self.log_level)
+                self.log_levels = data.get("log_levels", self.log_levels)
+                self.dark_frame_min_exposure = data.get(
+                    "dark_frame_min_exposure", self.dark_frame_min_exposure)
+                self.dark_frame_count = data.get(
+                    "dark_frame_count", self.dark_frame_count)
+                self.dark_temp_band = data.get(
+                    "dark_temp_band", self.dark_temp_band)
+                self.frame_cache_size = data.get(
+                    "frame_cache_size", self.frame_cache_size)
+
+
+class Folders:
+    """ The folders the photos and timelapses are saved in, shared by the web server and the camera service """
+
+    def __init__(self, settings: Settings, static_dir: str = "./static/"):
+        """
+        Arguments:
+        settings - the settings, the photos directory defaults to the static folder
+        static_dir - the folder served by the web server
+        """
+        self.static_dir = static_dir
+        self.target_dir = static_dir if settings.photo_directory is None else settings.photo_directory
+        self.static_photos_dir = os.path.join(static_dir, "photos/")
+        self.target_photos_dir = os.path.join(self.target_dir, "photos/")
+        self.thumbnails_dir = os.path.join(self.static_photos_dir, "thumbnails/")
+        self.static_timelapse_dir = os.path.join(static_dir, "timelapses/")
+        self.target_timelapse_dir = os.path.join(
+            self.target_dir, "timelapses/")
+        self.dark_frames_dir = os.path.join(self.target_dir, "darks/")
+
+    def create(self):
+        """ Creates the folders if they don't exist """
+        create_folder_if_not_exists(self.static_photos_dir)
+        create_folder_if_not_exists(self.target_photos_dir)
+        create_folder_if_not_exists(self.thumbnails_dir)
+        create_folder_if_not_exists(self.static_timelapse_dir)
+        create_folder_if_not_exists(self.target_timelapse_dir)
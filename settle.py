@@ -0,0 +1,128 @@
+import logging
+import time
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+# The smallest difference between a requested and an applied value always accepted, as the sensor quantizes them
+# e.g. the exposure time to its line time
+ABSOLUTE_TOLERANCES = {"ExposureTime": 100, "AnalogueGain": 0.05}
+# The controls whose applied values are checked against the requested ones
+CHECKED_CONTROLS = ("ExposureTime", "AnalogueGain")
+
+
+def is_close(applied: float, requested: float, control: str, tolerance: float) -> bool:
+    """
+    Checks if an applied value matches the requested one.
+    Arguments:
+    applied - the value reported by the frame's metadata, None if not reported
+    requested - the value requested
+    control - the name of the control
+    tolerance - the relative difference accepted
+    """
+    if applied is None:
+        return False
+    return abs(applied - requested) <= max(abs(requested) * tolerance, ABSOLUTE_TOLERANCES.get(control, 0))
+
+
+def controls_applied(metadata: Dict, controls: Dict, tolerance: float = 0.05) -> bool:
+    """
+    Checks if the exposure time and the gain of a frame are the requested ones.
+    Arguments:
+    metadata - the frame's metadata
+    controls - the requested controls, the ones not checked are ignored
+    tolerance - the relative difference accepted
+    """
+    for control in CHECKED_CONTROLS:
+        if control in controls and not is_close(metadata.get(control), controls[control], control, tolerance):
+            return False
+    return True
+
+
+def clamp_controls(controls: Dict, config: Dict) -> Dict:
+    """
+    Gets the controls a configuration can apply: the exposure time can't be longer than its longest frame duration,
+    e.g. about 83ms for the preview configuration, so the long exposures of a night timelapse are clamped.
+    Arguments:
+    controls - the requested controls
+    config - the camera configuration they're applied with
+    Returns:
+    The controls, with the exposure time clamped.
+    """
+    limits = (config.get("controls") or {}).get("FrameDurationLimits")
+    if "ExposureTime" not in controls or not limits:
+        return controls
+    return {**controls, "ExposureTime": min(controls["ExposureTime"], limits[1])}
+
+
+def is_stable(metadata: Dict, previous: Dict, key: str, tolerance: float) -> bool:
+    """
+    Checks if a value reported by the metadata hasn't changed since the previous frame.
+    Arguments:
+    metadata - the frame's metadata
+    previous - the previous frame's metadata, None for the first frame
+    key - the metadata key, the value can be a number or a tuple of numbers
+    tolerance - the relative difference accepted
+    """
+    if previous is None or key not in previous:
+        return False
+    current, last = metadata[key], previous[key]
+    if not isinstance(current, (tuple, list)):
+        current, last = (current,), (last,)
+    return all(abs(a - b) <= abs(b) * tolerance for a, b in zip(current, last))
+
+
+def is_settled(metadata: Dict, previous: Dict, controls: Dict, tolerance: float = 0.05) -> bool:
+    """
+    Checks if a frame has the requested exposure, and if the automatic exposure and white balance have converged.
+    Arguments:
+    metadata - the frame's metadata
+    previous - the previous frame's metadata, None for the first frame
+    controls - the requested controls
+    tolerance - the relative difference accepted
+    """
+    if not controls_applied(metadata, controls, tolerance):
+        return False
+    auto_exposure = controls.get("AeEnable", True) and not (
+        "ExposureTime" in controls and "AnalogueGain" in controls)
+    if auto_exposure:
+        if "AeLocked" in metadata:
+            if not metadata["AeLocked"]:
+                return False
+        elif "ExposureTime" in metadata and not (is_stable(metadata, previous, "ExposureTime", tolerance)
+                                                 and is_stable(metadata, previous, "AnalogueGain", tolerance)):
+            return False
+    if "ColourGains" not in controls and "ColourGains" in metadata:
+        # The white balance has no lock reported, it has converged once the gains stop moving
+        if not is_stable(metadata, previous, "ColourGains", tolerance):
+            return False
+    return True
+
+
+def wait_for_settle(camera, controls: Dict = None, timeout: float = 2.0, tolerance: float = 0.05) -> Tuple[Dict, bool]:
+    """
+    Waits until the frames have the requested exposure and the automatic exposure and white balance have converged,
+    instead of sleeping for a fixed time. The camera must be started.
+    Arguments:
+    camera - the started Picamera2
+    controls - the controls set before the camera was started
+    timeout - the maximum time to wait, in seconds
+    tolerance - the relative difference accepted between the requested and the applied values
+    Returns:
+    The metadata of the last frame, and False if the timeout was reached first.
+    """
+    controls = controls if controls is not None else {}
+    deadline = time.monotonic() + timeout
+    previous = None
+    frames = 0
+    while True:
+        metadata = camera.capture_metadata()
+        frames += 1
+        if is_settled(metadata, previous, controls, tolerance):
+            logger.debug("Settled after %d frames", frames)
+            return metadata, True
+        if time.monotonic() >= deadline:
+            logger.warning("Not settled after %d frames, requested: %s, applied: %s", frames, controls,
+                           {control: metadata.get(control) for control in CHECKED_CONTROLS})
+            return metadata, False
+        previous = metadata
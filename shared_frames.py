@@ -0,0 +1,64 @@
+from multiprocessing import shared_memory
+from typing import Tuple
+
+import numpy as np
+
+
+class SharedFrame:
+    """ A frame stored in shared memory so that it can be handed to another process without being copied or pickled """
+
+    def __init__(self, name: str, shape: Tuple[int, ...], dtype: str):
+        """
+        Arguments:
+        name - the name of the shared memory block
+        shape - the shape of the frame's array
+        dtype - the type of the frame's array
+        """
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self._shm = None
+
+    @staticmethod
+    def from_array(array: np.ndarray) -> "SharedFrame":
+        """
+        Copies an array, e.g. a mapped camera buffer, into a new shared memory block.
+        The creator is responsible for calling unlink() once the frame isn't needed anymore.
+        Arguments:
+        array - the array to share
+        Returns:
+        The SharedFrame, attached in the current process.
+        """
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        frame = SharedFrame(shm.name, array.shape, array.dtype.str)
+        frame._shm = shm
+        np.copyto(frame.array(), array, casting="no")
+        return frame
+
+    def array(self) -> np.ndarray:
+        """ Gets the frame as an array backed by the shared memory - no copy is made """
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=np.dtype(self.dtype), buffer=self._shm.buf)
+
+    def close(self):
+        """ Detaches the frame from the current process """
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def unlink(self):
+        """ Detaches the frame and frees the shared memory block """
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        shm = self._shm
+        self._shm = None
+        shm.close()
+        shm.unlink()
+
+    def __getstate__(self):
+        """ Only the frame's description is sent to the other processes """
+        return {"name": self.name, "shape": self.shape, "dtype": self.dtype}
+
+    def __setstate__(self, state):
+        self.__init__(state["name"], state["shape"], state["dtype"])
@@ -0,0 +1,144 @@
+import bisect
+import math
+from typing import Tuple
+
+# Approximate brightness of a clear sky landscape (EV at ISO 100) depending on the sun altitude in degrees,
+# from night to full daylight. Only the differences between two altitudes are used, to plan the exposure changes.
+SCENE_EV_BY_ALTITUDE = (
+    (-18.0, -2.0),
+    (-12.0, 2.0),
+    (-8.0, 5.0),
+    (-6.0, 6.5),
+    (-4.0, 8.0),
+    (-2.0, 9.5),
+    (0.0, 11.0),
+    (2.0, 12.0),
+    (5.0, 13.0),
+    (10.0, 14.0),
+    (20.0, 15.0),
+)
+
+
+def sun_position(timestamp: float, latitude: float, longitude: float) -> Tuple[float, float]:
+    """
+    Computes the position of the sun with the NOAA solar calculator's algorithm, accurate to about a minute of time.
+    Arguments:
+    timestamp - the time, as a POSIX timestamp
+    latitude - the latitude of the camera, in degrees, positive to the north
+    longitude - the longitude of the camera, in degrees, positive to the east
+    Returns:
+    The altitude of the sun above the horizon corrected for the atmospheric refraction, and its azimuth from the north,
+    in degrees.
+    """
+    julian_day = timestamp / 86400 + 2440587.5
+    julian_century = (julian_day - 2451545) / 36525
+    mean_longitude = (280.46646 + julian_century *
+                      (36000.76983 + julian_century * 0.0003032)) % 360
+    mean_anomaly = 357.52911 + julian_century * \
+        (35999.05029 - 0.0001537 * julian_century)
+    eccentricity = 0.016708634 - julian_century * \
+        (0.000042037 + 0.0000001267 * julian_century)
+    anomaly = math.radians(mean_anomaly)
+    center = math.sin(anomaly) * (1.914602 - julian_century * (0.004817 + 0.000014 * julian_century)) + \
+        math.sin(2 * anomaly) * (0.019993 - 0.000101 * julian_century) + \
+        math.sin(3 * anomaly) * 0.000289
+    omega = math.radians(125.04 - 1934.136 * julian_century)
+    apparent_longitude = mean_longitude + center - \
+        0.00569 - 0.00478 * math.sin(omega)
+    mean_obliquity = 23 + (26 + (21.448 - julian_century * (46.815 + julian_century *
+                                                              (0.00059 - julian_century * 0.001813))) / 60) / 60
+    obliquity = math.radians(mean_obliquity + 0.00256 * math.cos(omega))
+    declination = math.asin(math.sin(obliquity) *
+                            math.sin(math.radians(apparent_longitude)))
+    y = math.tan(obliquity / 2) ** 2
+    longitude_rad = math.radians(mean_longitude)
+    # Equation of time, in minutes
+    equation_of_time = 4 * math.degrees(y * math.sin(2 * longitude_rad) - 2 * eccentricity * math.sin(anomaly)
+                                        + 4 * eccentricity * y * math.sin(anomaly) * math.cos(2 * longitude_rad)
+                                        - 0.5 * y * y * math.sin(4 * longitude_rad)
+                                        - 1.25 * eccentricity * eccentricity * math.sin(2 * anomaly))
+    true_solar_time = ((timestamp % 86400) / 60 +
+                       equation_of_time + 4 * longitude) % 1440
+    hour_angle = math.radians(true_solar_time / 4 - 180)
+    latitude_rad = math.radians(latitude)
+    cos_zenith = math.sin(latitude_rad) * math.sin(declination) + \
+        math.cos(latitude_rad) * math.cos(declination) * math.cos(hour_angle)
+    zenith = math.acos(max(-1.0, min(1.0, cos_zenith)))
+    altitude = 90 - math.degrees(zenith)
+    sin_zenith = math.sin(zenith)
+    if sin_zenith == 0:
+        azimuth = 180.0 if latitude > 0 else 0.0
+    else:
+        cos_azimuth = (math.sin(latitude_rad) * cos_zenith -
+                       math.sin(declination)) / (math.cos(latitude_rad) * sin_zenith)
+        azimuth_angle = math.degrees(
+            math.acos(max(-1.0, min(1.0, cos_azimuth))))
+        azimuth = (azimuth_angle + 180) % 360 if hour_angle > 0 else (540 - azimuth_angle) % 360
+    return altitude + refraction(altitude), azimuth
+
+
+def refraction(altitude: float) -> float:
+    """
+    Approximates the atmospheric refraction, which makes the sun appear higher close to the horizon.
+    Arguments:
+    altitude - the geometric altitude of the sun, in degrees
+    Returns:
+    The correction, in degrees.
+    """
+    if altitude > 85:
+        return 0.0
+    tan_altitude = math.tan(math.radians(altitude))
+    if altitude > 5:
+        seconds = 58.1 / tan_altitude - 0.07 / tan_altitude ** 3 + \
+            0.000086 / tan_altitude ** 5
+    elif altitude > -0.575:
+        seconds = 1735 + altitude * \
+            (-518.2 + altitude * (103.4 + altitude * (-12.79 + altitude * 0.711)))
+    else:
+        seconds = -20.772 / tan_altitude
+    return seconds / 3600
+
+
+def scene_ev(altitude: float) -> float:
+    """
+    Estimates the brightness of the scene from the sun altitude, see SCENE_EV_BY_ALTITUDE.
+    Arguments:
+    altitude - the altitude of the sun, in degrees
+    Returns:
+    The EV at ISO 100.
+    """
+    altitudes = [point[0] for point in SCENE_EV_BY_ALTITUDE]
+    if altitude <= altitudes[0]:
+        return SCENE_EV_BY_ALTITUDE[0][1]
+    if altitude >= altitudes[-1]:
+        return SCENE_EV_BY_ALTITUDE[-1][1]
+    i = bisect.bisect_right(altitudes, altitude)
+    (low_altitude, low_ev), (high_altitude,
+                             high_ev) = SCENE_EV_BY_ALTITUDE[i - 1], SCENE_EV_BY_ALTITUDE[i]
+    return low_ev + (high_ev - low_ev) * (altitude - low_altitude) / (high_altitude - low_altitude)
+
+
+class ExposurePlanner:
+    """
+    Plans the exposure changes of a timelapse from the position of the sun, so that the sunset and sunrise transitions
+    are anticipated rather than corrected once a photo is already too dark or too bright.
+    """
+
+    def __init__(self, latitude: float, longitude: float):
+        """
+        Arguments:
+        latitude - the latitude of the camera, in degrees, positive to the north
+        longitude - the longitude of the camera, in degrees, positive to the east
+        """
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def expected_ev(self, timestamp: float) -> float:
+        """
+        Computes the expected EV of the scene at a time, e.g. of a photo taken or of the next one.
+        Arguments:
+        timestamp - the time, as a POSIX timestamp
+        Returns:
+        The expected EV at ISO 100.
+        """
+        return scene_ev(sun_position(timestamp, self.latitude, self.longitude)[0])
@@ -0,0 +1,69 @@
+import time
+
+import numpy as np
+
+
+class FrameStacker:
+    """
+    Stacks frames in a running float accumulator, so that the memory used stays the same whatever the number of frames.
+    The accumulator is kept between two stacks to avoid reallocating it for every timelapse photo.
+    """
+
+    MODES = ("mean", "max")
+
+    def __init__(self):
+        self.accumulator: np.ndarray = None
+        self.mode = "mean"
+        self.frames = 0
+        self.stack_time = 0.0
+
+    def reset(self, mode: str):
+        """
+        Starts a new stack.
+        Arguments:
+        mode - mean to average the frames e.g. for noise reduction, max to keep the brightest pixels e.g. for star trails
+        """
+        if mode not in self.MODES:
+            raise ValueError("Unknown stack mode: " + str(mode))
+        self.mode = mode
+        self.frames = 0
+        self.stack_time = 0.0
+
+    def add(self, frame: np.ndarray) -> float:
+        """
+        Adds a frame to the stack.
+        Arguments:
+        frame - the frame, e.g. a mapped camera buffer, it isn't kept
+        Returns:
+        The time it took to stack the frame, in ms.
+        """
+        start = time.perf_counter()
+        if self.accumulator is None or self.accumulator.shape != frame.shape:
+            self.accumulator = np.empty(frame.shape, dtype=np.float32)
+        if self.frames == 0:
+            np.copyto(self.accumulator, frame)
+        elif self.mode == "mean":
+            np.add(self.accumulator, frame, out=self.accumulator)
+        else:
+            np.maximum(self.accumulator, frame, out=self.accumulator)
+        self.frames += 1
+        elapsed = time.perf_counter() - start
+        self.stack_time += elapsed
+        return elapsed * 1000
+
+    def result(self) -> np.ndarray:
+        """
+        Gets the stacked frame. The accumulator is reused in place, so reset() must be called before the next stack.
+        Returns:
+        The stacked frame as an 8 bits array.
+        """
+        if self.mode == "mean" and self.frames > 1:
+            np.multiply(self.accumulator, 1 / self.frames, out=self.accumulator)
+            np.rint(self.accumulator, out=self.accumulator)
+        return self.accumulator.astype(np.uint8)
+
+    def mean_stack_time(self) -> float:
+        """ Gets the mean time it took to stack a frame, in ms """
+        if self.frames == 0:
+            return 0.0
+        return self.stack_time / self.frames * 1000
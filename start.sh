@@ -1,2 +1,2 @@
 #!/bin/bash
-gunicorn server:app --workers 1 --bind 0.0.0.0:8000
\ No newline at end of file
+gunicorn server:app --config gunicorn.conf.py
\ No newline at end of file
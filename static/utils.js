@@ -107,4 +107,55 @@ async function deleteTimelapse(elementID) {
         }
         return true;
     }
-}
\ No newline at end of file
+}
+
+/**
+ * Deletes several photos in a single call and removes their cards.
+ * @param {string[]} elementIDs The photos' names.
+ * @return {string[]} The names of the deleted photos.
+ */
+async function deletePhotos(elementIDs) {
+    let body = { names: elementIDs };
+    let resp = await fetch("/deletephotos", {
+        method: "POST",
+        body: JSON.stringify(body),
+    });
+    let res = await resp.json();
+    let deleted = res.deleted || [];
+    elementIDs.forEach((elementID) => {
+        let card = document.getElementById(elementID + "_card");
+        if (deleted.includes(elementID)) {
+            if (card) card.remove();
+        } else {
+            let error = document.getElementById(elementID + "_error");
+            if (error) error.classList.replace("d-none", "d-block");
+        }
+    });
+    return deleted;
+}
+
+
+/**
+ * Deletes several timelapses in a single call and removes their cards.
+ * @param {string[]} elementIDs The timelapses' names.
+ * @return {string[]} The names of the deleted timelapses.
+ */
+async function deleteTimelapses(elementIDs) {
+    let body = { timelapses: elementIDs };
+    let resp = await fetch("/deletetimelapses", {
+        method: "POST",
+        body: JSON.stringify(body),
+    });
+    let res = await resp.json();
+    let deleted = res.deleted || [];
+    elementIDs.forEach((elementID) => {
+        let card = document.getElementById(elementID + "_card");
+        if (deleted.includes(elementID)) {
+            if (card) card.remove();
+        } else {
+            let error = document.getElementById(elementID + "_error");
+            if (error) error.classList.replace("d-none", "d-block");
+        }
+    });
+    return deleted;
+}
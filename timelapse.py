@@ -1,21 +1,27 @@
 from datetime import datetime
 import logging
+import math
 import os
-from pathlib import Path
+import threading
+import time
 from typing import Dict, List
 
-from utils import generate_pretty_exposure_times, get_awb_mode
+from frame_records import FrameRecordStore
+from metering import Meter
+from scene_change import AdaptiveInterval
+from solar import ExposurePlanner
+from stacking import FrameStacker
+
+logger = logging.getLogger(__name__)
 # Exposure times in ms, from 1/3200s to 30s
 exposure_time_list = [300, 500, 1000, 2000, 4000, 8000, 16666, 33333, 66666, 125000, 250000,
                       500000, 1000000, 2000000, 4000000, 8000000, 12000000, 16000000, 20000000, 25000000, 30000000]
 
-pretty_exposure_times_list = generate_pretty_exposure_times()
-
 
 class Timelapse:
     """ Handles the whole timelapse """
 
-    def __init__(self, input):
+    def __init__(self, input, thumbnail_dir: str = "", records_path: str = None):
         """ 
         Starts the timelapse in a dedicated thread
         Arguments (request body): 
@@ -31,6 +37,19 @@ class Timelapse:
         - file_format - sets the file format to save the photos in - JPEG, DNG or both
         - photos_number - the number of photos to take
         - photos_delay - the delay between two photos, in seconds, must be at least 2 seconds higher than maxExposureTime
+        - stack_frames - optional, the number of frames stacked into each photo, 1 by default i.e. no stacking
+        - stack_mode - optional, mean (default) or max e.g. for star trails, see FrameStacker
+        - adaptive_interval - optional, True to adapt the delay between photos to the scene changes, see AdaptiveInterval
+        - min_delay, max_delay - optional, the bounds of the delay in the adaptive interval mode, in seconds
+        - skip_duplicates - optional, True to skip saving the near-duplicate photos in the adaptive interval mode
+        - latitude, longitude - optional, the position of the camera in degrees, to anticipate the exposure changes
+          from the position of the sun, see ExposurePlanner
+        - metering - optional, the metering mode driving the exposure changes, average (default), center, spot, roi or
+          lower, see Meter
+        - metering_roi - optional, the region of interest of the roi metering mode, as a list of [x, y] fractions of the
+          frame's width and height
+        thumbnail_dir - the folder of the thumbnails
+        records_path - optional, the path of the CSV file the photos' records are appended to
         """
         self.iso = int(input["startIso"])
         self.min_iso = int(input["minIso"])
@@ -39,22 +58,47 @@ class Timelapse:
         self.min_exposure_time = int(input["minExposureTime"])
         self.max_exposure_time = int(input["maxExposureTime"])
         self.priority = input["priority"]
-        self.wb = get_awb_mode(input["wb"])
+        # The name of the white balance, see CameraBackend.awb_mode
+        self.wb = input["wb"]
         # self.custom_wb = int(input["custom_wb"])
         self.file_format = input["file_format"]
         self.photos_to_take = int(input["photos_number"])
         self.photos_interval = int(input["photos_delay"]) - 2
+        self.stack_frames = max(1, int(input.get("stack_frames", 1)))
+        self.meter = Meter(input.get("metering", "average"),
+                           input.get("metering_roi"))
+        self.stack_mode = input.get("stack_mode", "mean")
+        if self.stack_mode not in FrameStacker.MODES:
+            self.stack_mode = "mean"
         self.last_brightnesses = [0.0, 0.0, 0.0]
-        self.photos_list = []
-        self.thumbs_list = []
+        self.records = FrameRecordStore(
+            self.photos_to_take, thumbnail_dir, records_path)
         self.photos_taken = 0
         self.reference_brightness = 0.0
+        # Adapts the interval to the scene changes, None for a fixed interval
+        self.adaptive_interval = None
+        if input.get("adaptive_interval"):
+            photos_delay = int(input["photos_delay"])
+            self.adaptive_interval = AdaptiveInterval(int(input.get("min_delay", photos_delay)), int(input.get("max_delay", photos_delay)),
+                                                      photos_delay, bool(input.get("skip_duplicates", False)))
+        # The scene change decisions of the photo being taken
+        self.scene_change = None
+        self.skip_photo = False
+        # Gives the expected EV of the scene at the time of each photo, None without a position
+        self.planner: ExposurePlanner = None
+        # The planned exposure change not applied yet, in stops, as the settings only change by whole stops
+        self.planned_stops = 0.0
+        if input.get("latitude") not in (None, "") and input.get("longitude") not in (None, ""):
+            self.planner = ExposurePlanner(
+                float(input["latitude"]), float(input["longitude"]))
+            logger.info("Expected scene EV at the start: %.1f", self.planner.expected_ev(time.time()))
 
     #
     def get_sleep_time(self):
         """ Get the sleep time between the end of the current exposure and the next one, depending on the exposure time """
-        exposure_time_in_seconds = int(self.exposure_time / 1000000)
-        return self.photos_interval - exposure_time_in_seconds
+        exposure_time_in_seconds = int(self.exposure_time * self.stack_frames / 1000000)
+        photos_interval = self.photos_interval if self.adaptive_interval is None else self.adaptive_interval.interval - 2
+        return max(0, photos_interval - exposure_time_in_seconds)
 
     def is_ongoing(self):
         """ Check if the timelapse is still ongoing """
@@ -90,8 +134,8 @@ class Timelapse:
             mean_brightness = self.mean_brightness_value()
             brightness_ratio = self.reference_brightness/mean_brightness
             current_photo_brightness_ratio = self.reference_brightness/photo_brightness
-            logging.info("mean_brightness: " + str(mean_brightness) + " / brightness_ratio: " + str(
-                brightness_ratio) + " / current_photo_brightness_ratio: " + str(current_photo_brightness_ratio))
+            logger.info("mean_brightness: %s / brightness_ratio: %s / current_photo_brightness_ratio: %s",
+                        mean_brightness, brightness_ratio, current_photo_brightness_ratio)
             if mean_brightness < self.reference_brightness and self.iso < self.max_iso:
                 if brightness_ratio > 1.10 and self.is_far_from_reference_photo(photo_brightness):
                     self.iso = int(self.iso * 2)
@@ -100,8 +144,7 @@ class Timelapse:
                     self.iso = int(self.iso / 2)
 
         if initial_iso != self.iso:
-            logging.info("ISO changed from " +
-                         str(initial_iso) + " to " + str(self.iso))
+            logger.info("ISO changed from %s to %s", initial_iso, self.iso)
 
     def get_slower_exposure_time(self):
         """ Get a 1 stop slower exposure time """
@@ -146,8 +189,8 @@ class Timelapse:
             mean_brightness = self.mean_brightness_value()
             brightness_ratio = self.reference_brightness/mean_brightness
             current_photo_brightness_ratio = self.reference_brightness/photo_brightness
-            logging.info("mean_brightness: " + str(mean_brightness) + " / brightness_ratio: " + str(
-                brightness_ratio) + " / current_photo_brightness_ratio: " + str(current_photo_brightness_ratio))
+            logger.info("mean_brightness: %s / brightness_ratio: %s / current_photo_brightness_ratio: %s",
+                        mean_brightness, brightness_ratio, current_photo_brightness_ratio)
             if mean_brightness < self.reference_brightness and self.exposure_time < self.max_exposure_time:
                 if brightness_ratio > 1.10 and self.is_far_from_reference_photo(photo_brightness):
                     self.exposure_time = self.get_slower_exposure_time()
@@ -155,8 +198,7 @@ class Timelapse:
                 if brightness_ratio < 0.90 and self.is_far_from_reference_photo(photo_brightness):
                     self.exposure_time = self.get_faster_exposure_time()
         if initial_exposure_time != self.exposure_time:
-            logging.info("Exposure time changed from " +
-                         str(initial_exposure_time) + " to " + str(self.exposure_time))
+            logger.info("Exposure time changed from %s to %s", initial_exposure_time, self.exposure_time)
 
     def is_close_to_reference_photo(self, photo_brightness):
         """
@@ -182,10 +224,9 @@ class Timelapse:
         photo_brightness - the current photo's brightness
         """
         mean_brightness = self.mean_brightness_value()
-        logging.info("Exposure_time: " + str(self.exposure_time) +
-                     " / ISO: " + str(self.iso))
-        logging.info("Photo_brightness: " + str(photo_brightness) +
-                     " / mean_brightness: " + str(mean_brightness) + " Reference brightness: " + str(self.reference_brightness))
+        logger.info("Exposure_time: %s / ISO: %s", self.exposure_time, self.iso)
+        logger.info("Photo_brightness: %s / mean_brightness: %s Reference brightness: %s",
+                    photo_brightness, mean_brightness, self.reference_brightness)
         if mean_brightness == 0:  # Very first item, brings wrong calculations
             self.last_brightnesses.append(photo_brightness)
             return
@@ -219,47 +260,111 @@ class Timelapse:
                 else:
                     self.update_iso(photo_brightness)
 
-    def add_photo(self, filename, date_and_time, photo_brightness):
+    def apply_plan(self):
+        """
+        Anticipates the exposure change expected between the photo just taken and the next one from the position of
+        the sun, the brightness based correction then only handles the residual error. The change is applied by whole
+        stops, the remainder is carried over to the next photos.
+        The sun's position is computed at the actual times of the photos, as the interval changes in the adaptive
+        interval mode and the time spent taking and processing each photo adds up over a night.
+        """
+        if self.planner is None or len(self.records) < 1 or not self.is_ongoing():
+            return
+        last_timestamp = self.records.timestamps[-1]
+        # The time spent on the photo just taken is already past, the next one comes after the sleep
+        next_timestamp = time.time() + self.get_sleep_time()
+        # A darker scene needs more exposure
+        self.planned_stops -= self.planner.expected_ev(next_timestamp) - \
+            self.planner.expected_ev(last_timestamp)
+        while abs(self.planned_stops) >= 1:
+            brighter = self.planned_stops > 0
+            if not self.shift_exposure(brighter):
+                self.planned_stops = 0.0
+                break
+            self.planned_stops += -1 if brighter else 1
+            logger.info("Planned exposure change: %s stop, exposure_time: %s / ISO: %s",
+                        "+1" if brighter else "-1", self.exposure_time, self.iso)
+
+    def shift_exposure(self, brighter: bool) -> bool:
+        """
+        Changes the settings by one stop, following the priority
+        Arguments:
+        brighter - True to make the next photo brighter, False to make it darker
+        Returns:
+        False if the settings are already at their limits.
+        """
+        iso_first = self.priority == "iso"
+        for use_iso in (iso_first, not iso_first):
+            if use_iso:
+                if brighter and self.iso < self.max_iso:
+                    self.iso = int(self.iso * 2)
+                    return True
+                if not brighter and self.iso > self.min_iso:
+                    self.iso = int(self.iso / 2)
+                    return True
+            else:
+                if brighter and self.exposure_time < self.max_exposure_time:
+                    self.exposure_time = self.get_slower_exposure_time()
+                    return True
+                if not brighter and self.exposure_time > self.min_exposure_time:
+                    self.exposure_time = self.get_faster_exposure_time()
+                    return True
+        return False
+
+    def check_scene_change(self, luma) -> bool:
+        """
+        Compares the photo being taken to the previous one in the adaptive interval mode, and adapts the interval
+        Arguments: 
+        luma - the luma plane of the photo, see utils.decimated_luma
+        Returns: 
+        True if the photo shouldn't be saved, as a near-duplicate of the previous one.
+        """
+        score, self.skip_photo = self.adaptive_interval.update(luma)
+        self.scene_change = None if math.isnan(score) else score
+        if self.skip_photo:
+            logger.info("Near-duplicate photo skipped, scene change: %.4f", score)
+        return self.skip_photo
+
+    def get_file_name(self, timestamp: float) -> str:
+        """
+        Get the file name of the photo being taken, without extension
+        Arguments: 
+        timestamp - the time the photo is taken, as a POSIX timestamp
+        """
+        return self.records.file_name(self.photos_taken, timestamp, self.iso, self.exposure_time)
+
+    def add_photo(self, timestamp, photo_brightness, stack_time=None):
         """
-        Add the photo to the list after it's been taken
+        Add the photo to the records after it's been taken
         Arguments: 
-        filename - the photo's file name
-        date_and_time - the date and time the photo was taken
+        timestamp - the time the photo was taken, as a POSIX timestamp
         photo_brightness - the photo's brightness
+        stack_time - optional, the mean time it took to stack a frame, in ms
         """
-        photo = {}
-        photo["file_name"] = filename
-        photo["time"] = date_and_time
-        photo["iso"] = self.iso
-        photo["speed"] = pretty_exposure_times_list[self.exposure_time]
-        photo["number"] = self.photos_taken
-        photo["brightness"] = "{:10.3f}".format(photo_brightness)
         if self.photos_taken == 1:
             self.reference_brightness = photo_brightness
-        self.photos_list.append(photo)
-
-    def add_thumbnail(self, path, number, day_and_time, iso, speed, brightness):
+        interval = None if self.adaptive_interval is None else self.adaptive_interval.interval
+        self.records.append(self.photos_taken, timestamp, self.iso,
+                            self.exposure_time, photo_brightness, stack_time,
+                            self.scene_change, interval, self.skip_photo)
+        self.scene_change = None
+        self.skip_photo = False
+
+    def add_thumbnail(self, number):
         """
-        Add the trhumbnail to the list
+        Flag the photo's thumbnail as made
         Arguments: 
-        path - the thumbnail's path
-        time - the date and time the photo was taken
+        number - the number of the photo
         """
-        thumb = {}
-        thumb["path"] = path
-        thumb["number"] = number
-        thumb["time"] = day_and_time
-        thumb["iso"] = iso
-        thumb["speed"] = speed
-        thumb["brightness"] = "{:10.3f}".format(brightness)
-        self.thumbs_list.append(thumb)
+        self.records.set_thumbnail_ready(number)
 
 
 class TimelapseGalleryItem:
     def __init__(self, timelapse_date: str, jpg_files: List[str], dng_files: List[str], thumbnails_files: List[str]):
         try:
+            # The timelapses of the other cameras than the first one have a suffix, e.g. _cam1
             datetime_info = datetime.strptime(
-                timelapse_date, "%Y-%m-%d_%H-%M-%S")
+                timelapse_date[:19], "%Y-%m-%d_%H-%M-%S")
             start_date = datetime_info.date()
             start_time = datetime_info.time()
         except ValueError:
@@ -294,37 +399,83 @@ class TimelapseGalleryItem:
 
 
 class TimelapseGallery:
-    def __init__(self, timelapse_folder: str):
+    def __init__(self, timelapse_folder: str, scan: bool = True):
+        """
+        Arguments:
+        timelapse_folder - the folder of the timelapses
+        scan - False to create an empty gallery and scan the folders later with refresh(), e.g. in the background
+        """
+        self.timelapse_folder = timelapse_folder
         self.galleries: Dict[str, TimelapseGalleryItem] = {}
-        timelapse_galleries: Dict[str, TimelapseGalleryItem] = {}
-        base_path = Path(timelapse_folder)
-
-        for folder in base_path.iterdir():
-            if folder.is_dir():
-                jpg_files = [f.name for f in folder.glob('*.jpg')]
-                dng_files = [f.name for f in folder.glob('*.dng')]
-
-                thumbnails_files = []
-                tmp_folder = os.path.join(folder, "tmp")
-                if os.path.exists(tmp_folder):
-                    entries = os.listdir(tmp_folder)
-                    thumbnails_files = [
-                        entry for entry in entries if entry != "ref.jpg" and os.path.isfile(os.path.join(tmp_folder, entry))]
-                    thumbnails_files.sort()
-                    gallery = TimelapseGalleryItem(
-                        timelapse_date=folder.name, jpg_files=jpg_files, dng_files=dng_files, thumbnails_files=thumbnails_files)
-                    timelapse_galleries[folder.name] = gallery
-
-        self.galleries = timelapse_galleries
+        # Maps the timelapse names to the modification times of their folders, to only rescan the ones that changed
+        self.signatures: Dict[str, tuple] = {}
+        self.lock = threading.RLock()
+        if scan:
+            self.refresh()
         # self.galleries = sorted(timelapse_galleries.items(), key=lambda item: datetime.strptime(item[0], '%Y-%m-%d_%H-%M-%S'))
 
+    def refresh(self):
+        """
+        Rescans the timelapse folders that changed since the last scan, e.g. when the timelapses are taken
+        by the camera service in another process.
+        """
+        with self.lock:
+            seen = set()
+            with os.scandir(self.timelapse_folder) as folders:
+                for folder in folders:
+                    if not folder.is_dir():
+                        continue
+                    seen.add(folder.name)
+                    tmp_folder = os.path.join(folder.path, "tmp")
+                    try:
+                        signature = (folder.stat().st_mtime_ns,
+                                     os.stat(tmp_folder).st_mtime_ns)
+                    except FileNotFoundError:
+                        continue
+                    if self.signatures.get(folder.name) == signature:
+                        continue
+                    gallery = self.load_folder(folder.path)
+                    if gallery is not None:
+                        self.galleries[folder.name] = gallery
+                        self.signatures[folder.name] = signature
+            for timelapse_date in list(self.galleries):
+                if timelapse_date not in seen:
+                    self.remove(timelapse_date)
+
+    def load_folder(self, folder: str):
+        """
+        Scans the files of a timelapse, with one listing per folder.
+        Arguments: 
+        folder - the folder of the timelapse
+        Returns: 
+        The TimelapseGalleryItem, or None if the folder has no thumbnails folder.
+        """
+        tmp_folder = os.path.join(folder, "tmp")
+        try:
+            with os.scandir(tmp_folder) as entries:
+                thumbnails_files = [
+                    entry.name for entry in entries if entry.name != "ref.jpg" and entry.is_file()]
+        except FileNotFoundError:
+            return None
+        thumbnails_files.sort()
+        jpg_files = []
+        dng_files = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.endswith(".jpg"):
+                    jpg_files.append(entry.name)
+                elif entry.name.endswith(".dng"):
+                    dng_files.append(entry.name)
+        return TimelapseGalleryItem(
+            timelapse_date=os.path.basename(os.path.normpath(folder)), jpg_files=jpg_files, dng_files=dng_files, thumbnails_files=thumbnails_files)
+
     def list_galleries(self):
         """
         Gets a list of galleries in timelapse start time order.
         Returns: 
         The list of TimelapseGallery.
         """
-        return sorted(self.galleries.items(), key=lambda item: datetime.strptime(item[0], '%Y-%m-%d_%H-%M-%S'))
+        return sorted(self.galleries.items(), key=lambda item: datetime.strptime(item[0][:19], '%Y-%m-%d_%H-%M-%S'))
 
     def add_timelapse(self, timelapse_date: str):
         """
@@ -363,10 +514,21 @@ class TimelapseGallery:
         """
         self.galleries[timelapse_date].thumbnails_files.append(thumbnail_path)
 
+    def invalidate(self, timelapse_date: str):
+        """
+        Makes the next refresh rescan a timelapse, e.g. after its files have been archived.
+        Arguments: 
+        timelapse_date - the date and time the timelapse started, YYYY-MM-DD_HH:mm:ss
+        """
+        with self.lock:
+            self.signatures.pop(timelapse_date, None)
+
     def remove(self, timelapse_date: str):
         """
         Removes an existing gallery.
         Arguments: 
         timelapse_date - the date and time the timelapse started, YYYY-MM-DD_HH:mm:ss
         """
-        del self.galleries[timelapse_date]
+        with self.lock:
+            del self.galleries[timelapse_date]
+            self.signatures.pop(timelapse_date, None)
@@ -0,0 +1,125 @@
+import threading
+from typing import Dict
+
+from frame_records import FrameRecordStore
+
+
+class TimelapseStatus:
+    """
+    An immutable snapshot of the ongoing timelapse, as shown on the timelapse page.
+    A new snapshot is published after each change, see StatusPublisher, so that the readers always see a consistent
+    state without blocking the capture thread.
+    The records of the photos are shared with the next snapshots, which only append to them: a snapshot only shows the
+    records below its counts, formatted when they're read.
+    """
+
+    __slots__ = ("is_ongoing", "folder", "photos_to_take", "iso", "exposure_time", "records", "photos_count",
+                 "thumbnails_count", "preview_clip_frames")
+
+    def __init__(self, is_ongoing: bool = False, folder: str = None, photos_to_take: int = 0, iso: int = None,
+                 exposure_time: int = None, records: FrameRecordStore = None, photos_count: int = 0,
+                 thumbnails_count: int = 0, preview_clip_frames: int = 0):
+        """
+        Arguments:
+        is_ongoing - True while the timelapse is ongoing
+        folder - the name of the timelapse's folder
+        photos_to_take - the number of photos of the timelapse
+        iso - the ISO of the next photo
+        exposure_time - the exposure time of the next photo (ms)
+        records - the records of the photos taken
+        photos_count - the number of photos taken
+        thumbnails_count - the number of thumbnails made, without gap
+        preview_clip_frames - the number of frames of the preview clip
+        """
+        values = locals()
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("A timelapse status can't be modified, publish a new one")
+
+    def replace(self, **changes) -> "TimelapseStatus":
+        """
+        Makes a new snapshot from this one.
+        Arguments:
+        changes - the values which changed
+        """
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return TimelapseStatus(**values)
+
+    def to_dict(self, since: int = 0, thumbs_since: int = 0) -> Dict:
+        """
+        Gets the status to be serialized.
+        Arguments:
+        since - only the photos taken after this photo number are returned
+        thumbs_since - only the thumbnails made after this photo number are returned
+        """
+        to_return = {}
+        if self.is_ongoing and self.folder is not None:
+            records = self.records
+            to_return["photos"] = [] if records is None else [
+                records.photo(index) for index in range(max(0, since), self.photos_count)]
+            to_return["photos_to_take"] = self.photos_to_take
+            to_return["photos_taken"] = self.photos_count
+            to_return["thumbs"] = [] if records is None else [
+                records.thumbnail(index) for index in range(max(0, thumbs_since), self.thumbnails_count)
+                if not records.skipped[index]]
+            to_return["iso"] = self.iso
+            to_return["exposure_time"] = self.exposure_time
+            to_return["folder"] = self.folder
+            to_return["preview_clip_frames"] = self.preview_clip_frames
+        to_return["is_timelapse_ongoing"] = self.is_ongoing
+        return to_return
+
+
+class StatusPublisher:
+    """
+    Publishes the snapshots of the ongoing timelapse. The readers get the current snapshot without any lock, the lock
+    only orders the capture thread and the thumbnail callbacks, which both publish.
+    """
+
+    def __init__(self):
+        self.current = TimelapseStatus()
+        self.lock = threading.Lock()
+
+    def publish(self, **changes):
+        """
+        Publishes a new snapshot.
+        Arguments:
+        changes - the values which changed, see TimelapseStatus
+        """
+        with self.lock:
+            self.current = self.current.replace(**changes)
+
+    def start(self):
+        """ Publishes the snapshot of a timelapse starting """
+        with self.lock:
+            self.current = TimelapseStatus(is_ongoing=True)
+
+    def add_photo(self, records: FrameRecordStore, iso: int, exposure_time: int):
+        """
+        Publishes the last photo taken.
+        Arguments:
+        records - the records of the timelapse's photos
+        iso - the ISO of the next photo
+        exposure_time - the exposure time of the next photo (ms)
+        """
+        with self.lock:
+            self.current = self.current.replace(records=records, photos_count=len(records), iso=iso,
+                                                exposure_time=exposure_time)
+
+    def add_thumbnails(self, records: FrameRecordStore, preview_clip_frames: int):
+        """
+        Publishes the thumbnails made since the last snapshot.
+        Arguments:
+        records - the records of the timelapse's photos
+        preview_clip_frames - the number of frames of the preview clip
+        """
+        with self.lock:
+            status = self.current
+            thumbnails_count = status.thumbnails_count
+            while thumbnails_count < status.photos_count and records.thumbnails_ready[thumbnails_count]:
+                thumbnails_count += 1
+            self.current = status.replace(records=records, thumbnails_count=thumbnails_count,
+                                          preview_clip_frames=preview_clip_frames)
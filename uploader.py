@@ -0,0 +1,396 @@
+import hashlib
+import hmac
+import http.client
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import quote, urlparse
+
+from dng_encoder import SPOOL_EXTENSION
+from scheduler import ThermalScheduler
+from settings import Folders, Settings
+from utils import lower_thread_priority
+
+logger = logging.getLogger(__name__)
+
+# The files from this size are sent as multipart uploads, e.g. the DNG files
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+# The size of the parts of the multipart uploads, 5 MB at least for S3
+PART_SIZE = 8 * 1024 * 1024
+# The delays between the attempts of a failed upload, doubled after each attempt (s)
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 600
+# The time the workers wait for new files, and the extra workers wait while the capture I/O is busy (s)
+IDLE_WAIT = 1
+THROTTLE_WAIT = 2
+# The timeout of the requests to the endpoint (s)
+REQUEST_TIMEOUT = 60
+
+
+class UploadError(Exception):
+    """ Raised when the endpoint refuses a request """
+
+    def __init__(self, status: int, message: str):
+        super().__init__("HTTP " + str(status) + " - " + message)
+        self.status = status
+        self.message = message
+
+
+def sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def hmac_sha256(key: bytes, message: str) -> bytes:
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+
+class S3Endpoint:
+    """
+    An S3-compatible endpoint, e.g. AWS S3 or a MinIO server, addressed with path-style URLs.
+    The requests are signed with AWS Signature Version 4, with only the standard library.
+    """
+
+    def __init__(self, url: str, bucket: str, region: str, access_key: str, secret_key: str):
+        """
+        Arguments:
+        url - the URL of the endpoint, e.g. https://s3.eu-west-3.amazonaws.com or http://nas.local:9000
+        bucket - the bucket the files are uploaded to
+        region - the region of the bucket, us-east-1 for most S3-compatible servers
+        access_key, secret_key - the credentials
+        """
+        parsed = urlparse(url)
+        self.secure = parsed.scheme == "https"
+        self.host = parsed.netloc
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+
+    def connection(self) -> http.client.HTTPConnection:
+        """ Opens a connection to the endpoint, kept alive across the requests of a worker """
+        if self.secure:
+            return http.client.HTTPSConnection(self.host, timeout=REQUEST_TIMEOUT)
+        return http.client.HTTPConnection(self.host, timeout=REQUEST_TIMEOUT)
+
+    def sign(self, method: str, path: str, query: Dict[str, str], payload_hash: str, now: datetime = None) -> Dict:
+        """
+        Computes the headers of a request signed with AWS Signature Version 4.
+        Arguments:
+        method - the HTTP method
+        path - the path of the request, not URL-encoded yet
+        query - the query parameters
+        payload_hash - the SHA-256 of the body, as hexadecimal
+        now - optional, the time of the request
+        Returns:
+        The headers of the request, including the Authorization header.
+        """
+        now = now if now is not None else datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        scope = now.strftime("%Y%m%d") + "/" + self.region + "/s3/aws4_request"
+        headers = {"host": self.host, "x-amz-content-sha256": payload_hash, "x-amz-date": amz_date}
+        signed_headers = ";".join(sorted(headers))
+        canonical_query = "&".join(quote(name, safe="~") + "=" + quote(value, safe="~")
+                                   for name, value in sorted(query.items()))
+        canonical_request = "\n".join([method, quote(path, safe="/~"), canonical_query] +
+                                      [name + ":" + headers[name].strip() for name in sorted(headers)] +
+                                      ["", signed_headers, payload_hash])
+        string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                                    sha256_hex(canonical_request.encode())])
+        key = ("AWS4" + self.secret_key).encode()
+        for part in (now.strftime("%Y%m%d"), self.region, "s3", "aws4_request"):
+            key = hmac_sha256(key, part)
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["Authorization"] = ("AWS4-HMAC-SHA256 Credential=" + self.access_key + "/" + scope +
+                                    ", SignedHeaders=" + signed_headers + ", Signature=" + signature)
+        return headers
+
+    def request(self, connection: http.client.HTTPConnection, method: str, key: str, query: Dict[str, str] = None,
+                body: bytes = b"") -> Tuple[http.client.HTTPResponse, bytes]:
+        """
+        Sends a signed request about an object of the bucket.
+        Arguments:
+        connection - the connection to the endpoint, see connection()
+        method - the HTTP method
+        key - the key of the object
+        query - optional, the query parameters
+        body - optional, the body of the request
+        Returns:
+        The response and its body, which is read so that the connection can be reused.
+        """
+        query = query or {}
+        path = "/" + self.bucket + "/" + key
+        headers = self.sign(method, path, query, sha256_hex(body))
+        headers["Content-Length"] = str(len(body))
+        url = quote(path, safe="/~")
+        if query:
+            url += "?" + "&".join(quote(name, safe="~") + "=" + quote(value, safe="~")
+                                  for name, value in sorted(query.items()))
+        connection.request(method, url, body, headers)
+        response = connection.getresponse()
+        data = response.read()
+        if response.status >= 300:
+            raise UploadError(response.status, data[:200].decode(errors="replace"))
+        return response, data
+
+
+class UploadQueue:
+    """
+    The files waiting to be uploaded, in an SQLite database so that the uploads resume after a restart.
+    The parts already sent of a multipart upload are recorded as well, so that only the missing ones are sent again.
+    """
+
+    def __init__(self, path: str):
+        """
+        Arguments:
+        path - the path of the database, created if it doesn't exist
+        """
+        self.lock = threading.Lock()
+        self.database = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.database.row_factory = sqlite3.Row
+        self.database.execute("PRAGMA journal_mode=WAL")
+        self.database.execute("CREATE TABLE IF NOT EXISTS uploads (path TEXT PRIMARY KEY, key TEXT NOT NULL, "
+                              "upload_id TEXT, parts TEXT NOT NULL DEFAULT '[]', "
+                              "attempts INTEGER NOT NULL DEFAULT 0, next_try REAL NOT NULL DEFAULT 0)")
+        # The files being uploaded by the workers
+        self.claimed = set()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.database.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+
+    def count_in(self, folder: str) -> int:
+        """
+        Counts the files of a folder still waiting to be uploaded.
+        Arguments:
+        folder - the path of the folder
+        """
+        prefix = os.path.join(os.path.abspath(folder), "")
+        with self.lock:
+            paths = [row[0] for row in self.database.execute("SELECT path FROM uploads")]
+        return sum(1 for path in paths if os.path.abspath(path).startswith(prefix))
+
+    def add(self, path: str, key: str):
+        """
+        Queues a file, unless it's already queued.
+        Arguments:
+        path - the path of the file
+        key - the key of the object to upload it to
+        """
+        with self.lock:
+            self.database.execute("INSERT OR IGNORE INTO uploads (path, key) VALUES (?, ?)", (path, key))
+
+    def claim(self) -> sqlite3.Row:
+        """ Gets the oldest file due which no worker is uploading, or None """
+        with self.lock:
+            for row in self.database.execute("SELECT * FROM uploads WHERE next_try <= ? ORDER BY rowid",
+                                             (time.time(),)):
+                if row["path"] not in self.claimed:
+                    self.claimed.add(row["path"])
+                    return row
+        return None
+
+    def release(self, path: str):
+        """
+        Lets the other workers upload a file again.
+        Arguments:
+        path - the path of the file
+        """
+        with self.lock:
+            self.claimed.discard(path)
+
+    def save_parts(self, path: str, upload_id: str, parts: List[str]):
+        """
+        Records the progress of a multipart upload.
+        Arguments:
+        path - the path of the file
+        upload_id - the ID of the multipart upload, None to start over
+        parts - the ETags of the parts sent
+        """
+        with self.lock:
+            self.database.execute("UPDATE uploads SET upload_id = ?, parts = ? WHERE path = ?",
+                                  (upload_id, json.dumps(parts), path))
+
+    def postpone(self, path: str, delay: float, failed: bool = True):
+        """
+        Tries a file again later.
+        Arguments:
+        path - the path of the file
+        delay - the time to wait before the next attempt (s)
+        failed - True if the attempt failed, False if the file wasn't ready
+        """
+        with self.lock:
+            self.database.execute("UPDATE uploads SET next_try = ?, attempts = attempts + ? WHERE path = ?",
+                                  (time.time() + delay, int(failed), path))
+
+    def remove(self, path: str):
+        """
+        Removes a file uploaded, or which can't be uploaded.
+        Arguments:
+        path - the path of the file
+        """
+        with self.lock:
+            self.database.execute("DELETE FROM uploads WHERE path = ?", (path,))
+
+
+class Uploader:
+    """
+    Replicates the timelapse files to an S3-compatible endpoint as they're written, so that a failed SD card doesn't
+    lose a shoot. The files are queued in an UploadQueue and sent by a few low priority threads, each one keeping its
+    connection alive. While the capture I/O is busy, only the first thread uploads.
+    The failed uploads are tried again later with a growing delay, e.g. while the network is down.
+    """
+
+    def __init__(self, settings: Settings, folders: Folders, is_busy: Callable[[], bool] = None,
+                 scheduler: ThermalScheduler = None):
+        """
+        Arguments:
+        settings - the settings, see the upload_* settings
+        folders - the folders of the photos, the keys of the objects are the paths of the files from the photos folder
+        is_busy - optional, True while the capture I/O is busy, e.g. while DNG files are being encoded
+        scheduler - optional, defers the uploads while the Pi is hot or a photo is being taken
+        """
+        self.endpoint = S3Endpoint(settings.upload_endpoint, settings.upload_bucket, settings.upload_region,
+                                   settings.upload_access_key, settings.upload_secret_key)
+        self.prefix = settings.upload_prefix
+        self.root = os.path.abspath(folders.target_dir)
+        self.queue = UploadQueue(os.path.join(folders.target_dir, "uploads.sqlite"))
+        self.is_busy = is_busy if is_busy is not None else lambda: False
+        self.scheduler = scheduler
+        self.uploaded_files = 0
+        self.uploaded_bytes = 0
+        self.failed_attempts = 0
+        self.last_error = None
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = [threading.Thread(target=self.run, args=(index,), name="uploader-" + str(index), daemon=True)
+                        for index in range(max(1, settings.upload_workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def enqueue(self, path: str):
+        """
+        Queues a file to be uploaded, e.g. once it's been written.
+        Arguments:
+        path - the path of the file, inside the photos folder
+        """
+        key = os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, "/")
+        self.queue.add(path, self.prefix + key)
+        self.wake.set()
+
+    def status(self) -> Dict:
+        """ Gets the status of the uploads as a Dict to be serialized """
+        return {
+            "pending": len(self.queue),
+            "uploaded": self.uploaded_files,
+            "uploaded_bytes": self.uploaded_bytes,
+            "failed_attempts": self.failed_attempts,
+            "last_error": self.last_error,
+            "throttled": self.is_busy(),
+        }
+
+    def close(self):
+        """ Stops the threads after their current upload, the queue is kept for the next run """
+        self.stopping.set()
+        self.wake.set()
+
+    def run(self, index: int):
+        """
+        Uploads the queued files one by one - is meant to be ran in a thread
+        Arguments:
+        index - the index of the thread, only the first one uploads while the capture I/O is busy
+        """
+        lower_thread_priority()
+        connection = None
+        while not self.stopping.is_set():
+            if index > 0 and self.is_busy():
+                self.stopping.wait(THROTTLE_WAIT)
+                continue
+            row = self.queue.claim()
+            if row is None:
+                self.wake.wait(IDLE_WAIT)
+                self.wake.clear()
+                continue
+            path = row["path"]
+            try:
+                if self.scheduler is not None:
+                    self.scheduler.wait_turn("upload")
+                if not os.path.exists(path):
+                    if os.path.exists(os.path.splitext(path)[0] + SPOOL_EXTENSION):
+                        # The DNG file is converted from its spool file at the end of the timelapse
+                        self.queue.postpone(path, RETRY_DELAY, failed=False)
+                    else:
+                        logger.warning("Not uploaded, the file has been deleted: %s", path)
+                        self.queue.remove(path)
+                    continue
+                if connection is None:
+                    connection = self.endpoint.connection()
+                size = os.path.getsize(path)
+                if size < MULTIPART_THRESHOLD:
+                    with open(path, "rb") as f:
+                        self.endpoint.request(connection, "PUT", row["key"], body=f.read())
+                else:
+                    self.upload_multipart(connection, row, size)
+                self.queue.remove(path)
+                self.uploaded_files += 1
+                self.uploaded_bytes += size
+                logger.info("Uploaded: %s", path)
+            except (OSError, http.client.HTTPException, UploadError, ElementTree.ParseError) as e:
+                # e.g. the network is down, the connection is opened again for the next attempt
+                if connection is not None:
+                    connection.close()
+                connection = None
+                self.failed_attempts += 1
+                self.last_error = str(e)
+                self.queue.postpone(path, min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** row["attempts"]))
+                logger.warning("Error while uploading: %s - %s", path, e)
+            finally:
+                self.queue.release(path)
+        if connection is not None:
+            connection.close()
+
+    def upload_multipart(self, connection: http.client.HTTPConnection, row: sqlite3.Row, size: int):
+        """
+        Uploads a large file in parts, resuming from the last part sent. Between two parts, the upload waits while
+        the capture I/O is busy.
+        Arguments:
+        connection - the connection to the endpoint
+        row - the file in the queue
+        size - the size of the file
+        """
+        path = row["path"]
+        key = row["key"]
+        upload_id = row["upload_id"]
+        parts = json.loads(row["parts"])
+        if upload_id is None:
+            _, data = self.endpoint.request(connection, "POST", key, {"uploads": ""})
+            upload_id = next(element.text for element in ElementTree.fromstring(data).iter()
+                             if element.tag.endswith("UploadId"))
+            parts = []
+            self.queue.save_parts(path, upload_id, parts)
+        part_count = (size + PART_SIZE - 1) // PART_SIZE
+        try:
+            with open(path, "rb") as f:
+                for number in range(len(parts) + 1, part_count + 1):
+                    while self.is_busy() and not self.stopping.is_set():
+                        self.stopping.wait(THROTTLE_WAIT)
+                    f.seek((number - 1) * PART_SIZE)
+                    response, _ = self.endpoint.request(connection, "PUT", key,
+                                                        {"partNumber": str(number), "uploadId": upload_id},
+                                                        f.read(PART_SIZE))
+                    parts.append(response.getheader("ETag", ""))
+                    self.queue.save_parts(path, upload_id, parts)
+            body = "<CompleteMultipartUpload>" + "".join(
+                "<Part><PartNumber>" + str(number) + "</PartNumber><ETag>" + etag + "</ETag></Part>"
+                for number, etag in enumerate(parts, 1)) + "</CompleteMultipartUpload>"
+            self.endpoint.request(connection, "POST", key, {"uploadId": upload_id}, body.encode())
+        except UploadError as e:
+            if e.status == 404:
+                # The upload expired on the endpoint, e.g. after a long outage, it starts over
+                self.queue.save_parts(path, None, [])
+            raise
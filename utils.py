@@ -1,11 +1,13 @@
+import base64
 from datetime import datetime
+import io
 import math
 import os
 from pathlib import Path
 import psutil
 from PIL import Image, ImageStat
-import libcamera
 import logging
+import threading
 logger = logging.getLogger(__name__)
 
 
@@ -63,11 +65,57 @@ def brightness(photo):
     photo - the photo to analyse
     """
     im = Image.open(photo)
+    return image_brightness(im)
+
+
+def image_brightness(im):
+    """ 
+    Gets the brightness of an image
+    Arguments: 
+    im - the PIL image to analyse
+    """
     stat = ImageStat.Stat(im)
     r, g, b = stat.mean
     return math.sqrt(0.241*(r**2) + 0.691*(g**2) + 0.068*(b**2))
 
 
+def array_brightness(array, step=4):
+    """ 
+    Gets the brightness of a frame, the same way brightness() does for a photo
+    Arguments: 
+    array - the frame as an RGB array
+    step - only one pixel every step pixels, on both axes, is taken into account
+    """
+    r, g, b = array[::step, ::step, :3].reshape(-1, 3).mean(axis=0)
+    return math.sqrt(0.241*(r**2) + 0.691*(g**2) + 0.068*(b**2))
+
+
+def decimated_luma(array, step=16):
+    """ 
+    Gets a small luma plane of a frame, e.g. to compare frames cheaply
+    Arguments: 
+    array - the frame as an RGB array
+    step - only one pixel every step pixels, on both axes, is taken into account
+    """
+    small = array[::step, ::step, :3].astype("float32")
+    return small[..., 0] * 0.299 + small[..., 1] * 0.587 + small[..., 2] * 0.114
+
+
+def quick_preview(array, max_size=320):
+    """ 
+    Makes a low resolution preview of a frame in a few milliseconds, by skipping pixels rather than resampling
+    Arguments: 
+    array - the frame as an RGB array
+    max_size - the maximum width and height of the preview
+    Returns:
+    The preview as a JPEG data URL.
+    """
+    step = max(1, math.ceil(max(array.shape[:2]) / max_size))
+    buffer = io.BytesIO()
+    Image.fromarray(array[::step, ::step].copy()).save(buffer, format="JPEG", quality=70)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
 def get_cpu_temp():
     """ Gets the CPU temp in celsius """
     tempFile = open("/sys/class/thermal/thermal_zone0/temp")
@@ -76,17 +124,24 @@ def get_cpu_temp():
     return round(float(cpu_temp)/1000, 2)
 
 
+def get_resident_memory():
+    """ Gets the resident memory of the current process, in bytes """
+    return psutil.Process().memory_info().rss
+
+
 def get_cpu_usage():
-    """ Gets the CPU usage in % """
-    return psutil.cpu_percent(interval=1)
+    """ Gets the CPU usage in % since the previous call, without blocking """
+    return psutil.cpu_percent(interval=None)
 
 
 def get_awb_mode(wb):
     """
-    Get the libcamera white balance value from a string value
+    Get the libcamera white balance value from a string value, for the Picamera2 backend - see CameraBackend
     Arguments: 
     wb - the wb as a string
     """
+    # Only installed along with Picamera2, the app runs without it on the fake backend
+    import libcamera
     if wb == "day":
         return libcamera.controls.AwbModeEnum.Daylight
     elif wb == "tungsten":
@@ -135,6 +190,20 @@ def generate_pretty_exposure_times():
     return pretty_exposure_times
 
 
+def pretty_exposure_time(exposure_time):
+    """ 
+    Formats any exposure time in ms, e.g. the exposure times of a bracket which aren't in the usual list
+    Arguments: 
+    exposure_time - the exposure time
+    """
+    pretty_exposure_times = generate_pretty_exposure_times()
+    if exposure_time in pretty_exposure_times:
+        return pretty_exposure_times[exposure_time]
+    if exposure_time >= 1000000:
+        return "{:g}s".format(round(exposure_time / 1000000, 1))
+    return "1/" + str(round(1000000 / exposure_time)) + "s"
+
+
 def create_folder_if_not_exists(folder_path):
     """
     Creates a folder if it doesn't already exist
@@ -156,21 +225,34 @@ def make_thumbnail(input_path: str, output_path: str, max_width: int, max_height
     max_height (int): The maximum height of the resized image.
     """
     with Image.open(input_path) as img:
-        # Get current dimensions
-        original_width, original_height = img.size
-
-        # Calculate the ratio and determine new dimensions
-        ratio = min(max_width / original_width, max_height / original_height)
-        new_width = int(original_width * ratio)
-        new_height = int(original_height * ratio)
-
         # Resize the image
-        resized_img = img.resize((new_width, new_height), Image.LANCZOS)
+        resized_img = resize_to_fit(img, max_width, max_height)
 
         # Save the resized image
         resized_img.save(output_path)
 
 
+def resize_to_fit(img: Image.Image, max_width: int, max_height: int) -> Image.Image:
+    """
+    Resize an image so that it fits within a specified width and height while maintaining aspect ratio.
+    Arguments:
+    img (Image): The image to resize.
+    max_width (int): The maximum width of the resized image.
+    max_height (int): The maximum height of the resized image.
+    Returns:
+    The resized image.
+    """
+    # Get current dimensions
+    original_width, original_height = img.size
+
+    # Calculate the ratio and determine new dimensions
+    ratio = min(max_width / original_width, max_height / original_height)
+    new_width = int(original_width * ratio)
+    new_height = int(original_height * ratio)
+
+    return img.resize((new_width, new_height), Image.LANCZOS)
+
+
 def check_directory_permissions(directory_path):
     """
     Check if the application has read and write permissions in the specified directory.
@@ -199,3 +281,16 @@ def check_directory_permissions(directory_path):
         return False
 
     return True
+
+
+def lower_thread_priority():
+    """
+    Lowers the CPU and I/O priority of the calling thread so that background work doesn't slow the capture down.
+    Only effective on Linux, where priorities are set per thread.
+    """
+    thread_id = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, thread_id, 19)
+        psutil.Process(thread_id).ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (AttributeError, OSError, psutil.Error) as e:
+        logger.warning(f"Unable to lower the thread priority: {e}")